@@ -0,0 +1,127 @@
+import asyncio
+import dataclasses
+import heapq
+import itertools
+import math
+from typing import Dict
+
+from fastapi import HTTPException, status
+
+from metrics import QUEUE_WAIT
+from protocol import ErrorCode
+
+
+@dataclasses.dataclass
+class Ticket:
+    size: int  # Bytes of the encoded audio
+    service: float  # Estimated processing time
+    start: float = 0
+
+
+@dataclasses.dataclass(order=True)
+class _Waiter:
+    priority: int  # Negated, so that higher priorities come first
+    order: int
+    ticket: Ticket = dataclasses.field(compare=False)
+    future: asyncio.Future = dataclasses.field(compare=False)
+
+
+class AdmissionController:
+    r"""
+    Bounded, prioritized admission of requests to `concurrent` inference slots.
+
+    The wait of a new request is estimated from the audio still to be processed ahead of it (guessed from its size
+    in bytes) and the observed real-time factor. Requests that can not meet their deadline are rejected at once
+    with a `Retry-After`, instead of queuing until they time out.
+    """
+
+    def __init__(self, concurrent: int = 8, max_queue: int = 64, timeout: float = 300) -> None:
+        self.concurrent = concurrent
+        self.max_queue = max_queue
+        self.timeout = timeout
+        self.running: Dict[int, Ticket] = {}
+        self.waiting: list[_Waiter] = []
+        self.order = itertools.count()
+
+        # Learned from finished requests
+        self.seconds_per_byte = 1 / 16000  # Audio seconds per byte, 128 kbps to begin with
+        self.rtf: float | None = None  # Processing time per audio second, unknown until observed
+
+    def estimate(self, size: int) -> float:
+        return size * self.seconds_per_byte * (self.rtf or 0)
+
+    def wait_time(self, priority: int = 0) -> float:
+        now = asyncio.get_running_loop().time()
+        running = sum(max(t.service - (now - t.start), 0) for t in self.running.values())
+        ahead = sum(w.ticket.service for w in self.waiting if -w.priority >= priority)
+        return (running + ahead) / self.concurrent
+
+    async def acquire(
+        self, size: int, deadline: float | None = None, priority: int = 0
+    ) -> Ticket:
+        loop = asyncio.get_running_loop()
+        arrived = loop.time()
+        deadline = deadline or self.timeout
+        ticket = Ticket(size, self.estimate(size))
+        if len(self.running) >= self.concurrent or self.waiting:
+            wait = self.wait_time(priority)
+            if len(self.waiting) >= self.max_queue:
+                raise self._reject(ErrorCode.OVERLOAD.value, "Too many requests queued", wait)
+            if self.rtf is not None and wait + ticket.service > deadline:
+                raise self._reject(
+                    ErrorCode.RATELIMIT.value,
+                    f"Estimated completion in {wait + ticket.service:.0f}s misses the {deadline:.0f}s deadline",
+                    wait,
+                )
+
+            waiter = _Waiter(-priority, next(self.order), ticket, loop.create_future())
+            heapq.heappush(self.waiting, waiter)
+            try:
+                await asyncio.wait_for(asyncio.shield(waiter.future), deadline)
+            except BaseException as e:
+                if waiter.future.done():  # Admitted meanwhile
+                    self._release_slot(ticket)
+                else:
+                    waiter.future.cancel()
+                    self.waiting.remove(waiter)
+                    heapq.heapify(self.waiting)
+                if isinstance(e, asyncio.TimeoutError):  # Client has probably given up
+                    raise HTTPException(
+                        status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                        detail=f"Rate limiting...",
+                    )
+                raise
+        else:
+            self.running[id(ticket)] = ticket
+            ticket.start = loop.time()
+        QUEUE_WAIT.observe(ticket.start - arrived, "admission")
+        return ticket
+
+    def release(self, ticket: Ticket, duration: float | None = None) -> None:
+        r"""
+        Free the slot of `ticket`, `duration` (audio seconds) of a finished request refines the estimates.
+        """
+
+        if duration:
+            elapsed = asyncio.get_running_loop().time() - ticket.start
+            self.seconds_per_byte = 0.9 * self.seconds_per_byte + 0.1 * duration / max(ticket.size, 1)
+            rtf = elapsed / duration
+            self.rtf = rtf if self.rtf is None else 0.9 * self.rtf + 0.1 * rtf
+        self._release_slot(ticket)
+
+    def _release_slot(self, ticket: Ticket) -> None:
+        self.running.pop(id(ticket), None)
+        while self.waiting and len(self.running) < self.concurrent:
+            waiter = heapq.heappop(self.waiting)
+            if not waiter.future.done():
+                self.running[id(waiter.ticket)] = waiter.ticket
+                waiter.ticket.start = asyncio.get_running_loop().time()
+                waiter.future.set_result(None)
+
+    @staticmethod
+    def _reject(status_code: int, detail: str, wait: float) -> HTTPException:
+        return HTTPException(
+            status_code=status_code,
+            detail=detail,
+            headers={"Retry-After": str(max(1, math.ceil(wait)))},
+        )
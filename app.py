@@ -1,41 +1,346 @@
 import argparse
 import asyncio
+import io
+import logging
+import os
 import time
 from contextlib import asynccontextmanager
-from typing import Dict
+from typing import AsyncIterator, BinaryIO, Callable, Dict
 
+import numpy as np
 import uvicorn
-from fastapi import Depends, FastAPI, HTTPException, status
+from fastapi import Depends, FastAPI, HTTPException, Request, WebSocket, status
 from fastapi.encoders import jsonable_encoder
 from fastapi.exceptions import RequestValidationError
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse, PlainTextResponse
+from fastapi.responses import (
+    FileResponse,
+    JSONResponse,
+    PlainTextResponse,
+    Response,
+    StreamingResponse,
+)
 from starlette.exceptions import HTTPException as StarletteHTTPException
+from starlette.formparsers import MultiPartParser
 
-from inference import STT, STTArgs
+from admission import AdmissionController
+from audio import RAW_FORMATS, decode_raw, set_decode_threads
+from batching import BatchScheduler
+from cache import ResultCache
+from fetch import URLFetcher
+from inference import STT, GenerateOptions, STTArgs
+from jobs import JobItem, JobManager
+from metrics import (
+    MODEL_MEMORY,
+    REALTIME_SESSIONS,
+    REPLICA_QUEUE_DEPTH,
+    REPLICA_UTILISATION,
+    REQUEST_LATENCY,
+    REQUEST_TTFT,
+    STAGE_SECONDS,
+    render as render_metrics,
+)
+from pool import ReplicaPool, log_phase, start_replicas
 from protocol import (
     AudioTranscriptionRequest,
     AudioTranscriptionResponse,
     AudioTranslationRequest,
     AudioTranslationResponse,
+    AudioVerboseResponse,
+    BatchRequest,
+    LanguageDetectionRequest,
     Error,
     ErrorCode,
     ErrorResponse,
 )
-from utils import ISO_639_1, torch_gc, whisper2srt, whisper2vtt
+from realtime import RealtimeSession, serve as serve_realtime
+from registry import ModelRegistry
+from sharding import Sharder
+from subtitles import CueOptions, SubtitleWriter, render_subtitles, verbose_json
+from utils import ISO_639_1, sse, torch_gc
+from workers import WorkerPool
 
+logger = logging.getLogger(__name__)
 
-@asynccontextmanager
-async def lifespan(app: FastAPI):  # collects GPU memory
-    yield
-    torch_gc()
+SAMPLING_RATE = 16000  # Of every Whisper feature extractor
 
 
 def create_app(
-    models: Dict[str, STT], concurrent: int = 1, timeout: int = 300
+    models: Dict[str, STT | ReplicaPool | WorkerPool] | ModelRegistry,
+    concurrent: int = 8,
+    timeout: int = 300,
+    scheduler: BatchScheduler | None = None,
+    cache: ResultCache | None = None,
+    fetcher: URLFetcher | None = None,
+    max_queue: int = 64,
+    max_upload_bytes: int = 512 << 20,
+    jobs_dir: str | None = None,
+    jobs_input_dir: str | None = None,
+    job_concurrency: int = 32,
+    realtime_sessions: int = 32,
+    sharder: Sharder | None = None,
 ) -> FastAPI:
-    models = {k.lower(): v for k, v in models.items()}  # Case-insensitive
-    semaphore = asyncio.Semaphore(concurrent)
+    registry = models if isinstance(models, ModelRegistry) else ModelRegistry.static(models)
+    admission = AdmissionController(concurrent, max_queue, timeout)
+    scheduler = scheduler or BatchScheduler()
+    cache = cache or ResultCache()
+    fetcher = fetcher or URLFetcher()
+    registry.on_evict.append(scheduler.discard)  # Its batching tasks hold the model
+
+    async def run_job_item(item: JobItem) -> dict:
+        # Not admitted like requests: jobs run `job_concurrency` files at a time, sharing batches with requests
+        file = await fetcher.fetch(item.source) if item.url else open(item.source, "rb")
+        try:
+            model = await registry.acquire(item.model)
+            try:
+                if isinstance(model, WorkerPool):
+                    return await model.run(file, item.options)
+                return await scheduler.run(model, file, item.options)
+            finally:
+                registry.release(item.model)
+        finally:
+            file.close()
+
+    jobs = JobManager(jobs_dir, run_job_item, jobs_input_dir, job_concurrency) if jobs_dir else None
+
+    def replica_stats(key: str):
+        return lambda: [
+            ((name, stats["replica"]), stats[key])
+            for name, model in registry.loaded().items()
+            if isinstance(model, (ReplicaPool, WorkerPool))
+            for stats in model.stats()
+            if key in stats
+        ]
+
+    sessions: set = set()  # Slots of the realtime sessions
+    # Registered while the app runs, so that apps that have stopped are neither scraped nor kept alive
+    collectors = [
+        (REPLICA_QUEUE_DEPTH, replica_stats("queue_depth")),
+        (REPLICA_UTILISATION, replica_stats("utilisation")),
+        (MODEL_MEMORY, lambda: [((m["id"],), m["memory_bytes"]) for m in registry.stats() if m["loaded"]]),
+        (REALTIME_SESSIONS, lambda: [((), len(sessions))]),
+    ]
+
+    created = time.perf_counter()
+
+    async def start() -> None:
+        # Pinned models load (and warm up) in the background, the server answers `/health` meanwhile
+        try:
+            await registry.load_pinned()
+        except Exception:
+            logger.exception("Startup failed")
+            raise
+        log_phase("", "ready", time.perf_counter() - created)
+
+    @asynccontextmanager
+    async def lifespan(app: FastAPI):  # collects GPU memory
+        log_phase("", "bind", time.perf_counter() - created)
+        for gauge, collect in collectors:
+            gauge.collectors.append(collect)
+        app.state.startup = asyncio.create_task(start())
+        if jobs is not None:
+            jobs.start()  # Resumes unfinished jobs
+        try:
+            yield
+        finally:
+            for gauge, collect in collectors:
+                gauge.collectors.remove(collect)
+        app.state.startup.cancel()
+        if jobs is not None:
+            await jobs.close()
+        await scheduler.close()
+        await fetcher.close()
+        await registry.close()
+        torch_gc()
+
+    async def transcribe(
+        model_name: str,
+        file: str | bytes | BinaryIO,
+        options: GenerateOptions,
+        response_format: str,
+        stream: bool,
+        endpoint: str,
+        deadline: float | None = None,
+        priority: int = 0,
+        arrived: float | None = None,
+        cue_options: CueOptions = CueOptions(),
+        raw: tuple[str, int] | None = None,  # (input_format, sample_rate) declared by the client
+    ):
+        start = time.perf_counter()
+        loop = asyncio.get_running_loop()
+        if isinstance(file, str):  # Downloaded before taking an inference slot
+            file = await fetcher.fetch(file)
+            STAGE_SECONDS.observe(time.perf_counter() - start, "download")
+        elif arrived is not None:
+            STAGE_SECONDS.observe(start - arrived, "upload")
+        cleanup = [file.close] if hasattr(file, "close") else []
+        try:
+            if raw is not None:  # Samples already, read with numpy instead of ffmpeg
+                try:
+                    file = await loop.run_in_executor(None, decode_raw, file, *raw, SAMPLING_RATE)
+                except ValueError as e:
+                    raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
+            if isinstance(file, np.ndarray):
+                size = file.nbytes
+            else:
+                size = len(file) if isinstance(file, bytes) else file.seek(0, 2)
+            if not isinstance(file, (bytes, np.ndarray)):
+                file.seek(0)
+            key = await loop.run_in_executor(
+                None,
+                ResultCache.key,
+                file,
+                model_name,
+                options.task,
+                options.language,
+                options.prompt,
+                options.temperature,
+                options.timestamp,
+                [[extra.task, extra.language] for extra in options.extra_decodes],
+            )
+
+            if not stream:
+
+                async def compute() -> dict:
+                    model = await registry.acquire(model_name)  # Loaded if need be
+                    try:
+                        ticket = await admission.acquire(size, deadline, priority)
+                        output = None
+                        try:
+                            if sharder is not None:  # Long files in parallel shards
+                                output = await sharder.run(model, file, options, scheduler)
+                            elif isinstance(model, WorkerPool):
+                                output = await model.run(file, options)
+                            else:
+                                output = await scheduler.run(model, file, options)
+                            return output
+                        finally:
+                            admission.release(ticket, output and output.get("duration"))
+                    finally:
+                        registry.release(model_name)
+
+                try:
+                    output = await cache.get_or_compute(key, compute)
+                except ValueError as e:  # Audio that does not decode, wherever it is decoded
+                    raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
+                rendering = time.perf_counter()
+                response = await loop.run_in_executor(  # Off the event loop, long outputs take a while
+                    None, render, output, response_format, options, cue_options
+                )
+                STAGE_SECONDS.observe(time.perf_counter() - rendering, "render")
+                REQUEST_TTFT.observe(time.perf_counter() - start, endpoint, "false")
+                REQUEST_LATENCY.observe(time.perf_counter() - start, endpoint, "false")
+                return response
+
+            # Streamed results are not cached, but cached results can be streamed
+            output = await cache.get(key)
+            if output is not None:
+                chunks = _once(output["chunks"])
+            else:
+                if not isinstance(file, (bytes, np.ndarray)):
+                    file = _detach(file)
+                    cleanup.append(file.close)
+                model = await registry.acquire(model_name)
+                cleanup.append(lambda: registry.release(model_name))
+                ticket = await admission.acquire(size, deadline, priority)
+                cleanup.append(lambda: admission.release(ticket))
+                if isinstance(model, WorkerPool):
+                    chunks = model.stream_chunks(file, options)
+                else:
+                    chunks = scheduler.stream_chunks(model, file, options)
+            response = StreamingResponse(
+                events(chunks, response_format, cue_options, endpoint, start, cleanup),
+                media_type="text/event-stream",
+            )
+            cleanup = []  # Up to the response now
+            return response
+        finally:
+            for callback in cleanup:
+                callback()
+
+    async def events(
+        chunks_stream: AsyncIterator[list[dict]],
+        response_format: str,
+        cue_options: CueOptions,
+        endpoint: str,
+        start: float,
+        cleanup: list[Callable[[], None]],
+    ) -> AsyncIterator[str]:
+        r"""
+        Server-sent events: one `chunk` (json/text) or `cue` (srt/vtt) per chunk, then `done` with the full text.
+        """
+
+        try:
+            texts, first = [], True
+            writer = SubtitleWriter(response_format, cue_options)  # type: ignore
+            if response_format in ("srt", "vtt"):
+                for cue in writer.header():
+                    yield sse("cue", {"text": cue})
+            async for chunks in chunks_stream:
+                if first:
+                    REQUEST_TTFT.observe(time.perf_counter() - start, endpoint, "true")
+                    first = False
+                texts += [chunk["text"] for chunk in chunks]
+                if response_format in ("srt", "vtt"):
+                    for cue in writer.feed(chunks):
+                        yield sse("cue", {"text": cue})
+                else:
+                    for chunk in chunks:
+                        yield sse("chunk", {"text": chunk["text"], "timestamp": chunk["timestamp"]})
+            if response_format in ("srt", "vtt"):
+                for cue in writer.flush():
+                    yield sse("cue", {"text": cue})
+            yield sse("done", {"text": "".join(texts)})
+        except Exception as e:
+            yield sse(
+                "error",
+                jsonable_encoder(ErrorResponse(error=Error(message=str(e)))),
+            )
+        finally:
+            for callback in cleanup:
+                callback()
+            REQUEST_LATENCY.observe(time.perf_counter() - start, endpoint, "true")
+
+    def render(
+        output: dict, response_format: str, options: GenerateOptions, cue_options: CueOptions
+    ):
+        extras = list(zip(options.extra_decodes, output.get("extra", [])))
+        if response_format == "json":
+            return AudioTranscriptionResponse(
+                text=output["text"],
+                chunks=output["chunks"],
+                skipped_seconds=output.get("skipped_seconds"),
+                tasks=[
+                    {"task": extra.task, "language": extra.language, "text": o["text"], "chunks": o["chunks"]}
+                    for extra, o in extras
+                ]
+                or None,
+            )
+        elif response_format == "verbose_json":
+            return AudioVerboseResponse(
+                **verbose_json(
+                    output,
+                    options.task,
+                    options.language or ISO_639_1.get(output.get("language"), output.get("language")),
+                    options.timestamp == "word",
+                ),
+                tasks=[
+                    verbose_json(
+                        o,
+                        extra.task,
+                        extra.language or ISO_639_1.get(o.get("language"), o.get("language")),
+                        options.timestamp == "word",
+                    )
+                    for extra, o in extras
+                ]
+                or None,
+            )
+        elif response_format == "text":
+            return PlainTextResponse(output["text"])
+        elif response_format in ("srt", "vtt"):
+            return PlainTextResponse(
+                render_subtitles(output["chunks"], response_format, cue_options)  # type: ignore
+            )
 
     app = FastAPI(lifespan=lifespan)
     app.add_middleware(
@@ -45,23 +350,25 @@ def create_app(
         allow_methods=["*"],
         allow_headers=["*"],
     )
+    app.add_middleware(_BodyLimit, max_bytes=max_upload_bytes)
+    app.add_middleware(_Arrival)
 
     @app.post(
         "/v1/audio/transcriptions",
-        response_model=AudioTranscriptionResponse,
+        response_model=AudioTranscriptionResponse | AudioVerboseResponse,  # Not filtered down to the json fields
         status_code=status.HTTP_200_OK,
     )
-    async def audio_transcription(form_data: AudioTranscriptionRequest = Depends()):
+    async def audio_transcription(
+        request: Request, form_data: AudioTranscriptionRequest = Depends()
+    ):
         response_format = form_data.response_format
-        if not response_format.lower() in ["json", "text", "srt", "vtt"]:
+        if not response_format.lower() in ["json", "text", "srt", "vtt", "verbose_json"]:
             raise HTTPException(
                 status_code=status.HTTP_400_BAD_REQUEST,
                 detail=f"Response format '{form_data.response_format}' is not supported!",
             )
 
-        if form_data.model.lower() in models:
-            model = models[form_data.model.lower()]
-        else:
+        if form_data.model.lower() not in registry:
             raise HTTPException(
                 status_code=status.HTTP_400_BAD_REQUEST,
                 detail=f"Model '{form_data.model}' is not supported!",
@@ -69,7 +376,7 @@ def create_app(
 
         file = None
         if form_data.file:
-            file = form_data.file
+            file = form_data.file.file
         elif form_data.url:
             file = form_data.url
         else:
@@ -88,52 +395,53 @@ def create_app(
             language = None
         prompt = form_data.prompt
         temperature = form_data.temperature
+        timestamp = "word" if "word" in (form_data.timestamp_granularities or []) else True
         if not (temperature >= 0 and temperature <= 1):
             raise HTTPException(
                 status_code=status.HTTP_400_BAD_REQUEST,
                 detail="temperature needs to be >=0 and <=1!",
             )
-
-        req_time = time.time()
-        async with semaphore:
-            if time.time() - req_time > timeout:  # Client has probably given up
-                raise HTTPException(
-                    status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
-                    detail=f"Rate limiting...",
-                )
-
-            loop = asyncio.get_running_loop()
-            output: dict = await loop.run_in_executor(
-                None, model.generate, file, True, task, language, prompt, temperature
+        extra_decodes = _extra_decodes(form_data.tasks, timestamp, temperature, language)
+        if extra_decodes and (form_data.stream or response_format.lower() not in ["json", "verbose_json"]):
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail="'tasks' needs a json or verbose_json response, and no stream!",
             )
 
-            if response_format == "json":
-                return AudioTranscriptionResponse(
-                    text=output["text"], chunks=output["chunks"]
-                )
-            elif response_format == "text":
-                return PlainTextResponse(output["text"])
-            elif response_format == "srt":
-                return PlainTextResponse(whisper2srt(output["chunks"]))
-            elif response_format == "vtt":
-                return PlainTextResponse(whisper2vtt(output["chunks"]))
+        return await transcribe(
+            form_data.model.lower(),
+            file,
+            GenerateOptions(timestamp, task, language, prompt, temperature, extra_decodes=extra_decodes),
+            response_format,
+            form_data.stream,
+            "transcriptions",
+            form_data.deadline,
+            form_data.priority,
+            request.scope.get("arrived"),
+            CueOptions(
+                form_data.max_line_chars,
+                max_duration_s=form_data.max_cue_s,
+                merge_words=form_data.merge_words,
+            ),
+            _raw_input(form_data.input_format, form_data.sample_rate),
+        )
 
     @app.post(
         "/v1/audio/translations",
-        response_model=AudioTranslationResponse,
+        response_model=AudioTranslationResponse | AudioVerboseResponse,  # Not filtered down to the json fields
         status_code=status.HTTP_200_OK,
     )
-    async def audio_translation(form_data: AudioTranslationRequest = Depends()):
+    async def audio_translation(
+        request: Request, form_data: AudioTranslationRequest = Depends()
+    ):
         response_format = form_data.response_format
-        if not response_format.lower() in ["json", "text", "srt", "vtt"]:
+        if not response_format.lower() in ["json", "text", "srt", "vtt", "verbose_json"]:
             raise HTTPException(
                 status_code=status.HTTP_400_BAD_REQUEST,
                 detail=f"Response format '{form_data.response_format}' is not supported!",
             )
 
-        if form_data.model.lower() in models:
-            model = models[form_data.model.lower()]
-        else:
+        if form_data.model.lower() not in registry:
             raise HTTPException(
                 status_code=status.HTTP_400_BAD_REQUEST,
                 detail=f"Model '{form_data.model}' is not supported!",
@@ -141,7 +449,7 @@ def create_app(
 
         file = None
         if form_data.file:
-            file = form_data.file
+            file = form_data.file.file
         elif form_data.url:
             file = form_data.url
         else:
@@ -154,35 +462,223 @@ def create_app(
         language = None
         prompt = form_data.prompt
         temperature = form_data.temperature
+        timestamp = "word" if "word" in (form_data.timestamp_granularities or []) else True
         if not (temperature >= 0 and temperature <= 1):
             raise HTTPException(
                 status_code=status.HTTP_400_BAD_REQUEST,
                 detail="temperature needs to be >=0 and <=1!",
             )
 
-        req_time = time.time()
-        async with semaphore:
-            if time.time() - req_time > timeout:  # Client has probably given up
+        return await transcribe(
+            form_data.model.lower(),
+            file,
+            GenerateOptions(timestamp, task, language, prompt, temperature),
+            response_format,
+            form_data.stream,
+            "translations",
+            form_data.deadline,
+            form_data.priority,
+            request.scope.get("arrived"),
+            CueOptions(
+                form_data.max_line_chars,
+                max_duration_s=form_data.max_cue_s,
+                merge_words=form_data.merge_words,
+            ),
+            _raw_input(form_data.input_format, form_data.sample_rate),
+        )
+
+    @app.websocket("/v1/audio/realtime")
+    async def audio_realtime(
+        websocket: WebSocket,
+        model: str = "whisper-1",
+        language: str | None = None,
+        task: str = "transcribe",
+        format: str = "pcm16",
+        sample_rate: int = 16000,
+    ):
+        r"""
+        Live transcription, see `realtime.serve`. `format` is "pcm16" (at `sample_rate`) or anything ffmpeg
+        decodes from a stream, *e.g.* "opus" in Ogg or WebM.
+        """
+
+        model_name = model.lower()
+        error = None
+        if model_name not in registry:
+            error = f"Model '{model}' is not supported!"
+        elif task not in ("transcribe", "translate"):
+            error = f"Task '{task}' is not supported!"
+        elif len(sessions) >= realtime_sessions:
+            error = "Too many realtime sessions"
+        if error is not None:
+            await websocket.close(code=1013 if model_name in registry else 1008, reason=error)
+            return
+        slot = object()  # Taken before the first await, so that concurrent connections can not all pass the check
+        sessions.add(slot)
+        try:
+            if language:
+                language = ISO_639_1.get(language.lower(), language.lower())
+
+            await websocket.accept()
+            stt = await registry.acquire(model_name)
+            try:
+                if isinstance(stt, WorkerPool):  # Its workers only take whole files
+                    await websocket.close(code=1008, reason="Realtime is not supported with --workers")
+                    return
+                options = GenerateOptions(True, task, language if task == "transcribe" else None)  # type: ignore
+                session = RealtimeSession(stt, scheduler, options)
+                await serve_realtime(websocket, session, format, sample_rate)
+            finally:
+                registry.release(model_name)
+        finally:
+            sessions.discard(slot)
+
+    @app.post("/v1/audio/language")
+    async def audio_language(form_data: LanguageDetectionRequest = Depends()):
+        if form_data.model.lower() not in registry:
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail=f"Model '{form_data.model}' is not supported!",
+            )
+        if not (form_data.windows >= 1 and form_data.windows <= 10):
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail="windows needs to be >=1 and <=10!",
+            )
+        if form_data.file:
+            file = form_data.file.file
+        elif form_data.url:
+            file = await fetcher.fetch(form_data.url)
+        else:
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail="Must upload a file or use 'url' param!",
+            )
+
+        # Encoder and one decoder step of a few windows: cheap enough to skip admission and batching
+        model_name = form_data.model.lower()
+        try:
+            model = await registry.acquire(model_name)
+            try:
+                if isinstance(model, WorkerPool):
+                    probs = await model.identify_language(file, form_data.windows)
+                else:
+                    probs = await asyncio.get_running_loop().run_in_executor(
+                        None, model.identify_language, file, form_data.windows
+                    )
+            finally:
+                registry.release(model_name)
+        except ValueError as e:  # Audio that does not decode
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
+        finally:
+            file.close()
+        top = list(probs.items())[: max(form_data.top_k, 1)]
+        return {
+            "language": ISO_639_1.get(top[0][0], top[0][0]),
+            "probabilities": [
+                {"language": ISO_639_1.get(code, code), "code": code, "probability": p}
+                for code, p in top
+            ],
+        }
+
+    @app.get("/v1/models")
+    async def list_models():
+        loaded = registry.loaded()
+        return {
+            "object": "list",
+            "data": [
+                {
+                    **stats,
+                    "object": "model",
+                    "replicas": (
+                        loaded[stats["id"]].stats()
+                        if isinstance(loaded.get(stats["id"]), (ReplicaPool, WorkerPool))
+                        else None
+                    ),
+                }
+                for stats in registry.stats()
+            ],
+        }
+
+    if jobs is not None:
+
+        @app.post("/v1/batches")
+        async def create_batch(form_data: BatchRequest = Depends()):
+            loop = asyncio.get_running_loop()
+            lines = (line.decode() for line in form_data.file.file)
+            try:
+                job = await loop.run_in_executor(None, jobs.create, lines, registry.__contains__)
+            except (ValueError, UnicodeDecodeError) as e:
+                raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
+            return job.summary()
+
+        @app.get("/v1/batches")
+        async def list_batches():
+            return {"object": "list", "data": [job.summary() for job in jobs.jobs.values()]}
+
+        @app.get("/v1/batches/{batch_id}")
+        async def retrieve_batch(batch_id: str):
+            return get_job(batch_id).summary()
+
+        @app.get("/v1/batches/{batch_id}/items")
+        async def list_batch_items(batch_id: str, status: str | None = None):
+            return {
+                "object": "list",
+                "data": [
+                    {"id": item.id, "status": item.status, "duration": item.duration, "error": item.error}
+                    for item in get_job(batch_id).items.values()
+                    if status is None or item.status == status
+                ],
+            }
+
+        @app.get("/v1/batches/{batch_id}/output")
+        async def batch_output(batch_id: str):
+            job = get_job(batch_id)
+            if not os.path.exists(job.output):
+                return PlainTextResponse("", media_type="application/jsonl")
+            return FileResponse(job.output, media_type="application/jsonl")
+
+        @app.post("/v1/batches/{batch_id}/cancel")
+        async def cancel_batch(batch_id: str):
+            job = get_job(batch_id)
+            job.cancel()
+            return job.summary()
+
+        def get_job(batch_id: str):
+            if batch_id not in jobs.jobs:
                 raise HTTPException(
-                    status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
-                    detail=f"Rate limiting...",
+                    status_code=status.HTTP_404_NOT_FOUND,
+                    detail=f"Batch '{batch_id}' not found!",
                 )
+            return jobs.jobs[batch_id]
 
-            loop = asyncio.get_running_loop()
-            output: dict = await loop.run_in_executor(
-                None, model.generate, file, True, task, language, prompt, temperature
+    @app.get("/health")
+    async def health(request: Request):
+        startup = getattr(request.app.state, "startup", None)
+        if startup is not None and startup.done() and not startup.cancelled() and startup.exception():
+            return JSONResponse(
+                {"status": "failed", "error": str(startup.exception())},
+                status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
             )
+        return {"status": "ok"}
 
-            if response_format == "json":
-                return AudioTranscriptionResponse(
-                    text=output["text"], chunks=output["chunks"]
-                )
-            elif response_format == "text":
-                return PlainTextResponse(output["text"])
-            elif response_format == "srt":
-                return PlainTextResponse(whisper2srt(output["chunks"]))
-            elif response_format == "vtt":
-                return PlainTextResponse(whisper2vtt(output["chunks"]))
+    @app.get("/ready")
+    async def ready(request: Request):
+        startup = getattr(request.app.state, "startup", None)  # None without lifespan, all models given loaded
+        if startup is not None and not startup.done():
+            return JSONResponse(
+                {"status": "loading", "models": registry.stats()},
+                status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            )
+        if startup is not None and (startup.cancelled() or startup.exception()):
+            return JSONResponse(
+                {"status": "failed", "models": registry.stats()},
+                status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            )
+        return {"status": "ready", "models": registry.stats()}
+
+    @app.get("/metrics")
+    async def metrics():
+        return Response(render_metrics(), media_type="text/plain; version=0.0.4")
 
     @app.exception_handler(RequestValidationError)
     async def validation_exception_handler(request, exc):
@@ -205,11 +701,123 @@ def create_app(
                 )
             ),
             status_code=status_code,
+            headers=getattr(exc, "headers", None),  # Retry-After of rejected requests
         )
 
     return app
 
 
+class _Arrival:
+    r"""
+    Stamps the arrival of a request, before its body is read, so the upload can be timed.
+    """
+
+    def __init__(self, app) -> None:
+        self.app = app
+
+    async def __call__(self, scope, receive, send) -> None:
+        if scope["type"] == "http":
+            scope["arrived"] = time.perf_counter()
+        await self.app(scope, receive, send)
+
+
+class _BodyLimit:
+    r"""
+    Rejects request bodies larger than `max_bytes` with 413 as soon as they are, instead of once received.
+    """
+
+    def __init__(self, app, max_bytes: int) -> None:
+        self.app = app
+        self.max_bytes = max_bytes
+
+    async def __call__(self, scope, receive, send) -> None:
+        if scope["type"] != "http" or not self.max_bytes:
+            return await self.app(scope, receive, send)
+        length = dict(scope["headers"]).get(b"content-length")
+        if length is not None and length.isdigit() and int(length) > self.max_bytes:
+            return await self._reject(scope, receive, send)
+
+        received = 0
+
+        async def limited():
+            nonlocal received
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+                if received > self.max_bytes:
+                    raise HTTPException(
+                        status_code=status.HTTP_413_CONTENT_TOO_LARGE,
+                        detail=f"Request body is larger than {self.max_bytes >> 20} MB",
+                    )
+            return message
+
+        await self.app(scope, limited, send)
+
+    async def _reject(self, scope, receive, send) -> None:
+        response = JSONResponse(
+            jsonable_encoder(
+                ErrorResponse(
+                    error=Error(
+                        message=f"Request body is larger than {self.max_bytes >> 20} MB",
+                        code=ErrorCode.TOOLARGE,
+                    )
+                )
+            ),
+            status_code=status.HTTP_413_CONTENT_TOO_LARGE,
+        )
+        await response(scope, receive, send)
+
+
+def _extra_decodes(
+    tasks: str | None, timestamp, temperature: float, language: str | None
+) -> tuple[GenerateOptions, ...]:
+    r"""
+    Options of the extra decodes of `tasks`, *e.g.* "translate,transcribe:fr" (task, and forced language if any).
+    They are in the `language` of the request unless forced.
+    """
+
+    extra_decodes = []
+    for spec in filter(None, (s.strip().lower() for s in (tasks or "").split(","))):
+        task, _, code = spec.partition(":")
+        if task not in ("transcribe", "translate"):
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail=f"Task '{spec}' is not supported!",
+            )
+        extra_language = ISO_639_1.get(code, code) or language
+        extra_decodes.append(GenerateOptions(timestamp, task, extra_language, None, temperature))  # type: ignore
+    return tuple(extra_decodes)
+
+
+def _raw_input(input_format: str | None, sample_rate: int) -> tuple[str, int] | None:
+    if input_format is None:
+        return None
+    if input_format.lower() not in RAW_FORMATS or sample_rate <= 0:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"input_format needs to be one of {', '.join(RAW_FORMATS)}, with a positive sample_rate!",
+        )
+    return input_format.lower(), sample_rate
+
+
+def _detach(file: BinaryIO) -> BinaryIO:
+    r"""
+    A handle on an uploaded file that outlives the endpoint, after which FastAPI closes the upload.
+    Files on disk are not copied.
+    """
+
+    file.seek(0)
+    if getattr(file, "_rolled", True) is False:  # Still in memory, thus small
+        return io.BytesIO(file.read())
+    handle = os.fdopen(os.dup(file.fileno()), "rb")  # Same file, which is already unlinked
+    handle.seek(0)
+    return handle
+
+
+async def _once(chunks: list[dict]) -> AsyncIterator[list[dict]]:
+    yield chunks
+
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser = STTArgs.add_cli_args(parser)
@@ -217,7 +825,25 @@ if __name__ == "__main__":
         "--port", default=9000, required=True, type=int, help="HTTP listening port"
     )
     parser.add_argument(
-        "--concurrent", default=1, required=False, type=int, help="Max concurrency"
+        "--concurrent",
+        default=8,
+        required=False,
+        type=int,
+        help="Max concurrent requests, their chunks share batches (default: 8)",
+    )
+    parser.add_argument(
+        "--max-batch-size",
+        default=None,
+        required=False,
+        type=int,
+        help="Max chunks per forward pass across requests (default: --batch-size)",
+    )
+    parser.add_argument(
+        "--max-wait-ms",
+        default=10,
+        required=False,
+        type=float,
+        help="Max time a chunk waits for others to fill its batch (default: 10)",
     )
     parser.add_argument(
         "--wait-timeout",
@@ -226,8 +852,175 @@ if __name__ == "__main__":
         type=int,
         help="Request max waiting time (in second)",
     )
+    parser.add_argument(
+        "--max-queue",
+        default=64,
+        required=False,
+        type=int,
+        help="Max requests waiting for a slot, more are rejected with 529 (default: 64)",
+    )
+    parser.add_argument(
+        "--cache-size-mb",
+        default=256,
+        required=False,
+        type=int,
+        help="Memory budget of the transcription result cache, 0 to disable (default: 256)",
+    )
+    parser.add_argument(
+        "--cache-dir",
+        default=None,
+        required=False,
+        type=str,
+        help="Directory of the on-disk result cache tier (default: None)",
+    )
+    parser.add_argument(
+        "--url-max-mb",
+        default=512,
+        required=False,
+        type=int,
+        help="Max size of a file downloaded from 'url' (default: 512)",
+    )
+    parser.add_argument(
+        "--url-per-host",
+        default=4,
+        required=False,
+        type=int,
+        help="Max concurrent downloads from one host (default: 4)",
+    )
+    parser.add_argument(
+        "--url-timeout",
+        default=60,
+        required=False,
+        type=float,
+        help="Download timeout of 'url' (in second) (default: 60)",
+    )
+    parser.add_argument(
+        "--max-upload-mb",
+        default=512,
+        required=False,
+        type=int,
+        help="Max size of a request body, rejected with 413 while being received, 0 for no limit (default: 512)",
+    )
+    parser.add_argument(
+        "--upload-spool-mb",
+        default=16,
+        required=False,
+        type=int,
+        help="Uploads larger than this are written to a temp file instead of kept in memory, for the whole process (default: 16)",
+    )
+    parser.add_argument(
+        "--workers",
+        default=0,
+        required=False,
+        type=int,
+        help="Run inference in this many worker processes, spread over --device-id, 0 to run in this process (default: 0)",
+    )
+
+    parser.add_argument(
+        "--models-config",
+        default=None,
+        required=False,
+        type=str,
+        help="JSON file of the models to serve, loaded on first use (default: whisper-1 of the args above)",
+    )
+    parser.add_argument(
+        "--memory-budget-mb",
+        default=None,
+        required=False,
+        type=int,
+        help="Memory for the models of --models-config, least recently used ones are unloaded to stay within (default: budget_mb of the file)",
+    )
+    parser.add_argument(
+        "--jobs-dir",
+        default=None,
+        required=False,
+        type=str,
+        help="Directory of the batch jobs of /v1/batches, which are resumed on restart, None to disable them (default: None)",
+    )
+    parser.add_argument(
+        "--jobs-input-dir",
+        default=None,
+        required=False,
+        type=str,
+        help="Directory batch jobs may read files from, None to only allow URLs (default: None)",
+    )
+    parser.add_argument(
+        "--job-concurrency",
+        default=32,
+        required=False,
+        type=int,
+        help="Files of a batch job transcribed at the same time, their chunks share batches (default: 32)",
+    )
+    parser.add_argument(
+        "--realtime-sessions",
+        default=32,
+        required=False,
+        type=int,
+        help="Max concurrent sessions of /v1/audio/realtime, their windows share batches (default: 32)",
+    )
+    parser.add_argument(
+        "--shard-s",
+        default=0,
+        required=False,
+        type=float,
+        help="Transcribe files longer than twice this in shards of about this long, in parallel across replicas or workers, 0 to disable (default: 0)",
+    )
+    parser.add_argument(
+        "--shard-overlap-s",
+        default=5,
+        required=False,
+        type=float,
+        help="Audio decoded past each cut between shards, on both sides (default: 5)",
+    )
+    parser.add_argument(
+        "--decode-threads",
+        default=os.cpu_count() or 4,
+        required=False,
+        type=int,
+        help="Files decoded in-process at the same time, by PyAV when installed (default: CPU count)",
+    )
 
     args = parser.parse_args()
-    models = {"whisper-1": STT(STTArgs.from_cli_args(args))}
-    app = create_app(models, args.concurrent, args.wait_timeout)
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+    stt_args = STTArgs.from_cli_args(args)
+    set_decode_threads(args.decode_threads)
+    # Process-wide: Starlette reads it from the class, larger uploads are written to disk while received
+    MultiPartParser.spool_max_size = args.upload_spool_mb << 20
+
+    def load(stt_args: STTArgs, spec: dict) -> STT | ReplicaPool | WorkerPool:
+        workers = spec.get("workers", args.workers)
+        if workers > 0:
+            pool = WorkerPool(stt_args, workers, args.max_batch_size, args.max_wait_ms / 1000)
+            pool.wait_ready()
+            return pool
+        return start_replicas(stt_args)
+
+    # Models load once the server is up, see `/ready`
+    if args.models_config:
+        models = ModelRegistry.from_file(
+            args.models_config,
+            stt_args,
+            None if args.memory_budget_mb is None else args.memory_budget_mb << 20,
+            load,
+        )
+    else:
+        models = ModelRegistry({"whisper-1": {"pinned": True}}, stt_args, loader=load)
+    scheduler = BatchScheduler(args.max_batch_size, args.max_wait_ms / 1000)
+    cache = ResultCache(args.cache_size_mb << 20, args.cache_dir)
+    fetcher = URLFetcher(args.url_max_mb << 20, args.url_per_host, args.url_timeout)
+    app = create_app(
+        models,
+        args.concurrent,
+        args.wait_timeout,
+        scheduler,
+        cache,
+        fetcher,
+        args.max_queue,
+        args.max_upload_mb << 20,
+        args.jobs_dir,
+        args.jobs_input_dir,
+        args.job_concurrency,
+        args.realtime_sessions,
+        Sharder(args.shard_s, args.shard_overlap_s) if args.shard_s else None,
+    )
     uvicorn.run(app, host="0.0.0.0", port=args.port, workers=1)
@@ -0,0 +1,585 @@
+import io
+import os
+import queue
+import struct
+import subprocess
+import tempfile
+import threading
+import time
+from typing import BinaryIO, Iterable, Iterator
+
+import numpy as np
+
+from metrics import STAGE_SECONDS
+
+try:
+    import av
+except ImportError:  # Optional, ffmpeg subprocesses decode the compressed formats instead
+    av = None
+
+SHM = "/dev/shm" if os.path.isdir("/dev/shm") else None  # Memory-backed temp files when available
+NPY_RATE = 16000  # Of `.npy` files that come without a declared rate
+RAW_FORMATS = ("pcm16", "f32", "npy")  # Declared by the client, decoded without ffmpeg
+WAV_ENCODINGS = {(1, 8), (1, 16), (1, 24), (1, 32), (3, 32), (3, 64)}  # (Format tag, bits) read with numpy
+DECODE_SLOTS = threading.BoundedSemaphore(os.cpu_count() or 4)  # In-process decodes at once
+MALFORMED = (
+    "Soundfile is either not in the correct format or is malformed. Ensure that the soundfile has "
+    "a valid audio file extension (e.g. wav, flac or mp3) and is not corrupted. If reading from a remote "
+    "URL, ensure that the URL is the full address to **download** the audio file."
+)
+
+
+def ffmpeg_stream(
+    source: str | bytes | BinaryIO | np.ndarray,
+    sampling_rate: int,
+    block_s: float = 5,
+) -> Iterator[np.ndarray]:
+    r"""
+    Decode `source` (a path/URL, an encoded file in memory or behind a file object, or samples already decoded)
+    to mono float32 PCM, yielding `block_s` seconds at a time instead of the whole file.
+    Files on disk are read by ffmpeg itself, from their current position.
+    """
+
+    block_size = int(block_s * sampling_rate)
+    if isinstance(source, np.ndarray):
+        for start in range(0, len(source), block_size):
+            yield np.asarray(source[start : start + block_size], dtype=np.float32)
+        return
+
+    command = [
+        "ffmpeg",
+        *("-i", source if isinstance(source, str) else "pipe:0"),
+        *("-ac", "1"),
+        *("-ar", str(sampling_rate)),
+        *("-f", "f32le"),
+        *("-hide_banner", "-loglevel", "quiet"),
+        "pipe:1",
+    ]
+    fileno = None if isinstance(source, (str, bytes)) else _fileno(source)
+    if fileno is not None:
+        os.lseek(fileno, source.tell(), os.SEEK_SET)  # type: ignore
+    try:
+        process = subprocess.Popen(
+            command,
+            stdin=(
+                subprocess.DEVNULL
+                if isinstance(source, str)
+                else fileno if fileno is not None else subprocess.PIPE
+            ),
+            stdout=subprocess.PIPE,
+        )
+    except FileNotFoundError as error:
+        raise ValueError("ffmpeg was not found but is required to load audio files from filename") from error
+
+    writer = None
+    if not isinstance(source, str) and fileno is None:
+        writer = threading.Thread(target=_feed, args=(process.stdin, source), daemon=True)
+        writer.start()
+
+    empty = True
+    decoding = 0.0  # Time waiting for ffmpeg, not for the consumer
+    try:
+        while True:
+            start = time.perf_counter()
+            raw = process.stdout.read(block_size * 4)  # type: ignore
+            decoding += time.perf_counter() - start
+            if not raw:
+                break
+            empty = False
+            yield np.frombuffer(raw, dtype=np.float32)
+        STAGE_SECONDS.observe(decoding, "decode")
+        if empty:
+            raise ValueError(MALFORMED)
+    finally:
+        if process.poll() is None:
+            process.kill()
+        process.wait()
+        process.stdout.close()  # type: ignore
+        if writer is not None:
+            writer.join()
+
+
+def decode_stream(
+    source: str | bytes | BinaryIO | np.ndarray | Iterable[np.ndarray],
+    sampling_rate: int,
+    block_s: float = 5,
+) -> Iterator[np.ndarray]:
+    r"""
+    Same as `ffmpeg_stream`, without a process per file when it can: WAV and `.npy` (taken as 16 kHz) are read
+    with numpy, other formats are decoded in-process by PyAV when it is installed. ffmpeg decodes the rest.
+    Blocks of samples decoded already (*e.g.* handed over to a worker process) are passed through.
+    """
+
+    block_size = int(block_s * sampling_rate)
+    if isinstance(source, np.ndarray):
+        yield from ffmpeg_stream(source, sampling_rate, block_s)
+        return
+    if not isinstance(source, (str, bytes)) and not hasattr(source, "read"):
+        yield from source
+        return
+
+    opened = None
+    if isinstance(source, str) and os.path.isfile(source):
+        source = opened = open(source, "rb")
+    try:
+        header = _peek(source, 12)
+        readable = io.BytesIO(source) if isinstance(source, bytes) else source
+        blocks: Iterator[np.ndarray] | None = None
+        if header[:4] == b"RIFF" and header[8:12] == b"WAVE":
+            blocks = _wav_stream(readable, sampling_rate, block_size)  # type: ignore
+        elif header[:6] == b"\x93NUMPY":
+            samples = resample(_npy(readable.read()), NPY_RATE, sampling_rate)  # type: ignore
+            blocks = ffmpeg_stream(samples, sampling_rate, block_s)
+        if blocks is None and av is not None:
+            blocks = _av_stream(opened.name if opened else source, sampling_rate, block_size)
+        if blocks is None:
+            blocks = ffmpeg_stream(opened.name if opened else source, sampling_rate, block_s)
+        yield from blocks
+    finally:
+        if opened is not None:
+            opened.close()
+
+
+def decode_raw(data: bytes | BinaryIO, format: str, sample_rate: int, sampling_rate: int) -> np.ndarray:
+    r"""
+    Samples declared by the client, "pcm16" (little-endian 16-bit) or "f32" (little-endian float) mono at
+    `sample_rate`, or a `.npy` array of float32 samples at `sample_rate`, resampled to `sampling_rate`.
+    """
+
+    raw = data if isinstance(data, bytes) else data.read()
+    if format == "pcm16":
+        samples = np.frombuffer(raw, dtype="<i2", count=len(raw) // 2).astype(np.float32) / 32768
+    elif format == "f32":
+        samples = np.frombuffer(raw, dtype="<f4", count=len(raw) // 4).astype(np.float32)
+    elif format == "npy":
+        samples = _npy(raw)
+    else:
+        raise ValueError(f"Unknown input format {format!r}, expected one of {', '.join(RAW_FORMATS)}")
+    if not len(samples):
+        raise ValueError(MALFORMED)
+    return resample(samples, sample_rate, sampling_rate)
+
+
+def set_decode_threads(threads: int) -> None:
+    r"""
+    Bound the in-process decodes running at once, each in the thread that prefetches its audio.
+    """
+
+    global DECODE_SLOTS
+    DECODE_SLOTS = threading.BoundedSemaphore(threads)
+
+
+class Resampler:
+    r"""
+    Streaming resampler from `orig_rate` to `rate`, vectorized over each block: a windowed-sinc low-pass filter
+    below the new Nyquist frequency when downsampling, then linear interpolation. The filter history and the
+    position of the next output sample carry over from one block to the next, so blocks join without clicks.
+    """
+
+    def __init__(self, orig_rate: int, rate: int) -> None:
+        self.step = orig_rate / rate  # Input samples per output sample
+        if orig_rate > rate:
+            half = int(np.ceil(8 * self.step))
+            n = np.arange(-half, half + 1)
+            cutoff = 0.475 / self.step  # Cycles per input sample, a little below the new Nyquist frequency
+            taps = 2 * cutoff * np.sinc(2 * cutoff * n) * np.hamming(len(n))
+            self.taps = (taps / taps.sum()).astype(np.float32)
+        else:
+            self.taps = np.ones(1, dtype=np.float32)
+        self.delay = (len(self.taps) - 1) // 2  # Of the filter, in input samples
+        self.history = np.zeros(len(self.taps) - 1, dtype=np.float32)
+        self.filtered = 0  # Filtered samples so far
+        self.last = np.zeros(1, dtype=np.float32)  # The last of them
+        self.emitted = 0  # Output samples so far
+
+    def __call__(self, samples: np.ndarray) -> np.ndarray:
+        if self.step == 1:
+            return samples
+        if len(self.taps) > 1:
+            padded = np.concatenate([self.history, samples])
+            self.history = padded[len(padded) - len(self.history) :]
+            samples = np.convolve(padded, self.taps, mode="valid").astype(np.float32)
+        end = self.filtered + len(samples) - 1  # Index of the last filtered sample
+        count = max(int(np.floor((end - self.delay) / self.step)) - self.emitted + 1, 0)
+        positions = (self.emitted + np.arange(count)) * self.step + self.delay - (self.filtered - 1)
+        output = np.interp(positions, np.arange(len(samples) + 1), np.concatenate([self.last, samples]))
+        if len(samples):
+            self.last = samples[-1:]
+        self.filtered += len(samples)
+        self.emitted += count
+        return output.astype(np.float32)
+
+    def flush(self) -> np.ndarray:
+        r"""
+        The samples still in the filter, at the end of the stream.
+        """
+
+        return self(np.zeros(self.delay, dtype=np.float32))
+
+
+def resample(samples: np.ndarray, orig_rate: int, rate: int) -> np.ndarray:
+    if orig_rate == rate:
+        return samples
+    resampler = Resampler(orig_rate, rate)
+    return np.concatenate([resampler(samples), resampler.flush()])
+
+
+def decode_to_file(
+    file: str | bytes | BinaryIO, sampling_rate: int, max_seconds: float | None = None
+) -> str:
+    r"""
+    Decode to float32 PCM in a memory-backed temp file, one block at a time, up to `max_seconds` if given.
+    The caller owns the file, it can be memory-mapped with `np.memmap(path, dtype=np.float32, mode="r")`.
+    """
+
+    fd, path = tempfile.mkstemp(suffix=".f32", dir=SHM)
+    try:
+        with os.fdopen(fd, "wb") as f:
+            decoded = 0
+            for block in decode_stream(file, sampling_rate):
+                block.tofile(f)
+                decoded += len(block)
+                if max_seconds is not None and decoded >= max_seconds * sampling_rate:
+                    break
+    except BaseException:
+        os.unlink(path)
+        raise
+    return path
+
+
+def probe_duration(source: str | bytes | BinaryIO | np.ndarray, sampling_rate: int = NPY_RATE) -> float | None:
+    r"""
+    Duration in seconds without decoding, `None` if it can not tell: from the header of WAV and `.npy` files
+    (`.npy` and samples already decoded are taken at `sampling_rate`), from their container for other files,
+    read by PyAV when it is installed and by ffprobe otherwise. File objects are left at their position.
+    """
+
+    if isinstance(source, np.ndarray):
+        return len(source) / sampling_rate
+    if isinstance(source, str) and os.path.isfile(source):
+        with open(source, "rb") as file:
+            return probe_duration(file, sampling_rate)
+    header = _peek(source, 12)
+    if header[:4] == b"RIFF" and header[8:12] == b"WAVE" or header[:6] == b"\x93NUMPY":
+        file = io.BytesIO(source) if isinstance(source, bytes) else source
+        start = file.tell()  # type: ignore
+        try:
+            if header[:6] == b"\x93NUMPY":
+                version = np.lib.format.read_magic(file)
+                if version == (1, 0):
+                    shape = np.lib.format.read_array_header_1_0(file)[0]
+                else:
+                    shape = np.lib.format.read_array_header_2_0(file)[0]
+                return shape[0] / sampling_rate if shape else None
+            if (wav := _wav_header(file)) is None or not 0 < wav[4] < 0xFFFFFFFF:  # type: ignore
+                return None
+            tag, channels, rate, bits, size = wav
+            return size / (channels * bits // 8) / rate
+        except ValueError:
+            return None
+        finally:
+            file.seek(start)  # type: ignore
+
+    if isinstance(source, str) or not isinstance(source, bytes) and not source.seekable():
+        return None  # A URL or a pipe: only decoding tells
+    if av is not None:
+        return _av_duration(source)
+
+    path = getattr(source, "name", None)
+    if isinstance(path, str) and os.path.isfile(path):
+        return _ffprobe_duration(path)
+    # Uploads and fetched URLs are spooled to unnamed files once large
+    fileno = None if isinstance(source, bytes) else _fileno(source)
+    if fileno is not None and os.path.exists(f"/proc/self/fd/{fileno}"):
+        return _ffprobe_duration(f"/proc/self/fd/{fileno}")
+    # Or kept in memory, and so small: probed from a copy, a pipe does not tell the duration of every container
+    with tempfile.NamedTemporaryFile(dir=SHM) as copy:
+        copy.write(source if isinstance(source, bytes) else _read_all(source))
+        copy.flush()
+        return _ffprobe_duration(copy.name)
+
+
+def _ffprobe_duration(path: str) -> float | None:
+    command = [
+        "ffprobe",
+        *("-v", "quiet"),
+        *("-show_entries", "format=duration"),
+        *("-of", "csv=p=0"),
+        path,
+    ]
+    try:
+        probed = subprocess.run(command, capture_output=True, text=True, timeout=30)
+        return float(probed.stdout.strip())
+    except (FileNotFoundError, subprocess.TimeoutExpired, ValueError):
+        return None
+
+
+def _av_duration(source: bytes | BinaryIO) -> float | None:
+    file = io.BytesIO(source) if isinstance(source, bytes) else source
+    start = file.tell()
+    try:
+        with av.open(file, metadata_errors="ignore") as container:
+            return container.duration / av.time_base if container.duration else None
+    except Exception:  # Formats vary by version: `av.AVError`, `av.FFmpegError`
+        return None
+    finally:
+        file.seek(start)
+
+
+def _read_all(file: BinaryIO) -> bytes:
+    # The rest of a file object in memory, which is left at its position
+    start = file.tell()
+    try:
+        return file.read()
+    finally:
+        file.seek(start)
+
+
+def _peek(source: str | bytes | BinaryIO, size: int) -> bytes:
+    if isinstance(source, bytes):
+        return source[:size]
+    if isinstance(source, str) or not source.seekable():  # URLs, pipes: left to the decoders
+        return b""
+    position = source.tell()
+    header = source.read(size)
+    source.seek(position)
+    return header
+
+
+def _wav_header(file: BinaryIO) -> tuple[int, int, int, int, int] | None:
+    # (Format tag, channels, rate, bits, data size) of an uncompressed WAV, read up to its samples; `None` for
+    # the encodings left to the decoders (*e.g.* A-law, ADPCM)
+    file.read(12)
+    fmt = None
+    while len(header := file.read(8)) == 8:
+        chunk, size = header[:4], int.from_bytes(header[4:], "little")
+        if chunk == b"fmt ":
+            body = file.read(size + size % 2)
+            tag, channels, rate = struct.unpack("<HHI", body[:8])
+            bits = struct.unpack("<H", body[14:16])[0]
+            if tag == 0xFFFE and size >= 40:  # WAVE_FORMAT_EXTENSIBLE, the tag starts the sub-format GUID
+                tag = struct.unpack("<H", body[24:26])[0]
+            fmt = tag, channels, rate, bits
+        elif chunk == b"data":
+            break
+        else:
+            file.seek(size + size % 2, os.SEEK_CUR)
+    else:
+        return None
+    if fmt is None or (fmt[0], fmt[3]) not in WAV_ENCODINGS or not fmt[1] or not fmt[2]:
+        return None
+    return (*fmt, size)
+
+
+def _wav_stream(file: BinaryIO, sampling_rate: int, block_size: int) -> Iterator[np.ndarray] | None:
+    start = file.tell()
+    if (header := _wav_header(file)) is None:
+        file.seek(start)
+        return None
+
+    tag, channels, rate, bits, size = header
+    frame = channels * bits // 8
+    # Streamed WAVs may leave the size at 0 or the maximum, read those to the end
+    remaining = size if 0 < size < 0xFFFFFFFF else None
+
+    def stream() -> Iterator[np.ndarray]:
+        nonlocal remaining
+        resampler = Resampler(rate, sampling_rate)
+        pending = np.empty(0, dtype=np.float32)
+        empty = True
+        decoding = 0.0
+        read = int(np.ceil(block_size * rate / sampling_rate)) * frame
+        while True:
+            start = time.perf_counter()
+            raw = file.read(read if remaining is None else min(read, remaining))
+            raw = raw[: len(raw) // frame * frame]
+            if remaining is not None:
+                remaining -= len(raw)
+            samples = _pcm(raw, tag, bits)
+            if channels > 1:
+                samples = samples.reshape(-1, channels).mean(axis=1)
+            samples = np.concatenate([pending, resampler(samples), resampler.flush() if not raw else np.empty(0, np.float32)])
+            blocks = len(samples) // block_size if raw else int(np.ceil(len(samples) / block_size))
+            pending = samples[blocks * block_size :]
+            decoding += time.perf_counter() - start
+            for i in range(blocks):
+                empty = False
+                yield samples[i * block_size : (i + 1) * block_size]
+            if not raw:
+                break
+        STAGE_SECONDS.observe(decoding, "decode")
+        if empty:
+            raise ValueError(MALFORMED)
+
+    return stream()
+
+
+def _pcm(raw: bytes, tag: int, bits: int) -> np.ndarray:
+    if tag == 3:
+        return np.frombuffer(raw, dtype=f"<f{bits // 8}").astype(np.float32)
+    if bits == 8:
+        return (np.frombuffer(raw, dtype=np.uint8).astype(np.float32) - 128) / 128
+    if bits == 24:  # Sign-extended into the top of 32-bit integers
+        padded = np.zeros((len(raw) // 3, 4), dtype=np.uint8)
+        padded[:, 1:] = np.frombuffer(raw, dtype=np.uint8).reshape(-1, 3)
+        return padded.view("<i4")[:, 0].astype(np.float32) / 2**31
+    return np.frombuffer(raw, dtype=f"<i{bits // 8}").astype(np.float32) / 2 ** (bits - 1)
+
+
+def _npy(raw: bytes) -> np.ndarray:
+    try:
+        samples = np.load(io.BytesIO(raw), allow_pickle=False)
+    except ValueError as error:
+        raise ValueError(MALFORMED) from error
+    if samples.dtype.kind != "f" or samples.ndim > 2:
+        raise ValueError("A .npy upload must hold float samples, of one channel or (samples, channels)")
+    if samples.ndim == 2:
+        samples = samples.mean(axis=1)
+    return samples.astype(np.float32)
+
+
+def _av_stream(source: str | bytes | BinaryIO, sampling_rate: int, block_size: int) -> Iterator[np.ndarray]:
+    try:
+        container = av.open(io.BytesIO(source) if isinstance(source, bytes) else source, metadata_errors="ignore")
+    except Exception as error:  # Formats vary by version: `av.AVError`, `av.FFmpegError`
+        raise ValueError(MALFORMED) from error
+    with container:
+        if not container.streams.audio:
+            raise ValueError(MALFORMED)
+        frames = container.decode(container.streams.audio[0])
+        resampler = av.AudioResampler(format="flt", layout="mono", rate=sampling_rate)
+        pending: list = []
+        buffered = 0
+        empty = True
+        decoding = 0.0
+        done = False
+        while not done:
+            start = time.perf_counter()
+            with DECODE_SLOTS:  # Released while the consumer waits
+                while not done and buffered < block_size:
+                    try:
+                        frame = next(frames, None)
+                    except Exception as error:
+                        raise ValueError(MALFORMED) from error
+                    done = frame is None
+                    for resampled in resampler.resample(frame):  # `None` flushes it
+                        pending.append(resampled.to_ndarray().reshape(-1))
+                        buffered += len(pending[-1])
+            samples = np.concatenate(pending) if pending else np.empty(0, dtype=np.float32)
+            blocks = int(np.ceil(len(samples) / block_size)) if done else len(samples) // block_size
+            rest = samples[blocks * block_size :]
+            pending, buffered = [rest] if len(rest) else [], len(rest)
+            decoding += time.perf_counter() - start
+            for i in range(blocks):
+                empty = False
+                yield samples[i * block_size : (i + 1) * block_size]
+        STAGE_SECONDS.observe(decoding, "decode")
+        if empty:
+            raise ValueError(MALFORMED)
+
+
+def _fileno(file: BinaryIO) -> int | None:
+    if getattr(file, "_rolled", True) is False:  # `SpooledTemporaryFile` still in memory
+        return None
+    try:
+        return file.fileno()
+    except (AttributeError, OSError):  # `io.UnsupportedOperation` of in-memory files is an `OSError`
+        return None
+
+
+def _feed(stdin, data: bytes | BinaryIO) -> None:
+    try:
+        if isinstance(data, bytes):
+            stdin.write(data)
+        else:  # Never holds more than one block of a file object
+            while block := data.read(1 << 20):
+                stdin.write(block)
+    except (BrokenPipeError, ValueError):  # ffmpeg has exited or been killed
+        pass
+    finally:
+        try:
+            stdin.close()
+        except BrokenPipeError:
+            pass
+
+
+def chunk_windows(
+    blocks: Iterable[np.ndarray], chunk_len: int, stride_left: int, stride_right: int
+) -> Iterator[tuple[np.ndarray, tuple[int, int, int], bool]]:
+    r"""
+    Same windows and strides (in samples) as the pipeline's `chunk_iter`, but over a stream of blocks,
+    keeping at most one window plus one block in memory.
+    """
+
+    step = chunk_len - stride_left - stride_right
+    blocks = iter(blocks)
+    buffer = np.empty(0, dtype=np.float32)
+    exhausted = False
+    first = True
+    while True:
+        # One sample past the window is enough to know whether it is the last one
+        while not exhausted and len(buffer) <= chunk_len:
+            block = next(blocks, None)
+            if block is None:
+                exhausted = True
+            else:
+                buffer = np.concatenate([buffer, block])
+
+        chunk = buffer[:chunk_len]
+        is_last = exhausted and len(buffer) <= chunk_len
+        _stride_left = 0 if first else stride_left
+        _stride_right = 0 if is_last else stride_right
+        if len(chunk) > _stride_left:
+            yield chunk, (len(chunk), _stride_left, _stride_right), is_last
+        if is_last:
+            break
+        buffer = buffer[step:]
+        first = False
+
+
+class _Raised:
+    def __init__(self, error: BaseException) -> None:
+        self.error = error
+
+
+def prefetch(iterable: Iterable, size: int) -> Iterator:
+    r"""
+    Run `iterable` in a background thread, at most `size` items ahead of the consumer.
+    """
+
+    items: queue.Queue = queue.Queue(size)
+    stop = threading.Event()
+    sentinel = object()
+
+    def put(item) -> bool:
+        while not stop.is_set():
+            try:
+                items.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce() -> None:
+        iterator = iter(iterable)
+        try:
+            for item in iterator:
+                if not put(item):
+                    return
+            put(sentinel)
+        except BaseException as error:
+            put(_Raised(error))
+        finally:
+            if hasattr(iterator, "close"):
+                iterator.close()  # type: ignore
+
+    thread = threading.Thread(target=produce, daemon=True)
+    thread.start()
+    try:
+        while (item := items.get()) is not sentinel:
+            if isinstance(item, _Raised):
+                raise item.error
+            yield item
+    finally:
+        stop.set()
+        thread.join()
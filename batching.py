@@ -0,0 +1,379 @@
+import asyncio
+import collections
+import contextlib
+import dataclasses
+import threading
+import time
+from typing import AsyncIterator, Dict, Iterable, Protocol
+
+from inference import GenerateOptions
+from metrics import BATCH_OCCUPANCY, QUEUE_WAIT, REAL_TIME_FACTOR
+
+
+class Model(Protocol):
+    r"""
+    What the scheduler needs from a model, `STT` or any stub with the same stages.
+    """
+
+    batch_size: int
+    sampling_rate: int
+    parallelism: int  # Batches that may run at the same time, *e.g.* one per replica
+
+    def preprocess(self, file) -> Iterable[dict]: ...
+
+    def forward(self, items: list[dict], options: GenerateOptions) -> list[dict]: ...
+
+    def postprocess(self, outputs: list[dict], options: GenerateOptions) -> dict: ...
+
+    # Optional: `language_windows` and `pin_language`, to detect the language of a file once,
+    # and `batch_limit`, the batch size it has learned to fit in memory
+
+
+@dataclasses.dataclass
+class _Pending:
+    item: dict
+    options: GenerateOptions
+    future: asyncio.Future
+    enqueued: float
+
+
+@dataclasses.dataclass
+class _Queue:
+    pending: collections.deque = dataclasses.field(default_factory=collections.deque)
+    event: asyncio.Event = dataclasses.field(default_factory=asyncio.Event)
+    worker: asyncio.Task | None = None
+    batches: set = dataclasses.field(default_factory=set)  # Forward passes running
+
+
+class BatchScheduler:
+    r"""
+    Collects the chunks of all in-flight requests of a model into shared forward passes.
+
+    A batch is sent as soon as `max_batch_size` chunks with the same `GenerateOptions` are waiting,
+    or when the oldest of them has waited `max_wait` seconds.
+    """
+
+    def __init__(
+        self,
+        max_batch_size: int | None = None,
+        max_wait: float = 0.01,
+        max_pending: int = 64,
+    ) -> None:
+        self.max_batch_size = max_batch_size  # Falls back to `model.batch_size`
+        self.max_wait = max_wait
+        self.max_pending = max_pending  # Per request, bounds the decoded windows waiting for the model
+        self.queues: Dict[int, _Queue] = {}
+
+    def submit(self, model: Model, item: dict, options: GenerateOptions) -> asyncio.Future:
+        r"""
+        Queue one chunk, the returned future resolves to its forward output.
+        """
+
+        loop = asyncio.get_running_loop()
+        queue = self.queues.get(id(model))
+        if queue is None:
+            queue = self.queues[id(model)] = _Queue()
+        if queue.worker is None or queue.worker.done():
+            queue.worker = loop.create_task(self._run(model, queue))
+
+        future = loop.create_future()
+        queue.pending.append(_Pending(item, options, future, loop.time()))
+        queue.event.set()
+        return future
+
+    async def stream(self, model: Model, file, options: GenerateOptions) -> AsyncIterator[dict]:
+        r"""
+        Yield the forward outputs of the windows of one file, in order, as soon as each is ready.
+        Its chunks are batched with those of other requests.
+        """
+
+        loop = asyncio.get_running_loop()
+        futures: asyncio.Queue = asyncio.Queue()
+        submitted: list[asyncio.Future] = []
+        pending = asyncio.Semaphore(self.max_pending)
+
+        async def produce() -> None:
+            nonlocal options
+            try:
+                items = iterate_in_thread(model.preprocess(file))
+                if getattr(model, "language_windows", 0) and options.language is None:
+                    # Detected once on the first windows, the whole file is then decoded in that language
+                    first = [item async for item in _take_first(items, model.language_windows)]
+                    if first:
+                        options = await loop.run_in_executor(None, model.pin_language, first, options)
+                    items = _chain(first, items)
+                async for item in items:
+                    await pending.acquire()
+                    future = self.submit(model, item, options)
+                    future.add_done_callback(lambda _: pending.release())
+                    submitted.append(future)
+                    futures.put_nowait(future)
+                futures.put_nowait(None)
+            except Exception as e:
+                futures.put_nowait(e)
+
+        producer = asyncio.ensure_future(produce())
+        try:
+            while (future := await futures.get()) is not None:
+                if isinstance(future, Exception):
+                    raise future
+                yield await future
+        finally:
+            producer.cancel()
+            for future in submitted:
+                future.cancel()
+
+    async def run(self, model: Model, file, options: GenerateOptions) -> dict:
+        r"""
+        Transcribe one file, its chunks are batched with those of other requests.
+        """
+
+        start = time.perf_counter()
+        outputs = [output async for output in self.stream(model, file, options)]
+        loop = asyncio.get_running_loop()
+        result = await loop.run_in_executor(None, model.postprocess, outputs, options)
+        if result.get("duration"):
+            REAL_TIME_FACTOR.observe((time.perf_counter() - start) / result["duration"])
+        return result
+
+    async def stream_chunks(
+        self, model: Model, file, options: GenerateOptions
+    ) -> AsyncIterator[list[dict]]:
+        r"""
+        Like `run`, but yield the `chunks` of the transcription as soon as they can no longer change,
+        *i.e.* once they end before the right stride of the last decoded window.
+
+        Only the windows from the one holding the end of the last emitted chunk are postprocessed again, their
+        timestamps shifted by where that window starts, so each window is merged a bounded number of times.
+        """
+
+        loop = asyncio.get_running_loop()
+        start = time.perf_counter()
+        outputs: list[dict] = []  # Windows not yet behind the emitted chunks
+        starts: list[int] = []  # Where each of them starts in the audio, past its left stride, in samples
+        stable = 0  # End of the last window, before its right stride
+        emitted = -float("inf")  # End of the last emitted chunk, in seconds
+        chunks: list[dict] = []  # Not emitted yet
+        last = None
+        async for output in self.stream(model, file, options):
+            chunk_len, stride_left, stride_right = output["stride"]
+            outputs.append(output)
+            starts.append(stable)
+            stable += chunk_len - stride_left - stride_right
+            last = output
+
+            # `postprocess` converts strides in place, only hand it copies
+            result = await loop.run_in_executor(
+                None, model.postprocess, [dict(o) for o in outputs], options
+            )
+            shift = starts[0] / model.sampling_rate
+            chunks = [
+                _shifted(chunk, shift)
+                for chunk in result["chunks"]
+                if chunk["timestamp"][1] is None or chunk["timestamp"][1] + shift > emitted + 0.01
+            ]
+            if output["is_last"] or stride_right == 0:  # Nothing can overlap what is decoded
+                if chunks:
+                    yield chunks
+                # Windows without right stride stand alone, *e.g.* VAD ones, whose timestamps are in the audio
+                outputs, starts, chunks = [], [], []
+                continue
+
+            end = 0
+            boundary = stable / model.sampling_rate + 0.005  # Timestamps are rounded to 10 ms
+            while end < len(chunks) and (
+                chunks[end]["timestamp"][1] is not None and chunks[end]["timestamp"][1] <= boundary
+            ):
+                end += 1
+            if end:
+                yield chunks[:end]
+                emitted = chunks[end - 1]["timestamp"][1]
+                chunks = chunks[end:]
+                # Merging starts again at the window the emitted chunks end in
+                while len(starts) > 1 and starts[1] / model.sampling_rate <= emitted + 0.01:
+                    outputs.pop(0)
+                    starts.pop(0)
+        if chunks:  # The last window was too short to be decoded
+            yield chunks
+        if last is not None and last.get("samples"):
+            duration = last["samples"] / model.sampling_rate
+            REAL_TIME_FACTOR.observe((time.perf_counter() - start) / duration)
+
+    async def discard(self, model: Model) -> None:
+        r"""
+        Stop the tasks of `model`, *e.g.* once it is unloaded, so that they no longer hold it.
+        """
+
+        queue = self.queues.pop(id(model), None)
+        if queue is None:
+            return
+        tasks = [queue.worker, *queue.batches] if queue.worker else [*queue.batches]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        for p in queue.pending:
+            p.future.cancel()
+
+    async def close(self) -> None:
+        for queue in self.queues.values():
+            tasks = [queue.worker, *queue.batches] if queue.worker else [*queue.batches]
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+        self.queues.clear()
+
+    async def _run(self, model: Model, queue: _Queue) -> None:
+        loop = asyncio.get_running_loop()
+        slots = asyncio.Semaphore(getattr(model, "parallelism", 1))
+        while True:
+            while not queue.pending:
+                queue.event.clear()
+                await queue.event.wait()
+            await slots.acquire()  # Only form a batch once it can run
+
+            # Give other requests a chance to join the batch of the oldest chunk
+            options = queue.pending[0].options
+            max_batch_size = self._batch_size(model, options)
+            deadline = queue.pending[0].enqueued + self.max_wait
+            while (
+                sum(p.options == options for p in queue.pending) < max_batch_size
+                and (delay := deadline - loop.time()) > 0
+            ):
+                queue.event.clear()
+                try:
+                    await asyncio.wait_for(queue.event.wait(), delay)
+                except asyncio.TimeoutError:
+                    break
+
+            batch = self._take(queue, options, max_batch_size)
+            if not batch:
+                slots.release()
+                continue
+            BATCH_OCCUPANCY.observe(len(batch) / max_batch_size)
+            for p in batch:
+                QUEUE_WAIT.observe(loop.time() - p.enqueued, "batch")
+            task = loop.create_task(self._forward(model, batch, options, slots))
+            queue.batches.add(task)
+            task.add_done_callback(queue.batches.discard)
+
+    @staticmethod
+    async def _forward(
+        model: Model, batch: list[_Pending], options: GenerateOptions, slots: asyncio.Semaphore
+    ) -> None:
+        loop = asyncio.get_running_loop()
+        try:
+            outputs = await loop.run_in_executor(
+                None, model.forward, [p.item for p in batch], options
+            )
+        except Exception as e:
+            for p in batch:
+                if not p.future.done():
+                    p.future.set_exception(e)
+        else:
+            for p, output in zip(batch, outputs):
+                if not p.future.done():
+                    p.future.set_result(output)
+        finally:
+            slots.release()
+
+    def _batch_size(self, model: Model, options: GenerateOptions) -> int:
+        # Within what the model has learned to fit in memory, if it learns it
+        limit = model.batch_limit(options) if hasattr(model, "batch_limit") else model.batch_size
+        return min(self.max_batch_size or limit, limit)
+
+    @staticmethod
+    def _take(queue: _Queue, options: GenerateOptions, size: int) -> list[_Pending]:
+        batch, rest = [], collections.deque()
+        while queue.pending:
+            p = queue.pending.popleft()
+            if p.future.cancelled():  # Client has gone
+                continue
+            if len(batch) < size and p.options == options:
+                batch.append(p)
+            else:
+                rest.append(p)
+        queue.pending = rest
+        return batch
+
+
+async def iterate_in_thread(iterable: Iterable) -> AsyncIterator:
+    r"""
+    Iterate a blocking iterable (*e.g.* audio decoding) in a thread of its own, one item ahead of the consumer.
+    The thread closes it, once the consumer stops, as soon as the item being computed is done.
+    """
+
+    loop = asyncio.get_running_loop()
+    items: asyncio.Queue = asyncio.Queue()
+    room = threading.Semaphore(1)
+    stop = threading.Event()
+    done = loop.create_future()
+    sentinel = object()
+
+    def put(item) -> None:
+        with contextlib.suppress(RuntimeError):  # The loop has closed
+            loop.call_soon_threadsafe(items.put_nowait, item)
+
+    def produce() -> None:
+        iterator = iter(iterable)
+        try:
+            for item in iterator:
+                while not room.acquire(timeout=0.1):
+                    if stop.is_set():
+                        return
+                if stop.is_set():
+                    return
+                put(item)
+            put(sentinel)
+        except BaseException as error:
+            put(_Raised(error))
+        finally:
+            if hasattr(iterator, "close"):
+                iterator.close()  # type: ignore
+            with contextlib.suppress(RuntimeError):
+                loop.call_soon_threadsafe(lambda: done.done() or done.set_result(None))
+
+    threading.Thread(target=produce, daemon=True).start()
+    try:
+        while (item := await items.get()) is not sentinel:
+            if isinstance(item, _Raised):
+                raise item.error
+            room.release()
+            yield item
+    finally:
+        stop.set()
+        await asyncio.shield(done)
+
+
+class _Raised:
+    def __init__(self, error: BaseException) -> None:
+        self.error = error
+
+
+def _shifted(chunk: dict, shift: float) -> dict:
+    # `chunk` with its timestamps moved by `shift` seconds
+    if not shift:
+        return chunk
+    begin, end = chunk["timestamp"]
+    return {
+        **chunk,
+        "timestamp": (
+            None if begin is None else round(begin + shift, 2),
+            None if end is None else round(end + shift, 2),
+        ),
+    }
+
+
+async def _take_first(items: AsyncIterator, count: int) -> AsyncIterator:
+    # At most `count` items, the rest stays in `items`
+    for _ in range(count):
+        try:
+            yield await items.__anext__()
+        except StopAsyncIteration:
+            return
+
+
+async def _chain(first: list, rest: AsyncIterator) -> AsyncIterator:
+    for item in first:
+        yield item
+    async for item in rest:
+        yield item
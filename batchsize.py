@@ -0,0 +1,104 @@
+import dataclasses
+import threading
+from typing import Callable, Dict, List
+
+# Messages of the allocators running out: CUDA and MPS, then CPU
+OOM_MESSAGES = ("out of memory", "can't allocate memory", "not enough memory")
+
+
+def is_out_of_memory(error: BaseException) -> bool:
+    r"""
+    Whether `error` is a device or host allocation failure, which a smaller batch may not hit.
+    A `MemoryError` counts too, so that tests can inject one on CPU.
+    """
+
+    if isinstance(error, MemoryError):
+        return True
+    return isinstance(error, RuntimeError) and any(message in str(error) for message in OOM_MESSAGES)
+
+
+@dataclasses.dataclass
+class _Shape:
+    limit: int  # Largest batch run now
+    safe: int = 0  # Largest batch that ran since the last failure
+    streak: int = 0  # Batches of `limit` that ran since the limit last changed
+    wait: int = 0  # Streak before probing a larger limit, doubles on each failed probe
+
+
+class BatchSizer:
+    r"""
+    Learns the largest batch that fits in memory, per shape of batch (*e.g.* word timestamps keep every cross
+    attention). A batch that runs out of memory halves the limit, or takes it back to the last size that ran
+    when it was a probe. After `probe_after` full batches in a row, and if the device has memory to spare,
+    the limit grows again by a quarter, up to `maximum`. Thread-safe, replicas of a device share one.
+    """
+
+    def __init__(
+        self, initial: int, maximum: int | None = None, probe_after: int = 50, sizes: List[int] | None = None
+    ) -> None:
+        self.initial = initial
+        self.maximum = max(initial, maximum or initial)
+        self.probe_after = probe_after
+        self.sizes = sizes  # The only sizes allowed, *e.g.* the buckets of compiled graphs
+        self.lock = threading.Lock()
+        self.shapes: Dict[str, _Shape] = {}
+
+    def limit(self, shape: str) -> int:
+        with self.lock:
+            return self._get(shape).limit
+
+    def limits(self) -> Dict[str, int]:
+        with self.lock:
+            return {shape: state.limit for shape, state in self.shapes.items()}
+
+    def failed(self, shape: str, size: int) -> int:
+        r"""
+        A batch of `size` ran out of memory, returns the new limit.
+        """
+
+        with self.lock:
+            state = self._get(shape)
+            if 0 < state.safe < size:  # A probe, or memory taken by something else: back to what ran
+                state.wait *= 2
+                state.limit = state.safe
+            else:
+                state.limit = self._snap(max(1, size // 2))
+                state.safe = 0
+            state.streak = 0
+            return state.limit
+
+    def succeeded(self, shape: str, size: int, memory_free: Callable[[], bool]) -> int | None:
+        r"""
+        A batch of `size` ran, returns the new limit if it is now probing a larger one. `memory_free` tells
+        whether the device has room for it, only asked before probing.
+        """
+
+        with self.lock:
+            state = self._get(shape)
+            if size > state.safe:
+                if state.safe:  # A probe that ran, the next one needs no longer wait
+                    state.wait = self.probe_after
+                state.safe = size
+            if size < state.limit:
+                return None
+            state.streak += 1
+            if state.streak < state.wait or state.limit >= self.maximum or not memory_free():
+                return None
+            state.limit = self._grow(state.limit)
+            state.streak = 0
+            return state.limit
+
+    def _get(self, shape: str) -> _Shape:
+        if shape not in self.shapes:
+            self.shapes[shape] = _Shape(self.initial, wait=self.probe_after)
+        return self.shapes[shape]
+
+    def _snap(self, size: int) -> int:
+        if not self.sizes:
+            return size
+        return max([s for s in self.sizes if s <= size] or [min(self.sizes)])
+
+    def _grow(self, size: int) -> int:
+        if self.sizes:
+            return min([s for s in self.sizes if s > size] or [size])
+        return min(size + max(1, size // 4), self.maximum)
@@ -0,0 +1,660 @@
+import argparse
+import asyncio
+import concurrent.futures
+import copy
+import dataclasses
+import io
+import json
+import random
+import re
+import resource
+import subprocess
+import sys
+import time
+import wave
+from typing import Callable, Dict, Iterator, List
+
+import httpx
+import numpy as np
+import torch
+
+from app import create_app
+from audio import chunk_windows, decode_raw, decode_stream, ffmpeg_stream, resample
+from batching import BatchScheduler
+from cache import ResultCache
+from inference import STT, GenerateOptions, STTArgs
+from pool import load_replicas
+from sharding import Sharder
+from subtitles import CueOptions, render_subtitles
+from utils import srt_chunk, torch_gc, vtt_chunk
+
+SAMPLING_RATE = 16000
+
+
+class StubSTT:
+    r"""
+    Stand-in for `STT` with the same stages: audio is really decoded and chunked, but the forward pass only sleeps
+    `forward_s` plus `item_s` per chunk, so the serving path can be benchmarked on any box.
+    """
+
+    language_windows = 0  # Whisper detects the language per window, as `STT` does by default
+
+    def __init__(
+        self,
+        batch_size: int = 24,
+        chunk_length_s: float = 30,
+        forward_s: float = 0.05,
+        item_s: float = 0.01,
+        parallelism: int = 1,
+    ) -> None:
+        self.model_name = "stub"
+        self.device = "stub"
+        self.batch_size = batch_size
+        self.chunk_length_s = chunk_length_s
+        self.forward_s = forward_s
+        self.item_s = item_s
+        self.sampling_rate = SAMPLING_RATE
+        self.parallelism = parallelism  # Batches sleeping at the same time, as replicas would run
+
+    def preprocess(self, file) -> Iterator[dict]:
+        chunk_len = int(self.chunk_length_s * self.sampling_rate)
+        stride = chunk_len // 6
+        decoded = 0
+
+        def count(blocks):
+            nonlocal decoded
+            for block in blocks:
+                decoded += len(block)
+                yield block
+
+        blocks = count(decode_stream(file, self.sampling_rate))
+        for _, window_stride, is_last in chunk_windows(blocks, chunk_len, stride, stride):
+            yield {"stride": window_stride, "is_last": is_last, "samples": decoded if is_last else None}
+
+    def forward(self, items: list[dict], options: GenerateOptions) -> list[dict]:
+        time.sleep(self.forward_s + self.item_s * len(items))
+        return [dict(item) for item in items]
+
+    def postprocess(self, outputs: list[dict], options: GenerateOptions) -> dict:
+        chunks, offset = [], 0
+        for output in outputs:
+            chunk_len, stride_left, stride_right = output["stride"]
+            step = chunk_len - stride_left - stride_right
+            begin, end = offset / self.sampling_rate, (offset + step) / self.sampling_rate
+            chunks.append({"text": f" Stub from {begin:.1f}s.", "timestamp": (begin, end)})
+            offset += step
+        result = {"text": "".join(c["text"] for c in chunks), "chunks": chunks}
+        if outputs and outputs[-1].get("samples") is not None:
+            result["duration"] = outputs[-1]["samples"] / self.sampling_rate
+        return result
+
+    def detect_language(self, items: list[dict]) -> Dict[str, float]:
+        return {"en": 1.0}
+
+    generate = STT.generate
+    identify_language = STT.identify_language
+
+
+def synthetic_audio(seconds: float, seed: int) -> bytes:
+    r"""
+    Speech-like 16 kHz mono WAV: bursts of harmonic tones separated by pauses, over a low noise floor.
+    """
+
+    rng = np.random.default_rng(seed)
+    n = int(seconds * SAMPLING_RATE)
+    audio = rng.normal(0, 0.003, n).astype(np.float32)
+    position = 0
+    while position < n:
+        length = int(rng.uniform(0.3, 3) * SAMPLING_RATE)
+        t = np.arange(min(length, n - position)) / SAMPLING_RATE
+        pitch = rng.uniform(90, 250)
+        burst = sum(np.sin(2 * np.pi * pitch * k * t) / k for k in range(1, 6))
+        envelope = 0.5 * (1 + np.sin(2 * np.pi * rng.uniform(3, 6) * t))  # Syllable rate
+        audio[position : position + len(t)] += 0.1 * burst * envelope
+        position += length + int(rng.uniform(0.1, 1) * SAMPLING_RATE)
+
+    buffer = io.BytesIO()
+    with wave.open(buffer, "wb") as f:
+        f.setnchannels(1)
+        f.setsampwidth(2)
+        f.setframerate(SAMPLING_RATE)
+        f.writeframes((np.clip(audio, -1, 1) * 32767).astype(np.int16).tobytes())
+    return buffer.getvalue()
+
+
+def workload(mix: str, requests: int, seed: int) -> List[tuple[float, bytes]]:
+    r"""
+    `requests` synthetic files, their durations drawn from `mix`, *e.g.* "10:0.6,60:0.3,600:0.1" (seconds:weight).
+    """
+
+    durations, weights = zip(*((float(d), float(w)) for d, w in (p.split(":") for p in mix.split(","))))
+    rng = random.Random(seed)
+    picked = rng.choices(durations, weights, k=requests)
+    return [(seconds, synthetic_audio(seconds, seed + index)) for index, seconds in enumerate(picked)]
+
+
+def samples(paths: str) -> List[tuple[float, bytes]]:
+    r"""
+    Real audio files (comma-separated paths), *e.g.* a fixed sample to measure accuracy on.
+    """
+
+    audios = []
+    for path in paths.split(","):
+        with open(path, "rb") as f:
+            data = f.read()
+        seconds = sum(len(block) for block in decode_stream(data, SAMPLING_RATE)) / SAMPLING_RATE
+        audios.append((seconds, data))
+    return audios
+
+
+async def bench_http(args: argparse.Namespace, model, audios: List[tuple[float, bytes]]) -> List[float | None]:
+    r"""
+    Send every file through `create_app` in-process, from `--concurrency` clients.
+    """
+
+    scheduler = BatchScheduler(args.max_batch_size, args.max_wait_ms / 1000)
+    app = create_app(
+        {"whisper-1": model},
+        args.concurrent,
+        args.wait_timeout,
+        scheduler,
+        ResultCache(0),  # Every request has to be transcribed
+        max_queue=len(audios),
+    )
+    latencies: List[float | None] = [None] * len(audios)
+    indexes = iter(range(len(audios)))
+
+    async def client(http: httpx.AsyncClient) -> None:
+        for index in indexes:
+            start = time.perf_counter()
+            response = await http.post(
+                "/v1/audio/transcriptions",
+                files={"file": ("audio.wav", audios[index][1], "audio/wav")},
+                data={"model": "whisper-1", "response_format": args.response_format},
+            )
+            if response.status_code == 200:
+                latencies[index] = time.perf_counter() - start
+            else:
+                print(f"Request {index} failed: {response.status_code} {response.text}", file=sys.stderr)
+
+    transport = httpx.ASGITransport(app=app)  # type: ignore
+    async with httpx.AsyncClient(transport=transport, base_url="http://benchmark", timeout=None) as http:
+        try:
+            await asyncio.gather(*(client(http) for _ in range(args.concurrency)))
+        finally:
+            await scheduler.close()
+    return latencies
+
+
+def bench_engine(args: argparse.Namespace, model, audios: List[tuple[float, bytes]]) -> List[float | None]:
+    r"""
+    Call `generate` on every file, from `--concurrency` threads.
+    """
+
+    def run(data: bytes) -> float:
+        start = time.perf_counter()
+        model.generate(data)
+        return time.perf_counter() - start
+
+    with concurrent.futures.ThreadPoolExecutor(args.concurrency) as executor:
+        return list(executor.map(run, (data for _, data in audios)))
+
+
+def bench_dtypes(args: argparse.Namespace, audios: List[tuple[float, bytes]]) -> Dict[str, dict]:
+    r"""
+    Run the engine once per `--dtypes`, and measure the word error rate of each against `--references`
+    (one transcript per line, one line per sample), or against the first dtype when there are none.
+    """
+
+    references = None
+    if args.references:
+        with open(args.references) as f:
+            references = [line.strip() for line in f]
+    results = {}
+    for dtype in args.dtypes.split(","):
+        model = load_replicas(dataclasses.replace(STTArgs.from_cli_args(args), dtype=dtype))
+        for _ in range(args.warmup_requests):
+            model.generate(audios[0][1])
+        texts, latencies = [], []
+        for _, data in audios:
+            start = time.perf_counter()
+            texts.append(model.generate(data)["text"])
+            latencies.append(time.perf_counter() - start)
+        references = references or texts
+        results[dtype] = {
+            **summarize(audios, latencies, sum(latencies)),  # Peak memory only ever grows across dtypes
+            "wer": word_error_rate(references, texts),
+        }
+        del model
+        torch_gc()
+    return results
+
+
+async def bench_shards(args: argparse.Namespace, model, audios: List[tuple[float, bytes]]) -> Dict[str, object]:
+    r"""
+    Transcribe every file in one pass, then in `--shard-s` shards, and compare their times and word error rates,
+    against `--references` (one transcript per line, one line per sample) or against the single pass when there
+    are none. Sharding is within tolerance when it adds at most `--shard-tolerance` to the word error rate.
+    """
+
+    scheduler = BatchScheduler(args.max_batch_size, args.max_wait_ms / 1000)
+    sharder = Sharder(args.shard_s, args.shard_overlap_s, min_s=0)
+    options = GenerateOptions()
+    texts: Dict[str, List[str]] = {"sequential": [], "sharded": []}
+    seconds = {"sequential": 0.0, "sharded": 0.0}
+    try:
+        for _, data in audios:
+            for name in texts:
+                start = time.perf_counter()
+                if name == "sequential":
+                    output = await scheduler.run(model, data, options)
+                else:
+                    output = await sharder.run(model, data, options, scheduler)
+                seconds[name] += time.perf_counter() - start
+                texts[name].append(output["text"])
+    finally:
+        await scheduler.close()
+
+    references = texts["sequential"]
+    if args.references:
+        with open(args.references) as f:
+            references = [line.strip() for line in f]
+    wer = {name: word_error_rate(references, hypotheses) for name, hypotheses in texts.items()}
+    return {
+        "audio_seconds": sum(s for s, _ in audios),
+        "sequential_seconds": seconds["sequential"],
+        "sharded_seconds": seconds["sharded"],
+        "speedup": seconds["sequential"] / seconds["sharded"],
+        "wer_sequential": wer["sequential"],
+        "wer_sharded": wer["sharded"],
+        "tolerance": args.shard_tolerance,
+        "within_tolerance": wer["sharded"] - wer["sequential"] <= args.shard_tolerance,
+    }
+
+
+def word_error_rate(references: List[str], hypotheses: List[str]) -> float:
+    r"""
+    Word-level edit distance over the number of reference words, case and punctuation ignored.
+    """
+
+    edits, words = 0, 0
+    for reference, hypothesis in zip(references, hypotheses):
+        ref, hyp = (re.findall(r"\w+(?:'\w+)?", text.lower()) for text in (reference, hypothesis))
+        distance = list(range(len(hyp) + 1))
+        for i, r in enumerate(ref, 1):
+            previous, distance[0] = distance[0], i
+            for j, h in enumerate(hyp, 1):
+                previous, distance[j] = distance[j], min(distance[j] + 1, distance[j - 1] + 1, previous + (r != h))
+        edits += distance[-1]
+        words += len(ref)
+    return edits / max(words, 1)
+
+
+def bench_render(hours: float, repeat: int = 3) -> Dict[str, dict]:
+    r"""
+    Time the subtitle renderer against the former `whisper2srt`/`whisper2vtt`, on `hours` of word-level chunks.
+    """
+
+    rng = random.Random(0)
+    chunks, t = [], 0.0
+    while t < hours * 3600:
+        duration = rng.uniform(0.1, 0.6)
+        chunks.append({"text": f" word{len(chunks)}", "timestamp": (t, t + duration)})
+        t += duration + rng.uniform(0, 0.2)
+
+    def best(render: Callable[[list[dict]], str], fresh: bool) -> float:
+        times = []
+        for _ in range(repeat):
+            data = copy.deepcopy(chunks) if fresh else chunks  # The former ones patch their input
+            start = time.perf_counter()
+            render(data)
+            times.append(time.perf_counter() - start)
+        return min(times)
+
+    results = {}
+    for format, legacy in (("srt", _legacy_whisper2srt), ("vtt", _legacy_whisper2vtt)):
+        assert render_subtitles(chunks, format) == legacy(copy.deepcopy(chunks))  # type: ignore
+        legacy_s = best(legacy, fresh=True)
+        new_s = best(lambda c: render_subtitles(c, format), fresh=False)  # type: ignore
+        shaped_s = best(
+            lambda c: render_subtitles(c, format, CueOptions(42, merge_words=True, max_duration_s=6)),  # type: ignore
+            fresh=False,
+        )
+        results[format] = {
+            "chunks": len(chunks),
+            "legacy_seconds": legacy_s,
+            "seconds": new_s,
+            "speedup": legacy_s / new_s,
+            "shaped_seconds": shaped_s,
+        }
+    return results
+
+
+def bench_decode(audios: List[tuple[float, bytes]], repeat: int = 3) -> Dict[str, dict]:
+    r"""
+    Time the decoding of each format through `decode_stream` (or `decode_raw` for raw samples) against one ffmpeg
+    process per file, on the same audio. Raw formats are compared with ffmpeg decoding them as WAV, the form they
+    had to be sent in before. Compressed formats are encoded by ffmpeg, and left out if it is not installed.
+    """
+
+    formats: Dict[str, List[tuple[bytes, bytes]]] = {}  # Format: (file, what ffmpeg decodes) per audio
+    for _, data in audios:
+        samples = np.concatenate(list(decode_stream(data, SAMPLING_RATE)))
+        npy = io.BytesIO()
+        np.save(npy, samples)
+        pcm16 = (np.clip(samples, -1, 1) * 32767).astype("<i2")
+        stereo = resample(samples, SAMPLING_RATE, 44100)
+        wav_44k = _wav(np.repeat(stereo[:, None], 2, axis=1), 44100)
+        files = {"wav": data, "wav_44k_stereo": wav_44k, "npy": npy.getvalue(), "pcm16": pcm16.tobytes()}
+        for format, file in files.items():
+            formats.setdefault(format, []).append((file, data if format in ("npy", "pcm16") else file))
+        for format in ("flac", "mp3", "opus"):
+            if (encoded := _ffmpeg_encode(data, format)) is not None:
+                formats.setdefault(format, []).append((encoded, encoded))
+
+    def best(decode: Callable[[bytes], int], files: List[bytes]) -> float | None:
+        times = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            try:
+                for file in files:
+                    decode(file)
+            except ValueError:  # ffmpeg not installed
+                return None
+            times.append(time.perf_counter() - start)
+        return min(times)
+
+    seconds = sum(s for s, _ in audios)
+    results = {}
+    for format, pairs in formats.items():
+        if format == "pcm16":
+            decode = lambda file: len(decode_raw(file, "pcm16", SAMPLING_RATE, SAMPLING_RATE))
+        else:
+            decode = lambda file: sum(len(block) for block in decode_stream(file, SAMPLING_RATE))
+        new_s = best(decode, [file for file, _ in pairs])
+        ffmpeg_s = best(lambda file: sum(len(b) for b in ffmpeg_stream(file, SAMPLING_RATE)), [f for _, f in pairs])
+        results[format] = {
+            "files": len(pairs),
+            "ffmpeg_seconds": ffmpeg_s,
+            "seconds": new_s,
+            "speedup": ffmpeg_s / new_s if ffmpeg_s and new_s else None,
+            "realtime_factor": seconds / new_s if new_s else None,
+        }
+    return results
+
+
+def _wav(samples: np.ndarray, rate: int) -> bytes:
+    buffer = io.BytesIO()
+    with wave.open(buffer, "wb") as f:
+        f.setnchannels(samples.shape[1] if samples.ndim == 2 else 1)
+        f.setsampwidth(2)
+        f.setframerate(rate)
+        f.writeframes((np.clip(samples, -1, 1) * 32767).astype(np.int16).tobytes())
+    return buffer.getvalue()
+
+
+def _ffmpeg_encode(data: bytes, format: str) -> bytes | None:
+    muxer = {"opus": "ogg"}.get(format, format)
+    command = ["ffmpeg", "-i", "pipe:0", *(["-c:a", "libopus"] if format == "opus" else []), "-f", muxer]
+    try:
+        encoded = subprocess.run([*command, "-loglevel", "quiet", "pipe:1"], input=data, capture_output=True)
+    except FileNotFoundError:
+        return None
+    return encoded.stdout or None
+
+
+def _legacy_whisper2srt(chunks: list[dict]) -> str:
+    result = ""
+    for index, chunk in enumerate(chunks, start=1):
+        if chunk["timestamp"][1] is None:  # Whisper did not predict an ending timestamp
+            chunk["timestamp"] = (chunk["timestamp"][0], chunk["timestamp"][0] + 0.001)
+        result += srt_chunk(
+            index, chunk["timestamp"][0], chunk["timestamp"][1], chunk["text"]
+        )
+    return result
+
+
+def _legacy_whisper2vtt(chunks: list[dict]) -> str:
+    result = "WEBVTT\n\n"
+    for chunk in chunks:
+        if chunk["timestamp"][1] is None:  # Whisper did not predict an ending timestamp
+            chunk["timestamp"] = (chunk["timestamp"][0], chunk["timestamp"][0] + 0.001)
+        result += vtt_chunk(chunk["timestamp"][0], chunk["timestamp"][1], chunk["text"])
+    return result
+
+
+def peak_memory() -> Dict[str, int | None]:
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return {
+        "rss_bytes": rss if sys.platform == "darwin" else rss * 1024,  # Bytes on macOS, KiB on Linux
+        "gpu_bytes": (
+            sum(torch.cuda.max_memory_allocated(i) for i in range(torch.cuda.device_count()))
+            if torch.cuda.is_initialized()
+            else None
+        ),
+    }
+
+
+def summarize(
+    audios: List[tuple[float, bytes]], latencies: List[float | None], wall: float
+) -> Dict[str, object]:
+    done = [(seconds, latency) for (seconds, _), latency in zip(audios, latencies) if latency is not None]
+    times = np.array([latency for _, latency in done]) if done else np.zeros(1)
+    audio_seconds = sum(seconds for seconds, _ in done)
+    return {
+        "requests": len(audios),
+        "errors": len(audios) - len(done),
+        "audio_seconds": audio_seconds,
+        "wall_seconds": wall,
+        "throughput": audio_seconds / wall,  # Audio seconds per second
+        "latency": {
+            "mean": float(times.mean()),
+            "p50": float(np.percentile(times, 50)),
+            "p95": float(np.percentile(times, 95)),
+            "p99": float(np.percentile(times, 99)),
+        },
+        "memory": peak_memory(),
+    }
+
+
+def compare(results: dict, baseline: dict) -> None:
+    r"""
+    Print the relative change of the headline numbers against a previous run.
+    """
+
+    if "render" in results or "decode" in results:
+        kind = "render" if "render" in results else "decode"
+        for format in results[kind].keys() & baseline.get(kind, {}).keys():
+            previous, value = baseline[kind][format]["seconds"], results[kind][format]["seconds"]
+            print(f"{format:>12}: {previous:10.3f} -> {value:10.3f} ({(value - previous) / previous * 100:+.1f}%)")
+        return
+    if "shards" in results:
+        for name in ("speedup", "wer_sharded"):
+            previous, value = baseline.get("shards", {}).get(name), results["shards"][name]
+            if previous is not None:
+                print(f"{name:>12}: {previous:10.3f} -> {value:10.3f}")
+        return
+    if "dtypes" in results:
+        for dtype in results["dtypes"].keys() & baseline.get("dtypes", {}).keys():
+            print(f"{dtype}:")
+            compare(results["dtypes"][dtype], baseline["dtypes"][dtype])
+        return
+    rows = [("throughput", results["throughput"], baseline["throughput"])]
+    rows += [(f"latency {k}", results["latency"][k], baseline["latency"][k]) for k in ("p50", "p95", "p99")]
+    for name, value, previous in rows:
+        change = (value - previous) / previous * 100 if previous else float("nan")
+        print(f"{name:>12}: {previous:10.3f} -> {value:10.3f} ({change:+.1f}%)")
+
+
+def load_model(args: argparse.Namespace):
+    if args.stub:
+        return StubSTT(
+            args.batch_size,
+            args.chunk_length_s,
+            args.stub_forward_ms / 1000,
+            args.stub_item_ms / 1000,
+            args.replicas_per_device,
+        )
+    return load_replicas(STTArgs.from_cli_args(args))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser = STTArgs.add_cli_args(parser)
+    parser.description = "Benchmark the HTTP API or the STT engine on synthetic or sample audio"
+    parser.set_defaults(model_name="openai/whisper-tiny")  # Small enough for any box
+    parser.add_argument(
+        "--mode",
+        default="http",
+        choices=["http", "engine", "dtypes", "render", "shards", "decode"],
+        help="Drive create_app in-process, call STT.generate directly, compare --dtypes of the engine, time the subtitle renderer, compare sharded and single-pass transcription, or time audio decoding per format against ffmpeg (default: http)",
+    )
+    parser.add_argument(
+        "--shard-s",
+        default=600,
+        type=float,
+        help="Shard length of --mode shards, files are sharded whatever their length (default: 600)",
+    )
+    parser.add_argument(
+        "--shard-overlap-s",
+        default=5,
+        type=float,
+        help="Audio decoded past each cut between shards, on both sides (default: 5)",
+    )
+    parser.add_argument(
+        "--shard-tolerance",
+        default=0.01,
+        type=float,
+        help="Word error rate sharding may add to the single pass in --mode shards (default: 0.01)",
+    )
+    parser.add_argument(
+        "--render-hours",
+        default=3,
+        type=float,
+        help="Hours of word-level chunks rendered by --mode render (default: 3)",
+    )
+    parser.add_argument(
+        "--dtypes",
+        default="fp32,bf16,int8",
+        type=str,
+        help="Types compared by --mode dtypes, the first one is the accuracy reference without --references (default: fp32,bf16,int8)",
+    )
+    parser.add_argument(
+        "--samples",
+        default=None,
+        type=str,
+        help="Comma-separated audio files to use instead of synthetic audio",
+    )
+    parser.add_argument(
+        "--references",
+        default=None,
+        type=str,
+        help="Transcripts of --samples, one per line, for the word error rate of --mode dtypes and --mode shards",
+    )
+    parser.add_argument(
+        "--stub",
+        action="store_true",
+        help="Use a stub model that sleeps instead of running Whisper, no GPU needed (default: False)",
+    )
+    parser.add_argument(
+        "--stub-forward-ms",
+        default=50,
+        type=float,
+        help="Time of a stub forward pass (default: 50)",
+    )
+    parser.add_argument(
+        "--stub-item-ms",
+        default=10,
+        type=float,
+        help="Extra time of a stub forward pass per chunk (default: 10)",
+    )
+    parser.add_argument(
+        "--audio-mix",
+        default="10:0.6,60:0.3,600:0.1",
+        type=str,
+        help="Durations of the synthetic files and their weights, as seconds:weight (default: 10:0.6,60:0.3,600:0.1)",
+    )
+    parser.add_argument("--requests", default=32, type=int, help="Files to transcribe (default: 32)")
+    parser.add_argument(
+        "--concurrency", default=8, type=int, help="Clients sending requests at the same time (default: 8)"
+    )
+    parser.add_argument(
+        "--warmup-requests", default=1, type=int, help="Requests sent before measuring (default: 1)"
+    )
+    parser.add_argument("--seed", default=0, type=int, help="Seed of the synthetic workload (default: 0)")
+    parser.add_argument(
+        "--concurrent", default=8, type=int, help="Max concurrent requests of the server (default: 8)"
+    )
+    parser.add_argument(
+        "--max-batch-size",
+        default=None,
+        type=int,
+        help="Max chunks per forward pass across requests (default: --batch-size)",
+    )
+    parser.add_argument(
+        "--max-wait-ms",
+        default=10,
+        type=float,
+        help="Max time a chunk waits for others to fill its batch (default: 10)",
+    )
+    parser.add_argument("--wait-timeout", default=300, type=int, help="Request max waiting time (in second)")
+    parser.add_argument(
+        "--response-format", default="json", type=str, help="Response format of the requests (default: json)"
+    )
+    parser.add_argument("--output", default=None, type=str, help="Write the results to this JSON file")
+    parser.add_argument(
+        "--baseline", default=None, type=str, help="Compare with the results of a previous run (JSON file)"
+    )
+
+    args = parser.parse_args()
+    if args.mode == "render":
+        audios = []
+    elif args.samples:
+        audios = samples(args.samples)
+    else:
+        audios = workload(args.audio_mix, args.requests, args.seed)
+
+    if args.mode == "render":
+        results = {"mode": args.mode, "config": vars(args), "render": bench_render(args.render_hours)}
+    elif args.mode == "decode":
+        results = {"mode": args.mode, "config": vars(args), "decode": bench_decode(audios)}
+    elif args.mode == "dtypes":
+        results = {
+            "mode": args.mode,
+            "model": args.model_name,
+            "config": vars(args),
+            "dtypes": bench_dtypes(args, audios),
+        }
+    elif args.mode == "shards":
+        results = {
+            "mode": args.mode,
+            "model": "stub" if args.stub else args.model_name,
+            "config": vars(args),
+            "shards": asyncio.run(bench_shards(args, load_model(args), audios)),
+        }
+    else:
+        model = load_model(args)
+        bench: Callable = (
+            (lambda audios: asyncio.run(bench_http(args, model, audios)))
+            if args.mode == "http"
+            else (lambda audios: bench_engine(args, model, audios))
+        )
+
+        if args.warmup_requests:
+            bench([(10, synthetic_audio(10, 2**31))] * args.warmup_requests)
+        start = time.perf_counter()
+        latencies = bench(audios)
+        results = {
+            "mode": args.mode,
+            "model": "stub" if args.stub else args.model_name,
+            "config": vars(args),
+            **summarize(audios, latencies, time.perf_counter() - start),
+        }
+
+    print(json.dumps(results, indent=2))
+    if args.baseline:
+        with open(args.baseline) as f:
+            compare(results, json.load(f))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
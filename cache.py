@@ -0,0 +1,140 @@
+import asyncio
+import collections
+import hashlib
+import json
+import os
+from typing import Awaitable, BinaryIO, Callable, Dict
+
+import numpy as np
+
+
+class _Abandoned(Exception):
+    r"""
+    The request running an inference has gone, whoever waits on it should retry.
+    """
+
+
+class ResultCache:
+    r"""
+    Content-addressed cache of `STT.generate` outputs.
+
+    Outputs are kept JSON-encoded in an in-memory LRU bounded by `max_bytes`, and optionally in `directory`
+    (unbounded, clean it up however you like). Identical requests that are in flight wait on the same inference.
+    """
+
+    def __init__(self, max_bytes: int = 256 << 20, directory: str | None = None) -> None:
+        self.max_bytes = max_bytes
+        self.directory = directory
+        self.size = 0
+        self.entries: collections.OrderedDict[str, bytes] = collections.OrderedDict()
+        self.inflight: Dict[str, asyncio.Future] = {}
+
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+    @staticmethod
+    def key(
+        data: bytes | BinaryIO | np.ndarray,
+        model: str,
+        task: str,
+        language: str | None,
+        prompt: str | None,
+        temperature: float,
+        timestamp: str | bool = True,
+        extra: list | None = None,  # (task, language) of extra decodes
+    ) -> str:
+        digest = hashlib.sha256()
+        if isinstance(data, bytes):
+            digest.update(data)
+        elif isinstance(data, np.ndarray):  # Decoded samples
+            digest.update(np.ascontiguousarray(data, dtype=np.float32).data)
+        else:
+            while block := data.read(1 << 20):
+                digest.update(block)
+            data.seek(0)
+        params = [model, task, language, prompt, temperature, timestamp]
+        if extra:  # Keys without them stay the same
+            params.append(extra)
+        digest.update(json.dumps(params).encode())
+        return digest.hexdigest()
+
+    async def get(self, key: str) -> dict | None:
+        if (data := self._get_memory(key)) is None:
+            loop = asyncio.get_running_loop()
+            if (data := await loop.run_in_executor(None, self._get_disk, key)) is None:
+                return None
+            self._put_memory(key, data)
+        return json.loads(data)
+
+    async def get_or_compute(
+        self, key: str, compute: Callable[[], Awaitable[dict]]
+    ) -> dict:
+        loop = asyncio.get_running_loop()
+        while True:
+            if (data := self._get_memory(key)) is not None:
+                return json.loads(data)
+            if (future := self.inflight.get(key)) is not None:
+                try:
+                    return json.loads(await asyncio.shield(future))
+                except _Abandoned:
+                    continue
+            break
+
+        future = self.inflight[key] = loop.create_future()
+        try:
+            data = await loop.run_in_executor(None, self._get_disk, key)
+            if data is None:
+                data = json.dumps(await compute(), ensure_ascii=False).encode()
+                await loop.run_in_executor(None, self._put_disk, key, data)
+            self._put_memory(key, data)
+            future.set_result(data)
+            return json.loads(data)
+        except asyncio.CancelledError:
+            future.set_exception(_Abandoned())
+            raise
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            if future.done() and not future.cancelled():
+                future.exception()  # Nobody may be waiting on it
+            del self.inflight[key]
+
+    def _get_memory(self, key: str) -> bytes | None:
+        data = self.entries.get(key)
+        if data is not None:
+            self.entries.move_to_end(key)
+        return data
+
+    def _put_memory(self, key: str, data: bytes) -> None:
+        if len(data) > self.max_bytes:
+            return
+        if key in self.entries:
+            self.size -= len(self.entries.pop(key))
+        self.entries[key] = data
+        self.size += len(data)
+        while self.size > self.max_bytes:
+            _, evicted = self.entries.popitem(last=False)
+            self.size -= len(evicted)
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, key[:2], f"{key}.json")  # type: ignore
+
+    def _get_disk(self, key: str) -> bytes | None:
+        if not self.directory:
+            return None
+        try:
+            with open(self._path(key), "rb") as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def _put_disk(self, key: str, data: bytes) -> None:
+        if not self.directory:
+            return
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = f"{path}.{os.getpid()}.tmp"
+        with open(tmp, "wb") as f:
+            f.write(data)
+        os.replace(tmp, path)  # Atomic, readers never see partial files
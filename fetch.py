@@ -0,0 +1,99 @@
+import asyncio
+import contextlib
+import dataclasses
+import tempfile
+from typing import AsyncIterator, BinaryIO, Dict
+
+import httpx
+from fastapi import HTTPException, status
+
+
+@dataclasses.dataclass
+class _Host:
+    semaphore: asyncio.Semaphore
+    users: int = 0  # Downloads waiting or running
+
+
+class URLFetcher:
+    r"""
+    Downloads the `url` param on the event loop with a shared, connection-pooled client,
+    streaming into a temp file that is only spilled to disk above `spool_bytes`.
+    """
+
+    def __init__(
+        self,
+        max_bytes: int = 512 << 20,
+        per_host: int = 4,
+        timeout: float = 60,
+        spool_bytes: int = 16 << 20,
+    ) -> None:
+        self.max_bytes = max_bytes
+        self.spool_bytes = spool_bytes
+        self.client = httpx.AsyncClient(
+            timeout=timeout,
+            follow_redirects=True,
+            limits=httpx.Limits(max_connections=100, max_keepalive_connections=20),
+        )
+        self.per_host = per_host
+        self.hosts: Dict[str, _Host] = {}  # Only those with downloads in flight
+
+    async def fetch(self, url: str) -> BinaryIO:
+        try:
+            parsed = httpx.URL(url)
+        except httpx.InvalidURL:
+            parsed = None
+        if parsed is None or parsed.scheme not in ("http", "https"):
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail="'url' must be an http(s) URL!",
+            )
+
+        loop = asyncio.get_running_loop()
+        spool = tempfile.SpooledTemporaryFile(max_size=self.spool_bytes)
+        try:
+            async with self._host(parsed.host):
+                async with self.client.stream("GET", parsed) as response:
+                    response.raise_for_status()
+                    if int(response.headers.get("content-length", 0)) > self.max_bytes:
+                        raise self._too_large()
+                    size = 0
+                    async for block in response.aiter_bytes():
+                        size += len(block)
+                        if size > self.max_bytes:
+                            raise self._too_large()
+                        await loop.run_in_executor(None, spool.write, block)  # To disk past `spool_bytes`
+        except httpx.HTTPError as e:
+            spool.close()
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail=f"Failed to download '{url}': {e}",
+            )
+        except BaseException:
+            spool.close()
+            raise
+        spool.seek(0)
+        return spool  # type: ignore
+
+    async def close(self) -> None:
+        await self.client.aclose()
+
+    @contextlib.asynccontextmanager
+    async def _host(self, host: str) -> AsyncIterator[None]:
+        # At most `per_host` downloads at a time from `host`
+        entry = self.hosts.get(host)
+        if entry is None:
+            entry = self.hosts[host] = _Host(asyncio.Semaphore(self.per_host))
+        entry.users += 1
+        try:
+            async with entry.semaphore:
+                yield
+        finally:
+            entry.users -= 1
+            if not entry.users:
+                del self.hosts[host]
+
+    def _too_large(self) -> HTTPException:
+        return HTTPException(
+            status_code=status.HTTP_413_CONTENT_TOO_LARGE,
+            detail=f"File behind 'url' is larger than {self.max_bytes} bytes!",
+        )
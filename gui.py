@@ -6,7 +6,9 @@ from typing import Dict
 import gradio as gr
 
 from inference import STT, STTArgs
-from utils import ISO_639_1, torch_gc, whisper2srt, whisper2vtt
+from pool import ReplicaPool, start_replicas
+from subtitles import whisper2srt, whisper2vtt
+from utils import ISO_639_1, torch_gc
 
 
 def check_null(**kwargs):
@@ -15,7 +17,7 @@ def check_null(**kwargs):
             raise gr.Error(f"'{k}' is required!")
 
 
-def create_gui(models: Dict[str, STT]) -> gr.TabbedInterface:
+def create_gui(models: Dict[str, STT | ReplicaPool]) -> gr.TabbedInterface:
     # Transcription
     audio_transcription_inputs = [
         gr.Audio(type="filepath"),
@@ -153,7 +155,7 @@ if __name__ == "__main__":
     )
 
     args = parser.parse_args()
-    models = {"whisper-1": STT(STTArgs.from_cli_args(args))}
+    models = {"whisper-1": start_replicas(STTArgs.from_cli_args(args))}
     gui = create_gui(models)
     try:
         gui.launch(server_name="0.0.0.0", server_port=args.port, inbrowser=True)
@@ -1,18 +1,54 @@
 import argparse
 import dataclasses
-from typing import Dict, Literal
+import itertools
+import logging
+import os
+import threading
+import time
+from typing import Dict, Iterator, Literal
 
+import numpy as np
 import torch
-from transformers import pipeline
+from transformers import AutoModelForSpeechSeq2Seq, StoppingCriteria, StoppingCriteriaList, pipeline
+from transformers.pipelines.base import pad_collate_fn
+
+from audio import chunk_windows, decode_stream, prefetch
+from batchsize import BatchSizer, is_out_of_memory
+from metrics import (
+    AUDIO_SECONDS,
+    BATCH_LIMIT,
+    GPU_MEMORY_PEAK,
+    OUT_OF_MEMORY,
+    REAL_TIME_FACTOR,
+    SPECULATIVE_FALLBACKS,
+    SPECULATIVE_TOKENS,
+    STAGE_SECONDS,
+)
+from vad import EnergyVAD, pack_windows, remap, speech_segments
+
+logger = logging.getLogger(__name__)
 
 
 @dataclasses.dataclass
 class STTArgs:
     device_id: str = "0"
+    replicas_per_device: int = 1
     model_name: str = "openai/whisper-large-v3"
     batch_size: int = 24
+    batch_size_max: int | None = None
     chunk_length_s: float = 30
     flash: bool = False
+    vad: bool = False
+    vad_threshold_db: float = -45
+    dtype: str = "auto"
+    threads: int = 0
+    interop_threads: int = 0
+    cpu_cores: str | None = None
+    assistant_model: str | None = None
+    warmup: str = "1,max"
+    compile: bool = False
+    compile_cache_dir: str | None = None
+    detect_language_windows: int = 0
 
     @staticmethod
     def add_cli_args(parser: argparse.ArgumentParser) -> argparse.ArgumentParser:
@@ -22,7 +58,14 @@ class STTArgs:
             required=False,
             default="0",
             type=str,
-            help='Device ID for your GPU. Just pass the device number when using CUDA, or "mps" for Macs with Apple Silicon. (default: "0")',
+            help='Device ID for your GPU. Just pass the device number when using CUDA, "mps" for Macs with Apple Silicon, or "cpu". Comma-separated for several GPUs, e.g. "0,1,2,3". (default: "0")',
+        )
+        parser.add_argument(
+            "--replicas-per-device",
+            required=False,
+            default=1,
+            type=int,
+            help="Number of replicas sharing the model weights on each device. (default: 1)",
         )
         parser.add_argument(
             "--model-name",
@@ -36,7 +79,14 @@ class STTArgs:
             required=False,
             type=int,
             default=24,
-            help="Number of parallel batches you want to compute. Reduce if you face OOMs. (default: 24)",
+            help="Number of parallel batches you want to compute. Batches that run out of memory are split and retried, and the batch size is lowered until memory allows it again. (default: 24)",
+        )
+        parser.add_argument(
+            "--batch-size-max",
+            required=False,
+            type=int,
+            default=None,
+            help="Let the batch size grow up to this while the device has memory to spare. (default: --batch-size)",
         )
         parser.add_argument(
             "--chunk-length-s",
@@ -52,6 +102,82 @@ class STTArgs:
             default=False,
             help="Use Flash Attention 2. Read the FAQs to see how to install FA2 correctly. (default: False)",
         )
+        parser.add_argument(
+            "--vad",
+            required=False,
+            action="store_true",
+            help="Drop non-speech audio with voice activity detection and pack speech into chunks. (default: False)",
+        )
+        parser.add_argument(
+            "--vad-threshold-db",
+            required=False,
+            type=float,
+            default=-45,
+            help="Minimum loudness (in dBFS) of speech for voice activity detection. (default: -45)",
+        )
+        parser.add_argument(
+            "--dtype",
+            required=False,
+            type=str,
+            default="auto",
+            choices=["auto", "fp16", "bf16", "fp32", "int8"],
+            help="Weights and activations type. auto is fp16 on GPUs, bf16 on CPUs that support it and fp32 otherwise. int8 quantizes the linear layers dynamically, CPU only. (default: auto)",
+        )
+        parser.add_argument(
+            "--threads",
+            required=False,
+            type=int,
+            default=0,
+            help="Intra-op threads of PyTorch, 0 for its default or the number of --cpu-cores. (default: 0)",
+        )
+        parser.add_argument(
+            "--interop-threads",
+            required=False,
+            type=int,
+            default=0,
+            help="Inter-op threads of PyTorch, 0 for its default. (default: 0)",
+        )
+        parser.add_argument(
+            "--cpu-cores",
+            required=False,
+            type=str,
+            default=None,
+            help='Pin the process to these cores, e.g. "0-7". With --workers, one set per worker separated by ";", e.g. "0-7;8-15". Linux only. (default: None)',
+        )
+        parser.add_argument(
+            "--assistant-model",
+            required=False,
+            type=str,
+            default=None,
+            help="Small model sharing the tokenizer (e.g. distil-whisper/distil-large-v3) drafting tokens for speculative decoding, only used for greedy batches of one chunk. (default: None)",
+        )
+        parser.add_argument(
+            "--warmup",
+            required=False,
+            type=str,
+            default="1,max",
+            help='Batch sizes run on synthetic audio once loaded, before serving, comma-separated, "max" for --batch-size, "all" for every batch bucket of --compile, "" to skip. (default: "1,max")',
+        )
+        parser.add_argument(
+            "--compile",
+            required=False,
+            action="store_true",
+            help="Decode with a static KV cache and torch.compile the encoder and decoder, batches are padded to power-of-two buckets so that graphs are reused. (default: False)",
+        )
+        parser.add_argument(
+            "--compile-cache-dir",
+            required=False,
+            type=str,
+            default=None,
+            help="Directory keeping the compiled graphs of --compile between restarts. (default: None)",
+        )
+        parser.add_argument(
+            "--detect-language-windows",
+            required=False,
+            type=int,
+            default=0,
+            help="Detect the language of files sent without one on their first N windows only, weighted by speech, then decode all of them in it. 0 lets Whisper detect it in every window. (default: 0)",
+        )
         return parser
 
     @classmethod
@@ -63,30 +189,520 @@ class STTArgs:
         return engine_args
 
 
+# Keys of model inputs that are not for the model, handed over to the outputs as they are
+PASSTHROUGH = ("spans", "samples", "language", "extra")
+
+# File of `--compile-cache-dir` holding the compiled graphs
+COMPILE_ARTIFACTS = "compiled.bin"
+
+# `GenerateOptions` whose pipeline params a model keeps
+PARAMS_CACHED = 64
+
+
+@dataclasses.dataclass(frozen=True)
+class GenerateOptions:
+    r"""
+    Decoding options of one request. Chunks sharing the same options can be batched together.
+    """
+
+    timestamp: Literal["word"] | bool = True
+    task: Literal["transcribe", "translate"] = "transcribe"
+    language: str | None = None
+    prompt: str | None = None
+    temperature: float = 0
+    num_beams: int = 1
+    extra_decodes: tuple["GenerateOptions", ...] = ()  # Decoded too from the same encoder pass, *e.g.* a translation
+
+
 class STT:
     def __init__(self, args: STTArgs) -> None:
         self.model_name = args.model_name
+        self.device = args.device_id
         self.batch_size = args.batch_size
         self.chunk_length_s = args.chunk_length_s
+        self.language_windows = args.detect_language_windows
+        self.vad = args.vad
+        self.vad_threshold_db = args.vad_threshold_db
+        self.dtype = resolve_dtype(args.dtype, args.device_id)
+        self.buckets = batch_buckets(max(args.batch_size, args.batch_size_max or 0)) if args.compile else None
+        self.sizer = BatchSizer(args.batch_size, args.batch_size_max, sizes=self.buckets)  # Shared by replicas
+        self.compile_cache_dir = args.compile_cache_dir
+        self.params: Dict[GenerateOptions, tuple[dict, dict]] = {}  # Of `pipeline_params`, shared by replicas
+        self.params_lock = threading.Lock()
+        configure_threads(args.threads, args.interop_threads, args.cpu_cores)
+        if args.compile and args.assistant_model:
+            raise ValueError("Assisted generation does not support the static KV cache of --compile")
+        if args.compile and args.device_id == "mps":
+            raise ValueError("--compile runs on CUDA and CPU only")
 
         self.pipe = pipeline(
             "automatic-speech-recognition",
             model=args.model_name,
-            torch_dtype=torch.float16,
-            device="mps" if args.device_id == "mps" else f"cuda:{args.device_id}",
+            torch_dtype=DTYPES[self.dtype],
+            device=torch_device(args.device_id),
             model_kwargs=(
                 {"attn_implementation": "flash_attention_2"}
                 if args.flash
                 else {"attn_implementation": "sdpa"}
             ),
         )
+        if self.dtype == "int8":
+            torch.ao.quantization.quantize_dynamic(
+                self.pipe.model, {torch.nn.Linear}, dtype=torch.qint8, inplace=True
+            )
+        self.collate = pad_collate_fn(self.pipe.tokenizer, self.pipe.feature_extractor)
+        self.sampling_rate: int = self.pipe.feature_extractor.sampling_rate  # type: ignore
+
+        # Splits the forward pass into encoder and decoder time, per thread as replicas share the model
+        self.timing = threading.local()
+        encoder = self.pipe.model.get_encoder()
+        encoder.register_forward_pre_hook(self._encoder_start)
+        encoder.register_forward_hook(self._encoder_end)
+
+        self.assistant = None
+        if args.assistant_model:
+            self.assistant = AutoModelForSpeechSeq2Seq.from_pretrained(
+                args.assistant_model,
+                torch_dtype=DTYPES[self.dtype],
+                attn_implementation="sdpa",
+            ).to(torch_device(args.device_id))
+            if self.dtype == "int8":
+                torch.ao.quantization.quantize_dynamic(
+                    self.assistant, {torch.nn.Linear}, dtype=torch.qint8, inplace=True
+                )
+            self.assistant.get_decoder().register_forward_hook(self._drafted)
+
+        if args.compile:
+            self._compile()
 
         if args.device_id == "mps":
             torch.mps.empty_cache()
 
+    def _compile(self) -> None:
+        r"""
+        Static KV cache, and encoder and decoder compiled for static shapes: one graph per batch bucket.
+        CUDA graphs on GPUs, to cut the launch overhead of the decoding loop.
+        """
+
+        import torch._dynamo
+        import torch._inductor.config
+
+        if self.compile_cache_dir:
+            os.makedirs(self.compile_cache_dir, exist_ok=True)
+            os.environ["TORCHINDUCTOR_CACHE_DIR"] = self.compile_cache_dir
+            torch._inductor.config.fx_graph_cache = True
+            path = os.path.join(self.compile_cache_dir, COMPILE_ARTIFACTS)
+            if hasattr(torch.compiler, "load_cache_artifacts") and os.path.exists(path):
+                with open(path, "rb") as f:
+                    torch.compiler.load_cache_artifacts(f.read())
+        # Graphs per bucket, for each of encoder, first decoding step and next steps, and timestamp kind
+        limit = 8 * len(self.buckets)  # type: ignore
+        torch._dynamo.config.cache_size_limit = max(torch._dynamo.config.cache_size_limit, limit)
+
+        model = self.pipe.model
+        model.generation_config.cache_implementation = "static"
+        mode = "default" if self.device == "cpu" else "reduce-overhead"
+        encoder = model.get_encoder()
+        encoder.forward = torch.compile(encoder.forward, mode=mode, dynamic=False)  # Its hooks still run
+        model.forward = torch.compile(model.forward, mode=mode, dynamic=False)
+
+    def save_compile_cache(self) -> None:
+        r"""
+        Write the graphs compiled so far to `--compile-cache-dir`, for the next start to load them.
+        """
+
+        if not (self.buckets and self.compile_cache_dir and hasattr(torch.compiler, "save_cache_artifacts")):
+            return  # Older PyTorch only keeps the inductor cache of `TORCHINDUCTOR_CACHE_DIR`
+        artifacts = torch.compiler.save_cache_artifacts()
+        if artifacts is None:
+            return
+        path = os.path.join(self.compile_cache_dir, COMPILE_ARTIFACTS)
+        temp = f"{path}.{os.getpid()}"  # Replicas and workers may save at the same time
+        with open(temp, "wb") as f:
+            f.write(artifacts[0])
+        os.replace(temp, path)
+
+    def _encoder_start(self, module, args) -> None:
+        self.timing.encoder_start = time.perf_counter()
+
+    def _encoder_end(self, module, args, output) -> None:
+        _synchronize(self.device)  # The decoder waits for it anyway
+        self.timing.encoder = time.perf_counter() - self.timing.encoder_start
+
+    def _drafted(self, module, args, output) -> None:
+        self.timing.drafted = getattr(self.timing, "drafted", 0) + 1  # One draft token per assistant step
+
+    def pipeline_params(self, options: GenerateOptions) -> tuple[dict, dict]:
+        r"""
+        Turn `GenerateOptions` into the forward and postprocess params of the pipeline, cached for the
+        `PARAMS_CACHED` options used last.
+        """
+
+        with self.params_lock:
+            params = self.params.pop(options, None)
+            if params is None:
+                params = self._pipeline_params(options)
+                if len(self.params) >= PARAMS_CACHED:
+                    del self.params[next(iter(self.params))]  # Least recently used
+            self.params[options] = params  # Most recently used last
+            return params
+
+    def _pipeline_params(self, options: GenerateOptions) -> tuple[dict, dict]:
+        generate_kwargs = {
+            "task": options.task,
+            "language": options.language,
+            "prompt_ids": (
+                self.pipe.tokenizer.get_prompt_ids(options.prompt, return_tensors="pt")  # type: ignore
+                if options.prompt
+                else None
+            ),
+            "do_sample": True if options.temperature > 0 else False,
+            "temperature": options.temperature if options.temperature > 0 else 1,
+            "num_beams": options.num_beams,
+        }
+        if self.model_name.split(".")[-1] == "en":
+            generate_kwargs.pop("task")
+
+        _, forward_params, postprocess_params = self.pipe._sanitize_parameters(  # type: ignore
+            generate_kwargs=generate_kwargs,
+            return_timestamps="word" if options.timestamp == "word" else True,
+        )
+        return forward_params, postprocess_params
+
+    def preprocess(self, file: str | bytes | np.ndarray) -> Iterator[dict]:
+        r"""
+        Decode the audio and yield its `chunk_length_s` windows as model inputs, as soon as each is decoded.
+        Decoding runs a few seconds ahead in the background, so memory stays bounded however long the file is.
+        """
+
+        sampling_rate = self.sampling_rate
+        chunk_len, stride = self._window_shape()
+
+        decoded = 0
+
+        def count(blocks: Iterator[np.ndarray]) -> Iterator[np.ndarray]:
+            nonlocal decoded
+            for block in blocks:
+                decoded += len(block)
+                yield block
+            AUDIO_SECONDS.inc(decoded / sampling_rate)
+
+        # The last window also tells how long the audio was
+        blocks = count(prefetch(decode_stream(file, sampling_rate), size=8))
+        if not self.vad:
+            for window, window_stride, is_last in chunk_windows(blocks, chunk_len, stride, stride):
+                yield self._features(
+                    window, window_stride, is_last, samples=decoded if is_last else None
+                )
+            return
+
+        # Windows of packed speech do not overlap, each keeps the spans it came from in the original audio
+        vad = EnergyVAD(threshold_db=self.vad_threshold_db)
+        segments = speech_segments(blocks, sampling_rate, vad, max_segment_s=self.chunk_length_s)
+        previous = None
+        for window, spans in pack_windows(segments, chunk_len, gap=sampling_rate // 10):
+            if previous is not None:
+                yield self._features(
+                    previous[0], (len(previous[0]), 0, 0), False, spans=previous[1], samples=None
+                )
+            previous = (window, spans)
+        if previous is not None:
+            yield self._features(
+                previous[0], (len(previous[0]), 0, 0), True, spans=previous[1], samples=decoded
+            )
+
+    def _window_shape(self) -> tuple[int, int]:
+        # Samples of a window and of each of its strides, aligned to the model inputs
+        align_to = getattr(self.pipe.model.config, "inputs_to_logits_ratio", 1)
+        chunk_len = int(round(self.chunk_length_s * self.sampling_rate / align_to) * align_to)
+        stride = int(round(self.chunk_length_s / 6 * self.sampling_rate / align_to) * align_to)
+        return chunk_len, stride
+
+    def warmup(self, batch_sizes: list[int]) -> None:
+        r"""
+        Run batches of synthetic audio through the model, so that the first requests do not pay for kernel
+        selection and allocator growth. Each batch ends with a short last window, as the batches of a file do,
+        and is decoded with segment then word timestamps, which do not run the same attention.
+        """
+
+        chunk_len, stride = self._window_shape()
+        noise = np.random.default_rng(0).normal(0, 1e-3, chunk_len).astype(np.float32)
+        full = self._features(noise, (chunk_len, stride, stride), False)
+        last = self._features(noise[: 2 * stride], (2 * stride, stride, 0), True)
+        for batch_size in batch_sizes:
+            for options in (GenerateOptions(), GenerateOptions(timestamp="word")):
+                self.forward([full] * (batch_size - 1) + [last], options)
+        _synchronize(self.device)
+        self.save_compile_cache()
+
+    def detect_language(self, items: list[dict]) -> Dict[str, float]:
+        r"""
+        Probability of each language (ISO 639-1 code) over the windows `items`, from the encoder and the first
+        decoder step only. Windows are weighted by their probability of speech, as told by the no-speech token.
+        """
+
+        if self.model_name.split(".")[-1] == "en":
+            return {"en": 1.0}
+        model = self.pipe.model
+        config = model.generation_config
+        batch = self.collate([{k: v for k, v in item.items() if k not in PASSTHROUGH} for item in items])
+        features = batch["input_features"].to(model.device, dtype=model.dtype)
+        with torch.inference_mode():
+            encoder_outputs = model.get_encoder()(features)
+            start = torch.full((len(items), 1), config.decoder_start_token_id, device=model.device)
+            logits = model(encoder_outputs=encoder_outputs, decoder_input_ids=start).logits[:, -1]
+        probs = logits.float().softmax(-1).cpu()
+
+        codes = [token[2:-2] for token in config.lang_to_id]  # "<|en|>"
+        languages = probs[:, list(config.lang_to_id.values())]
+        languages /= languages.sum(-1, keepdim=True)
+        speech = 1 - probs[:, config.no_timestamps_token_id - 1]  # <|nospeech|> precedes <|notimestamps|>
+        if speech.sum() < 1e-3:  # Silence all along, every window counts the same
+            speech = torch.ones_like(speech)
+        mean = (languages * speech[:, None]).sum(0) / speech.sum()
+        return dict(sorted(zip(codes, mean.tolist()), key=lambda pair: -pair[1]))
+
+    def pin_language(self, items: list[dict], options: GenerateOptions) -> GenerateOptions:
+        r"""
+        `options` with the language detected on `items`, the first windows of a file, which are tagged with it.
+        """
+
+        if self.model_name.split(".")[-1] == "en":  # Would reject a language
+            return options
+        probs = self.detect_language(items)
+        language = max(probs, key=probs.__getitem__)
+        for item in items:
+            item["language"] = language
+        return with_language(options, language)
+
+    def identify_language(self, file: str | bytes | np.ndarray, windows: int = 3) -> Dict[str, float]:
+        r"""
+        `detect_language` on the first `windows` windows of `file`, which is only decoded that far.
+        """
+
+        items = self.preprocess(file)
+        try:
+            return self.detect_language(list(itertools.islice(items, windows)))
+        finally:
+            items.close()  # type: ignore
+
+    def window_item(self, window: np.ndarray) -> dict:
+        r"""
+        The model input of one standalone window of samples, *e.g.* the sliding window of a live stream.
+        """
+
+        return self._features(window, (len(window), 0, 0), True)
+
+    def _features(
+        self, window: np.ndarray, stride: tuple[int, int, int], is_last: bool, **extra
+    ) -> dict:
+        start = time.perf_counter()
+        processed = self.pipe.feature_extractor(  # type: ignore
+            window, sampling_rate=self.sampling_rate, return_tensors="pt"
+        )
+        if self.pipe.torch_dtype is not None:
+            processed = processed.to(dtype=self.pipe.torch_dtype)
+        STAGE_SECONDS.observe(time.perf_counter() - start, "features")
+        return {"is_last": is_last, "stride": stride, **processed, **extra}
+
+    @staticmethod
+    def batch_shape(options: GenerateOptions) -> str:
+        # Batches of one shape take the same memory per window
+        timestamps = "word" if options.timestamp == "word" else "segment"
+        return f"{timestamps},beams={options.num_beams},decodes={1 + len(options.extra_decodes)}"
+
+    def batch_limit(self, options: GenerateOptions) -> int:
+        r"""
+        The effective batch size for `options`, learned from out-of-memory errors, see `BatchSizer`.
+        """
+
+        return self.sizer.limit(self.batch_shape(options))
+
+    def forward(self, items: list[dict], options: GenerateOptions) -> list[dict]:
+        r"""
+        Run one batched forward pass over `items`, which may come from different requests.
+        Returns one output per item, in the same order. Batches larger than `batch_limit` run in parts,
+        and a batch that runs out of memory is split in halves and retried.
+        """
+
+        shape = self.batch_shape(options)
+        limit = self.sizer.limit(shape)
+        BATCH_LIMIT.set(limit, self.model_name, self.device, shape)
+        if len(items) > limit:
+            return [
+                output
+                for start in range(0, len(items), limit)
+                for output in self.forward(items[start : start + limit], options)
+            ]
+        try:
+            outputs = self._forward(items, options)
+        except Exception as error:
+            if len(items) == 1 or not is_out_of_memory(error):
+                raise
+        else:
+            if (probe := self.sizer.succeeded(shape, len(items), self._memory_free)) is not None:
+                logger.info(f"Probing batches of {probe} on {self.device} ({shape})")
+            return outputs
+
+        # Out of the handler, so that the tensors of the failed pass can be freed
+        OUT_OF_MEMORY.inc(1, self.model_name, self.device)
+        limit = self.sizer.failed(shape, len(items))
+        logger.warning(f"Out of memory on {self.device} with {len(items)} windows ({shape}), limit now {limit}")
+        _empty_cache(self.device)
+        half = (len(items) + 1) // 2
+        return self.forward(items[:half], options) + self.forward(items[half:], options)
+
+    def _memory_free(self) -> bool:
+        # Room to probe larger batches: a quarter of the device, counting what the allocator caches unused
+        if self.device in ("cpu", "mps"):
+            return True
+        device = torch_device(self.device)
+        free, total = torch.cuda.mem_get_info(device)
+        cached = torch.cuda.memory_reserved(device) - torch.cuda.memory_allocated(device)
+        return free + cached >= total / 4
+
+    def _forward(self, items: list[dict], options: GenerateOptions) -> list[dict]:
+        # With `extra_decodes`, the encoder runs once and its hidden states are decoded once per options,
+        # each output holding the ones of the extra decodes in `extra`
+
+        forward_params, _ = self.pipeline_params(options)
+        counter = None
+        if self.assistant is not None:
+            reason = self.speculation_fallback(items, options)
+            if reason is None:
+                counter = _AcceptanceCounter(self.timing)
+                forward_params = _with_generate_kwargs(
+                    forward_params,
+                    assistant_model=self.assistant,
+                    stopping_criteria=StoppingCriteriaList([counter]),
+                )
+            else:
+                SPECULATIVE_FALLBACKS.inc(1, reason)
+
+        inputs = [{k: v for k, v in item.items() if k not in PASSTHROUGH} for item in items]
+        if self.buckets:  # Padded with copies of the last input, their outputs are dropped below
+            size = next((bucket for bucket in self.buckets if bucket >= len(inputs)), len(inputs))
+            inputs += [inputs[-1]] * (size - len(inputs))
+        batch = self.collate(inputs)
+        self.timing.encoder = 0.0
+        start = time.perf_counter()
+        if options.extra_decodes:
+            model = self.pipe.model
+            with torch.inference_mode():
+                features = batch["input_features"].to(model.device, dtype=model.dtype)
+                encoder_outputs = model.get_encoder()(features)
+            decodes = [
+                self.pipe.forward(
+                    dict(batch),
+                    **_with_generate_kwargs(self.pipeline_params(o)[0], encoder_outputs=encoder_outputs),
+                )
+                for o in (options, *options.extra_decodes)
+            ]
+        else:
+            decodes = [self.pipe.forward(batch, **forward_params)]
+        elapsed = time.perf_counter() - start
+        if counter is not None:
+            SPECULATIVE_TOKENS.inc(counter.drafted, "drafted")
+            SPECULATIVE_TOKENS.inc(counter.accepted, "accepted")
+        STAGE_SECONDS.observe(self.timing.encoder, "encoder")
+        STAGE_SECONDS.observe(elapsed - self.timing.encoder, "decoder")
+
+        results = [
+            [
+                {
+                    **{
+                        k: (v[i].unsqueeze(0) if isinstance(v, torch.Tensor) else v[i])
+                        for k, v in outputs.items()
+                        if v is not None
+                    },
+                    **{k: item[k] for k in PASSTHROUGH if k in item},
+                }
+                for i, item in enumerate(items)
+            ]
+            for outputs in decodes
+        ]
+        if options.extra_decodes:
+            for i, output in enumerate(results[0]):
+                output["extra"] = [extra[i] for extra in results[1:]]
+        return results[0]
+
+    @staticmethod
+    def speculation_fallback(items: list[dict], options: GenerateOptions) -> str | None:
+        r"""
+        Why `items` are not worth speculative decoding, `None` if they are. Drafting only pays off for one
+        sequence decoded greedily: batches already keep the GPU busy, and samples are rarely accepted.
+        """
+
+        if options.extra_decodes:  # The decodes share one encoder pass, the assistant would need its own
+            return "multitask"
+        if len(items) > 1:
+            return "batch"
+        if options.temperature > 0 or options.num_beams > 1:
+            return "sampling"
+        if options.timestamp == "word":  # Needs the cross attentions of every step
+            return "word_timestamps"
+        return None
+
+    def postprocess(self, outputs: list[dict], options: GenerateOptions) -> dict:
+        r"""
+        Merge the outputs of all the windows of one file, in order.
+        """
+
+        _, postprocess_params = self.pipeline_params(options)
+        if not outputs:  # No speech at all
+            result = {"text": "", "chunks": []}
+            if options.extra_decodes:
+                result["extra"] = [{"text": "", "chunks": []} for _ in options.extra_decodes]
+            return result
+        start = time.perf_counter()
+        samples = outputs[-1].get("samples")
+        language = outputs[0].get("language")
+        if "spans" not in outputs[0]:
+            stripped = [{k: v for k, v in o.items() if k not in PASSTHROUGH} for o in outputs]
+            result = self.pipe.postprocess(stripped, **postprocess_params)  # type: ignore
+        else:
+            result = self._postprocess_speech(outputs, postprocess_params)
+        STAGE_SECONDS.observe(time.perf_counter() - start, "merge")
+        if samples is not None:
+            result["duration"] = samples / self.sampling_rate
+        if language is not None:  # Detected once for the whole file
+            result["language"] = language
+        if options.extra_decodes:
+            result["extra"] = [
+                self.postprocess([output["extra"][j] for output in outputs], extra)
+                for j, extra in enumerate(options.extra_decodes)
+            ]
+        return result
+
+    def _postprocess_speech(self, outputs: list[dict], postprocess_params: dict) -> dict:
+        # Speech windows do not overlap, decode them one by one and map them back to the original audio
+        texts, chunks, speech = [], [], 0
+        for output in outputs:
+            spans = output["spans"]
+            output = {k: v for k, v in output.items() if k not in PASSTHROUGH}
+            result = self.pipe.postprocess([output], **postprocess_params)
+            texts.append(result["text"])  # type: ignore
+            for chunk in result["chunks"]:  # type: ignore
+                begin, end = chunk["timestamp"]
+                chunks.append(
+                    {
+                        **chunk,
+                        "timestamp": (
+                            remap(begin, spans, self.sampling_rate),
+                            remap(end, spans, self.sampling_rate),
+                        ),
+                    }
+                )
+            speech += sum(length for _, _, length in spans)
+
+        result = {"text": "".join(texts), "chunks": chunks}
+        if (decoded := outputs[-1].get("samples")) is not None:
+            result["skipped_seconds"] = (decoded - speech) / self.sampling_rate
+        return result
+
     def generate(
         self,
-        file: str | bytes,
+        file: str | bytes | np.ndarray,
         timestamp: Literal["word"] | bool = True,
         task: Literal["transcribe", "translate"] = "transcribe",
         language: str | None = None,
@@ -105,25 +721,160 @@ class STT:
                     `"".join(chunk["text"] for chunk in output["chunks"])`.
         """
 
-        generate_kwargs = {
-            "task": task,
-            "language": language,
-            "prompt_ids": (
-                self.pipe.tokenizer.get_prompt_ids(prompt, return_tensors="pt")  # type: ignore
-                if prompt
-                else None
-            ),
-            "do_sample": True if temperature > 0 else False,
-            "temperature": temperature if temperature > 0 else 1,
-            "num_beams": num_beams,
-        }
-        if self.model_name.split(".")[-1] == "en":
-            generate_kwargs.pop("task")
+        options = GenerateOptions(timestamp, task, language, prompt, temperature, num_beams)
+        start = time.perf_counter()
+        items = self.preprocess(file)
+        if self.language_windows and options.language is None:
+            first = list(itertools.islice(items, self.language_windows))
+            if first:
+                options = self.pin_language(first, options)
+            items = itertools.chain(first, items)
+        outputs, batch = [], []
+        for item in items:
+            batch.append(item)
+            if len(batch) == self.batch_size:
+                outputs += self.forward(batch, options)
+                batch = []
+        if batch:
+            outputs += self.forward(batch, options)
+        result = self.postprocess(outputs, options)
+        if result.get("duration"):
+            REAL_TIME_FACTOR.observe((time.perf_counter() - start) / result["duration"])
+        return result
 
-        return self.pipe(
-            file,
-            batch_size=self.batch_size,
-            chunk_length_s=self.chunk_length_s,
-            generate_kwargs=generate_kwargs,
-            return_timestamps="word" if timestamp == "word" else True,
-        )  # type: ignore
+
+class _AcceptanceCounter(StoppingCriteria):
+    r"""
+    Never stops generation, counts the draft tokens the main model accepts. It is checked once per step of
+    the main model, and the assistant has drafted one token per forward pass of its decoder since the last one.
+    """
+
+    def __init__(self, timing: threading.local) -> None:
+        self.timing = timing
+        self.length: int | None = None
+        self.last_drafted = 0
+        self.drafted = 0
+        self.accepted = 0
+
+    def __call__(self, input_ids: torch.Tensor, scores: torch.Tensor, **kwargs) -> torch.Tensor:
+        drafted = getattr(self.timing, "drafted", 0)
+        if self.length is not None:  # A step adds its accepted drafts, plus one token of the main model
+            self.drafted += drafted - self.last_drafted
+            self.accepted += max(input_ids.shape[-1] - self.length - 1, 0)
+        self.length, self.last_drafted = input_ids.shape[-1], drafted
+        return torch.zeros(input_ids.shape[0], dtype=torch.bool, device=input_ids.device)
+
+
+def with_language(options: GenerateOptions, language: str) -> GenerateOptions:
+    r"""
+    `options` decoded in `language`, and so are its extra decodes unless they force their own.
+    """
+
+    extra_decodes = tuple(
+        extra if extra.language else dataclasses.replace(extra, language=language)
+        for extra in options.extra_decodes
+    )
+    return dataclasses.replace(options, language=language, extra_decodes=extra_decodes)
+
+
+def warmup_batch_sizes(spec: str, batch_size: int) -> list[int]:
+    r"""
+    Batch sizes of `--warmup` (*e.g.* "1,8,max" or "all"), in order and at most `batch_size`.
+    """
+
+    sizes = set()
+    for part in spec.split(","):
+        part = part.strip()
+        if part == "max":
+            sizes.add(batch_size)
+        elif part == "all":
+            sizes.update(batch_buckets(batch_size))
+        elif part:
+            sizes.add(int(part))
+    return sorted({min(size, batch_size) for size in sizes if size > 0})
+
+
+def batch_buckets(batch_size: int) -> list[int]:
+    r"""
+    Sizes batches are padded to with `--compile`: powers of two, and `batch_size` itself.
+    """
+
+    return sorted({1 << i for i in range(batch_size.bit_length()) if 1 << i < batch_size} | {batch_size})
+
+
+def _with_generate_kwargs(forward_params: dict, **kwargs) -> dict:
+    if "generate_kwargs" in forward_params:  # Older pipelines nest them
+        return {**forward_params, "generate_kwargs": {**forward_params["generate_kwargs"], **kwargs}}
+    return {**forward_params, **kwargs}
+
+
+# Weights type of each `--dtype`, int8 is quantized from fp32 once loaded
+DTYPES = {"fp16": torch.float16, "bf16": torch.bfloat16, "fp32": torch.float32, "int8": torch.float32}
+
+
+def torch_device(device_id: str) -> str:
+    return device_id if device_id in ("cpu", "mps") else f"cuda:{device_id}"
+
+
+def resolve_dtype(dtype: str, device_id: str) -> str:
+    if dtype == "auto":
+        if device_id != "cpu":
+            return "fp16"
+        return "bf16" if torch.backends.mkldnn.is_available() and _cpu_supports_bf16() else "fp32"
+    if dtype == "int8" and device_id != "cpu":
+        raise ValueError("int8 dynamic quantization only runs on CPU")
+    return dtype
+
+
+def _cpu_supports_bf16() -> bool:
+    try:
+        return torch.ops.mkldnn._is_mkldnn_bf16_supported()
+    except (AttributeError, RuntimeError):
+        return False
+
+
+def configure_threads(threads: int, interop_threads: int, cpu_cores: str | None) -> None:
+    r"""
+    Pin this process to `cpu_cores` (*e.g.* "0-7,16-23") and size the thread pools of PyTorch, for all its replicas.
+    """
+
+    if cpu_cores:
+        cores = set()
+        for part in cpu_cores.replace(";", ",").split(","):  # Several sets are only split up by `WorkerPool`
+            first, _, last = part.partition("-")
+            cores.update(range(int(first), int(last or first) + 1))
+        os.sched_setaffinity(0, cores)
+        threads = threads or len(cores)
+    if threads:
+        torch.set_num_threads(threads)
+    if interop_threads:
+        try:
+            torch.set_num_interop_threads(interop_threads)
+        except RuntimeError:  # Can only be set once, before any inter-op work
+            pass
+
+
+def _empty_cache(device: str) -> None:
+    if device == "mps":
+        torch.mps.empty_cache()
+    elif device != "cpu":
+        torch.cuda.empty_cache()
+
+
+def _synchronize(device: str) -> None:
+    if device == "mps":
+        torch.mps.synchronize()
+    elif device != "cpu":
+        torch.cuda.synchronize(f"cuda:{device}")
+
+
+def _gpu_memory() -> list[tuple[tuple, float]]:
+    if not torch.cuda.is_initialized():  # Never initialize CUDA just to be scraped
+        return []
+    return [
+        ((f"cuda:{index}",), torch.cuda.max_memory_allocated(index))
+        for index in range(torch.cuda.device_count())
+    ]
+
+
+GPU_MEMORY_PEAK.collectors.append(_gpu_memory)
@@ -0,0 +1,498 @@
+import argparse
+import asyncio
+import dataclasses
+import json
+import logging
+import os
+import time
+import uuid
+from typing import Awaitable, Callable, Dict, Iterable, List
+
+from audio import probe_duration
+from inference import GenerateOptions, STTArgs
+from subtitles import render_subtitles, verbose_json
+from utils import ISO_639_1
+
+logger = logging.getLogger(__name__)
+
+RESPONSE_FORMATS = ("json", "text", "srt", "vtt", "verbose_json")
+
+
+@dataclasses.dataclass
+class JobItem:
+    id: str
+    source: str  # Path of a file on disk, or URL
+    url: bool
+    model: str = "whisper-1"
+    options: GenerateOptions = GenerateOptions()
+    response_format: str = "json"
+    duration: float | None = None  # Seconds, probed before running, unknown for URLs
+    status: str = "pending"  # pending/running/completed/failed
+    error: str | None = None
+
+    @classmethod
+    def parse(cls, index: int, line: dict, input_dir: str | None, confine: bool = True) -> "JobItem":
+        r"""
+        One line of a manifest, *e.g.* `{"id": "a", "file": "a.mp3", "language": "en", "response_format": "srt"}`.
+        Files are relative to `input_dir`, and must be inside it if `confine`. No `input_dir`, no files.
+        """
+
+        if bool(line.get("file")) == bool(line.get("url")):
+            raise ValueError(f"Line {index + 1}: needs either 'file' or 'url'")
+        if line.get("file"):
+            if input_dir is None:
+                raise ValueError(f"Line {index + 1}: files on disk are not allowed, use 'url'")
+            root = os.path.realpath(input_dir)
+            source = os.path.realpath(os.path.join(root, line["file"]))
+            if confine and os.path.commonpath([root, source]) != root:
+                raise ValueError(f"Line {index + 1}: '{line['file']}' is outside of the input directory")
+        else:
+            source = line["url"]
+
+        response_format = line.get("response_format", "json")
+        if response_format not in RESPONSE_FORMATS:
+            raise ValueError(f"Line {index + 1}: response format '{response_format}' is not supported")
+        task = line.get("task", "transcribe")
+        if task not in ("transcribe", "translate"):
+            raise ValueError(f"Line {index + 1}: task '{task}' is not supported")
+        temperature = float(line.get("temperature", 0))
+        if not (temperature >= 0 and temperature <= 1):
+            raise ValueError(f"Line {index + 1}: temperature needs to be >=0 and <=1")
+        language = line.get("language")
+        if language and task == "transcribe":
+            language = ISO_639_1.get(language.lower(), language.lower())
+        else:
+            language = None
+        timestamp = "word" if "word" in (line.get("timestamp_granularities") or []) else True
+
+        return cls(
+            str(line.get("id", index)),
+            source,
+            bool(line.get("url")),
+            line.get("model", "whisper-1").lower(),
+            GenerateOptions(timestamp, task, language, line.get("prompt"), temperature),
+            response_format,
+        )
+
+    def manifest(self) -> dict:
+        return {
+            "id": self.id,
+            "url" if self.url else "file": self.source,
+            "model": self.model,
+            "task": self.options.task,
+            "language": self.options.language,
+            "prompt": self.options.prompt,
+            "temperature": self.options.temperature,
+            "timestamp_granularities": ["word"] if self.options.timestamp == "word" else ["segment"],
+            "response_format": self.response_format,
+        }
+
+
+Transcribe = Callable[[JobItem], Awaitable[dict]]
+
+
+class BatchJob:
+    r"""
+    Transcription of every item of a manifest, kept in `directory`:
+    - `manifest.jsonl`: the items, validated
+    - `results.jsonl`: one line per finished item, appended and synced as each finishes, so that an
+      interrupted job resumes with the items that did not complete. The lines of items that failed and were
+      retried are dropped once the run ends, and when the job is resumed
+    - `job.json`: the state of the job, and `status.json`: a snapshot of every item, refreshed while running
+
+    Items are sorted so that the ones running together share their model and options, and have similar
+    durations, longest first: their chunks fill the same batches until the end of the job.
+    """
+
+    def __init__(self, directory: str) -> None:
+        self.directory = directory
+        with open(self._path("job.json")) as f:
+            self.state = json.load(f)
+        self.id: str = self.state["id"]
+        self.items: Dict[str, JobItem] = {}
+        with open(self._path("manifest.jsonl")) as f:
+            for index, line in enumerate(f):
+                item = JobItem.parse(index, json.loads(line), "/", confine=False)  # Validated on creation
+                self.items[item.id] = item
+        records = list(self._records())
+        for record in records:
+            item = self.items.get(record["id"])
+            if item is not None:
+                item.status, item.error = record["status"], record.get("error")
+                item.duration = record.get("duration", item.duration)
+        if len({record["id"] for record in records}) < len(records):  # Items retried by an interrupted run
+            self._compact()
+        self.cancelled = False
+
+    @classmethod
+    def create(
+        cls,
+        directory: str,
+        lines: Iterable[str],
+        input_dir: str | None,
+        confine: bool = True,
+        job_id: str | None = None,
+        models: Callable[[str], bool] | None = None,
+    ) -> "BatchJob":
+        r"""
+        Validate a JSONL manifest and store it in a new job `directory`. Raises `ValueError` on a bad line,
+        *e.g.* one with a model that `models` does not know.
+        """
+
+        items: Dict[str, JobItem] = {}
+        for index, line in enumerate(lines):
+            if not line.strip():
+                continue
+            try:
+                entry = json.loads(line)
+            except json.JSONDecodeError as e:
+                raise ValueError(f"Line {index + 1}: {e}")
+            item = JobItem.parse(index, entry, input_dir, confine)
+            if item.id in items:
+                raise ValueError(f"Line {index + 1}: duplicate id '{item.id}'")
+            if models is not None and not models(item.model):
+                raise ValueError(f"Line {index + 1}: model '{item.model}' is not supported")
+            items[item.id] = item
+        if not items:
+            raise ValueError("The manifest is empty")
+
+        os.makedirs(directory)
+        with open(os.path.join(directory, "manifest.jsonl"), "w") as f:
+            for item in items.values():
+                f.write(json.dumps(item.manifest()) + "\n")
+        job = {
+            "id": job_id or os.path.basename(os.path.abspath(directory)),
+            "status": "queued",
+            "created_at": int(time.time()),
+            "completed_at": None,
+        }
+        _write_json(os.path.join(directory, "job.json"), job)
+        return cls(directory)
+
+    @property
+    def status(self) -> str:
+        return self.state["status"]
+
+    @property
+    def output(self) -> str:
+        return self._path("results.jsonl")
+
+    def counts(self) -> Dict[str, int]:
+        counts = {"total": len(self.items), "pending": 0, "running": 0, "completed": 0, "failed": 0}
+        for item in self.items.values():
+            counts[item.status] += 1
+        return counts
+
+    def summary(self) -> dict:
+        return {
+            "id": self.id,
+            "object": "batch",
+            "status": self.status,
+            "created_at": self.state["created_at"],
+            "completed_at": self.state["completed_at"],
+            "request_counts": self.counts(),
+        }
+
+    def cancel(self) -> None:
+        r"""
+        Stop starting items, the running ones finish. Completed items are kept.
+        """
+
+        self.cancelled = True
+        if self.status == "queued":
+            self._set_status("cancelled")
+
+    async def run(
+        self,
+        transcribe: Transcribe,
+        concurrency: int = 32,
+        snapshot_interval: float = 10,
+    ) -> None:
+        r"""
+        Run the items not completed yet, `concurrency` at a time so that their chunks fill the batches.
+        """
+
+        loop = asyncio.get_running_loop()
+        self.cancelled = False
+        self._set_status("in_progress")
+        todo = [item for item in self.items.values() if item.status != "completed"]
+        for item in todo:
+            item.status, item.error = "pending", None
+        durations = await asyncio.gather(
+            *(
+                loop.run_in_executor(None, probe_duration, item.source)
+                for item in todo
+                if not item.url and item.duration is None
+            )
+        )
+        for item, duration in zip((i for i in todo if not i.url and i.duration is None), durations):
+            item.duration = duration
+        queue = iter(_pack(todo))
+
+        async def work() -> None:
+            for item in queue:  # Shared by the workers
+                if self.cancelled:
+                    return
+                item.status = "running"
+                try:
+                    output = await transcribe(item)
+                    response = await loop.run_in_executor(None, render, output, item)
+                except Exception as e:
+                    logger.warning(f"Job {self.id}: item '{item.id}' failed: {e}")
+                    item.status, item.error = "failed", f"{type(e).__name__}: {e}"
+                    record = {"id": item.id, "status": "failed", "duration": item.duration, "error": item.error}
+                else:
+                    item.status, item.duration = "completed", output.get("duration", item.duration)
+                    record = {"id": item.id, "status": "completed", "duration": item.duration, "response": response}
+                await loop.run_in_executor(None, self._append, record)
+
+        async def snapshot() -> None:
+            while True:
+                await asyncio.sleep(snapshot_interval)
+                await loop.run_in_executor(None, self.snapshot)
+
+        snapshots = asyncio.create_task(snapshot())
+        try:
+            await asyncio.gather(*(work() for _ in range(concurrency)))
+        finally:
+            snapshots.cancel()
+            for item in self.items.values():
+                if item.status == "running":  # Interrupted
+                    item.status = "pending"
+            if self.cancelled:
+                self._set_status("cancelled")
+            elif all(item.status != "pending" for item in self.items.values()):
+                self._set_status("completed")
+            if todo:
+                await loop.run_in_executor(None, self._compact)  # Retried items were appended again
+            self.snapshot()
+
+    def snapshot(self) -> None:
+        _write_json(
+            self._path("status.json"),
+            {
+                **self.summary(),
+                "items": [
+                    {"id": item.id, "status": item.status, "duration": item.duration, "error": item.error}
+                    for item in self.items.values()
+                ],
+            },
+        )
+
+    def _append(self, record: dict) -> None:
+        with open(self.output, "a") as f:
+            f.write(json.dumps(record) + "\n")
+            f.flush()
+            os.fsync(f.fileno())  # The checkpoint of this item
+
+    def _compact(self) -> None:
+        # Rewrite the results with the last record of each item only
+        records = {record["id"]: record for record in self._records()}
+        temp = f"{self.output}.tmp"
+        with open(temp, "w") as f:
+            for record in records.values():
+                f.write(json.dumps(record) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp, self.output)
+
+    def _records(self) -> Iterable[dict]:
+        if not os.path.exists(self.output):
+            return
+        with open(self.output) as f:
+            for line in f:
+                try:
+                    yield json.loads(line)
+                except json.JSONDecodeError:  # Cut off by a crash
+                    continue
+
+    def _set_status(self, status: str) -> None:
+        self.state["status"] = status
+        if status == "completed":
+            self.state["completed_at"] = int(time.time())
+        _write_json(self._path("job.json"), self.state)
+
+    def _path(self, name: str) -> str:
+        return os.path.join(self.directory, name)
+
+
+class JobManager:
+    r"""
+    The batch jobs of the server, in `root`, run one after the other in the background.
+    Jobs left unfinished by a previous run are resumed.
+    """
+
+    def __init__(
+        self,
+        root: str,
+        transcribe: Transcribe,
+        input_dir: str | None = None,
+        concurrency: int = 32,
+    ) -> None:
+        self.root = root
+        self.transcribe = transcribe
+        self.input_dir = input_dir
+        self.concurrency = concurrency
+        self.jobs: Dict[str, BatchJob] = {}
+        self.queue: asyncio.Queue = asyncio.Queue()
+        self.runner: asyncio.Task | None = None
+
+        os.makedirs(root, exist_ok=True)
+        for name in sorted(os.listdir(root)):
+            if os.path.exists(os.path.join(root, name, "job.json")):
+                job = BatchJob(os.path.join(root, name))
+                self.jobs[job.id] = job
+        unfinished = [job for job in self.jobs.values() if job.status in ("queued", "in_progress")]
+        for job in sorted(unfinished, key=lambda job: job.state["created_at"]):
+            self.queue.put_nowait(job)
+
+    def create(self, lines: Iterable[str], models: Callable[[str], bool]) -> BatchJob:
+        job_id = f"batch_{uuid.uuid4().hex}"
+        job = BatchJob.create(
+            os.path.join(self.root, job_id), lines, self.input_dir, job_id=job_id, models=models
+        )
+        self.jobs[job.id] = job
+        self.queue.put_nowait(job)
+        return job
+
+    def start(self) -> None:
+        self.runner = asyncio.create_task(self._run())
+
+    async def close(self) -> None:
+        if self.runner is not None:
+            self.runner.cancel()
+            await asyncio.gather(self.runner, return_exceptions=True)
+
+    async def _run(self) -> None:
+        while True:
+            job = await self.queue.get()
+            if job.status == "cancelled":
+                continue
+            logger.info(f"Running job {job.id}: {job.counts()}")
+            try:
+                await job.run(self.transcribe, self.concurrency)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception(f"Job {job.id} failed")
+                job._set_status("failed")
+            logger.info(f"Job {job.id} is {job.status}: {job.counts()}")
+
+
+def _pack(items: List[JobItem]) -> List[JobItem]:
+    # Items of the same model and options together, each group longest first, unknown durations last
+    groups: Dict[tuple, List[JobItem]] = {}
+    for item in items:
+        groups.setdefault((item.model, item.options), []).append(item)
+    return [
+        item
+        for group in groups.values()
+        for item in sorted(group, key=lambda i: (i.duration is None, -(i.duration or 0)))
+    ]
+
+
+def render(output: dict, item: JobItem):
+    r"""
+    The response of `item` as the endpoints would send it, `str` for text/srt/vtt.
+    """
+
+    if item.response_format == "json":
+        response = {"text": output["text"], "chunks": output["chunks"]}
+        if output.get("skipped_seconds") is not None:
+            response["skipped_seconds"] = output["skipped_seconds"]
+        return response
+    elif item.response_format == "verbose_json":
+        language = item.options.language or ISO_639_1.get(output.get("language"), output.get("language"))
+        return verbose_json(output, item.options.task, language, item.options.timestamp == "word")
+    elif item.response_format == "text":
+        return output["text"]
+    return render_subtitles(output["chunks"], item.response_format)  # type: ignore
+
+
+def _write_json(path: str, data: dict) -> None:
+    temp = f"{path}.tmp"
+    with open(temp, "w") as f:
+        json.dump(data, f)
+    os.replace(temp, path)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser = STTArgs.add_cli_args(parser)
+    parser.description = "Transcribe every file of a JSONL manifest, resumable"
+    parser.add_argument(
+        "--output-dir",
+        required=True,
+        type=str,
+        help="Directory of the job, with its results.jsonl; an existing job there is resumed",
+    )
+    parser.add_argument(
+        "--manifest",
+        default=None,
+        type=str,
+        help='JSONL manifest, one {"id", "file" or "url", "language", "task", "prompt", "temperature", '
+        '"timestamp_granularities", "response_format"} per line, files relative to it',
+    )
+    parser.add_argument(
+        "--status",
+        action="store_true",
+        help="Print the status of the job in --output-dir and exit, also while it runs (default: False)",
+    )
+    parser.add_argument(
+        "--concurrency",
+        default=32,
+        type=int,
+        help="Files transcribed at the same time, their chunks share batches (default: 32)",
+    )
+    parser.add_argument(
+        "--max-batch-size",
+        default=None,
+        type=int,
+        help="Max chunks per forward pass across files (default: --batch-size)",
+    )
+    parser.add_argument(
+        "--max-wait-ms",
+        default=10,
+        type=float,
+        help="Max time a chunk waits for others to fill its batch (default: 10)",
+    )
+
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+    if args.status:
+        path = os.path.join(args.output_dir, "status.json")
+        if not os.path.exists(path):
+            path = os.path.join(args.output_dir, "job.json")
+        with open(path) as f:
+            print(json.dumps(json.load(f), indent=2))
+        raise SystemExit(0)
+
+    if os.path.exists(os.path.join(args.output_dir, "job.json")):
+        job = BatchJob(args.output_dir)
+        logger.info(f"Resuming job {job.id}: {job.counts()}")
+    elif args.manifest:
+        with open(args.manifest) as f:
+            job = BatchJob.create(
+                args.output_dir, f, os.path.dirname(os.path.abspath(args.manifest)), confine=False
+            )
+    else:
+        parser.error("--manifest is required to start a job")
+
+    from batching import BatchScheduler
+    from pool import start_replicas
+
+    model = start_replicas(STTArgs.from_cli_args(args))
+
+    async def main() -> None:
+        scheduler = BatchScheduler(args.max_batch_size, args.max_wait_ms / 1000)
+
+        async def transcribe(item: JobItem) -> dict:
+            return await scheduler.run(model, item.source, item.options)  # ffmpeg reads paths and URLs
+
+        try:
+            await job.run(transcribe, args.concurrency)
+        finally:
+            await scheduler.close()
+
+    asyncio.run(main())
+    logger.info(f"Job {job.id} is {job.status}: {job.counts()}, results in {job.output}")
@@ -0,0 +1,310 @@
+import bisect
+import threading
+from typing import Callable, Dict, Iterable, List, Sequence
+
+DEFAULT_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+STAGE_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+
+
+class Histogram:
+    r"""
+    Minimal Prometheus histogram, cumulative buckets are only computed when scraped.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: Sequence[str] = (),
+        buckets: Sequence[float] = DEFAULT_BUCKETS,
+    ) -> None:
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self.lock = threading.Lock()
+        self.series: Dict[tuple, list] = {}  # labels -> [counts per bucket (+Inf last), sum]
+        REGISTRY.append(self)
+
+    def observe(self, value: float, *labels: str) -> None:
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            series = self.series.get(labels)
+            if series is None:
+                series = self.series[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][index] += 1
+            series[1] += value
+
+    def snapshot(self) -> Dict[tuple, list]:
+        with self.lock:
+            return {labels: [list(counts), total] for labels, (counts, total) in self.series.items()}
+
+    @staticmethod
+    def merge(values: Dict[tuple, list], other: Dict[tuple, list]) -> Dict[tuple, list]:
+        merged = {labels: [list(counts), total] for labels, (counts, total) in values.items()}
+        for labels, (counts, total) in other.items():
+            if labels in merged:
+                merged[labels][0] = [a + b for a, b in zip(merged[labels][0], counts)]
+                merged[labels][1] += total
+            else:
+                merged[labels] = [list(counts), total]
+        return merged
+
+    def render(self) -> List[str]:
+        lines = [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} histogram",
+        ]
+        merged = self.snapshot()
+        for snapshot in _remote(self.name):
+            merged = self.merge(merged, snapshot)
+        for labels, (counts, total) in merged.items():
+            pairs = [f'{k}="{v}"' for k, v in zip(self.labelnames, labels)]
+            cumulative = 0
+            for bound, count in zip((*self.buckets, "+Inf"), counts):
+                cumulative += count
+                le = ",".join(pairs + [f'le="{bound}"'])
+                lines.append(f"{self.name}_bucket{{{le}}} {cumulative}")
+            suffix = "{" + ",".join(pairs) + "}" if pairs else ""
+            lines.append(f"{self.name}_sum{suffix} {total}")
+            lines.append(f"{self.name}_count{suffix} {cumulative}")
+        return lines
+
+
+class Counter:
+    r"""
+    Minimal Prometheus counter.
+    """
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> None:
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.lock = threading.Lock()
+        self.values: Dict[tuple, float] = {}
+        REGISTRY.append(self)
+
+    def inc(self, value: float = 1, *labels: str) -> None:
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0.0) + value
+
+    def snapshot(self) -> Dict[tuple, float]:
+        with self.lock:
+            return dict(self.values)
+
+    @staticmethod
+    def merge(values: Dict[tuple, float], other: Dict[tuple, float]) -> Dict[tuple, float]:
+        merged = dict(values)
+        for labels, value in other.items():
+            merged[labels] = merged.get(labels, 0.0) + value
+        return merged
+
+    def render(self) -> List[str]:
+        lines = [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} counter",
+        ]
+        values = self.snapshot()
+        for snapshot in _remote(self.name):
+            values = self.merge(values, snapshot)
+        return lines + _samples(self.name, self.labelnames, values)
+
+
+class Gauge:
+    r"""
+    Minimal Prometheus gauge. Values are either set, or pulled from `collectors` only when scraped.
+    The values of the same series in several processes are combined by `combine`, the highest by default.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: Sequence[str] = (),
+        combine: Callable[[float, float], float] = max,
+    ) -> None:
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.combine = combine
+        self.values: Dict[tuple, float] = {}
+        self.collectors: List[Callable[[], Iterable[tuple[tuple, float]]]] = []
+        REGISTRY.append(self)
+
+    def set(self, value: float, *labels: str) -> None:
+        self.values[labels] = value
+
+    def snapshot(self) -> Dict[tuple, float]:
+        values = dict(self.values)
+        for collect in self.collectors:
+            values.update(collect())
+        return values
+
+    def merge(self, values: Dict[tuple, float], other: Dict[tuple, float]) -> Dict[tuple, float]:
+        merged = dict(values)
+        for labels, value in other.items():
+            merged[labels] = self.combine(merged[labels], value) if labels in merged else value
+        return merged
+
+    def render(self) -> List[str]:
+        lines = [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} gauge",
+        ]
+        values = self.snapshot()
+        for snapshot in _remote(self.name):
+            values = self.merge(values, snapshot)
+        return lines + _samples(self.name, self.labelnames, values)
+
+
+def _samples(name: str, labelnames: tuple, values: Dict[tuple, float]) -> List[str]:
+    lines = []
+    for labels, value in values.items():
+        pairs = ",".join(f'{k}="{v}"' for k, v in zip(labelnames, labels))
+        lines.append(f"{name}{{{pairs}}} {value}" if pairs else f"{name} {value}")
+    return lines
+
+
+REGISTRY: List[Histogram | Counter | Gauge] = []
+REMOTE: Dict[str, Dict[str, dict]] = {}  # Source (*e.g.* a worker process) -> its last snapshot
+RETIRED = "retired"  # Source of the counts of the sources gone
+
+
+def _remote(name: str) -> List[dict]:
+    return [snapshot[name] for snapshot in list(REMOTE.values()) if name in snapshot]
+
+
+def snapshot() -> Dict[str, dict]:
+    r"""
+    Values of all metrics of this process, to be merged into the ones of another with `REMOTE`.
+    """
+    return {metric.name: metric.snapshot() for metric in REGISTRY}
+
+
+def retire(source: str) -> None:
+    r"""
+    Drop the gauges of `source` of `REMOTE`, *e.g.* a worker process that has died. Its counters and
+    histograms are kept in the totals.
+    """
+
+    snapshot = REMOTE.pop(source, None)
+    if not snapshot:
+        return
+    retired = dict(REMOTE.get(RETIRED, {}))
+    for metric in REGISTRY:
+        if not isinstance(metric, Gauge) and metric.name in snapshot:
+            retired[metric.name] = metric.merge(retired.get(metric.name, {}), snapshot[metric.name])
+    REMOTE[RETIRED] = retired  # Replaced at once, while scrapes may read it
+
+
+def render() -> str:
+    r"""
+    All metrics in the Prometheus text exposition format.
+    """
+    return "\n".join(line for metric in REGISTRY for line in metric.render()) + "\n"
+
+
+REQUEST_TTFT = Histogram(
+    "whisper_request_ttft_seconds",
+    "Time from request to the first transcribed content sent back",
+    ["endpoint", "stream"],
+)
+REQUEST_LATENCY = Histogram(
+    "whisper_request_latency_seconds",
+    "Time from request to the end of the response",
+    ["endpoint", "stream"],
+)
+REPLICA_QUEUE_DEPTH = Gauge(
+    "whisper_replica_queue_depth",
+    "Chunks being processed by a replica",
+    ["model", "replica"],
+)
+REPLICA_UTILISATION = Gauge(
+    "whisper_replica_utilisation",
+    "Share of time a replica has been running forward passes since it was created",
+    ["model", "replica"],
+)
+STAGE_SECONDS = Histogram(
+    "whisper_stage_seconds",
+    "Time spent in each stage of a request: upload, download, decode, features, encoder, decoder, merge, render",
+    ["stage"],
+    STAGE_BUCKETS,
+)
+QUEUE_WAIT = Histogram(
+    "whisper_queue_wait_seconds",
+    "Time waited for an inference slot (admission) or for a forward pass (batch)",
+    ["queue"],
+    STAGE_BUCKETS,
+)
+BATCH_OCCUPANCY = Histogram(
+    "whisper_batch_occupancy",
+    "Chunks per forward pass over the max batch size",
+    buckets=(0.125, 0.25, 0.375, 0.5, 0.625, 0.75, 0.875, 1),
+)
+AUDIO_SECONDS = Counter(
+    "whisper_audio_seconds_total",
+    "Seconds of audio decoded",
+)
+REAL_TIME_FACTOR = Histogram(
+    "whisper_real_time_factor",
+    "Processing time of a request over the duration of its audio",
+    buckets=(0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1, 2, 5),
+)
+GPU_MEMORY_PEAK = Gauge(
+    "whisper_gpu_memory_peak_bytes",
+    "Highest memory allocated by tensors on a GPU since start, the highest of the processes using it",
+    ["device"],
+)
+SPECULATIVE_TOKENS = Counter(
+    "whisper_speculative_tokens_total",
+    "Tokens drafted by the assistant model, and accepted by the main one, their ratio is the acceptance rate",
+    ["kind"],
+)
+SPECULATIVE_FALLBACKS = Counter(
+    "whisper_speculative_fallbacks_total",
+    "Forward passes decoded without the assistant model, by reason",
+    ["reason"],
+)
+BATCH_LIMIT = Gauge(
+    "whisper_batch_size_limit",
+    "Largest batch a replica runs now, learned from out-of-memory errors and probes, per shape of batch",
+    ["model", "device", "shape"],
+)
+OUT_OF_MEMORY = Counter(
+    "whisper_out_of_memory_total",
+    "Forward passes that ran out of memory, and were split and retried",
+    ["model", "device"],
+)
+MODEL_EVENTS = Counter(
+    "whisper_model_events_total",
+    "Models loaded, evicted, or failing to load",
+    ["model", "event"],
+)
+MODEL_LOAD_SECONDS = Histogram(
+    "whisper_model_load_seconds",
+    "Time to load a model",
+    ["model"],
+)
+MODEL_MEMORY = Gauge(
+    "whisper_model_memory_bytes",
+    "Weights of a loaded model",
+    ["model"],
+)
+STARTUP_SECONDS = Gauge(
+    "whisper_startup_seconds",
+    "Time taken by each phase of startup, per model for loading and warmup",
+    ["model", "phase"],
+)
+REALTIME_SESSIONS = Gauge(
+    "whisper_realtime_sessions",
+    "Open realtime WebSocket sessions",
+)
+REALTIME_COMMIT_LATENCY = Histogram(
+    "whisper_realtime_commit_latency_seconds",
+    "Time from receiving the end of a word to committing it, of realtime sessions",
+    buckets=STAGE_BUCKETS,
+)
+REALTIME_DROPPED_SECONDS = Counter(
+    "whisper_realtime_dropped_seconds_total",
+    "Seconds of realtime audio dropped before being transcribed, as passes fell a whole window behind",
+)
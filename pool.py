@@ -0,0 +1,126 @@
+import copy
+import dataclasses
+import logging
+import threading
+import time
+from typing import Callable, Dict, List, TypeVar
+
+from inference import STT, GenerateOptions, STTArgs, warmup_batch_sizes
+from metrics import STARTUP_SECONDS
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+
+class ReplicaPool:
+    r"""
+    Several `STT` replicas of one model, on one or several devices. Every batch goes to the replica
+    with the fewest chunks in flight, so a `BatchScheduler` keeps all of them busy.
+    """
+
+    def __init__(self, replicas: List[STT]) -> None:
+        self.replicas = replicas
+        self.model_name = replicas[0].model_name
+        self.batch_size = replicas[0].batch_size
+        self.sampling_rate = replicas[0].sampling_rate
+        self.language_windows = replicas[0].language_windows
+        self.parallelism = len(replicas)
+
+        self.lock = threading.Lock()
+        self.created = time.monotonic()
+        self.depth = [0] * len(replicas)  # Chunks in flight per replica
+        self.busy = [0.0] * len(replicas)  # Time spent in forward passes per replica
+        self.running: Dict[int, float] = {}  # Replica -> start of its current forward pass
+
+    def preprocess(self, file):
+        return self.replicas[0].preprocess(file)
+
+    def window_item(self, window):
+        return self.replicas[0].window_item(window)
+
+    def forward(self, items: list[dict], options: GenerateOptions) -> list[dict]:
+        return self._route(items, lambda replica: replica.forward(items, options))
+
+    def batch_limit(self, options: GenerateOptions) -> int:
+        # Of the device with the most room, replicas of the others split what is too large for them
+        return max(replica.batch_limit(options) for replica in self.replicas)
+
+    def detect_language(self, items: list[dict]) -> Dict[str, float]:
+        return self._route(items, lambda replica: replica.detect_language(items))
+
+    def _route(self, items: list[dict], call: Callable[[STT], T]) -> T:
+        with self.lock:
+            index = min(range(len(self.replicas)), key=self.depth.__getitem__)
+            self.depth[index] += len(items)
+            self.running[index] = start = time.monotonic()
+        try:
+            return call(self.replicas[index])
+        finally:
+            with self.lock:
+                self.depth[index] -= len(items)
+                self.busy[index] += time.monotonic() - start
+                if not self.depth[index]:
+                    self.running.pop(index, None)
+
+    def postprocess(self, outputs: list[dict], options: GenerateOptions) -> dict:
+        return self.replicas[0].postprocess(outputs, options)
+
+    generate = STT.generate  # Same loop as a single replica, on top of the routed stages
+    pin_language = STT.pin_language
+    identify_language = STT.identify_language
+
+    def warmup(self, batch_sizes: list[int]) -> None:
+        # Replicas of a device share its weights and kernel caches, one of them is enough
+        for replica in {replica.device: replica for replica in self.replicas}.values():
+            replica.warmup(batch_sizes)
+
+    def stats(self) -> List[dict]:
+        now = time.monotonic()
+        with self.lock:
+            return [
+                {
+                    "replica": f"{replica.device}#{index}",
+                    "queue_depth": self.depth[index],
+                    "batch_size": replica.sizer.limits() or {"default": replica.batch_size},
+                    "utilisation": (
+                        self.busy[index] + now - self.running.get(index, now)
+                    )
+                    / max(now - self.created, 1e-9),
+                }
+                for index, replica in enumerate(self.replicas)
+            ]
+
+
+def load_replicas(args: STTArgs) -> STT | ReplicaPool:
+    r"""
+    One `STT` per device of `--device-id` (*e.g.* "0,1,2,3"), plus `--replicas-per-device` - 1
+    replicas sharing its weights, so that their CPU work (decoding loop, timestamps) overlaps.
+    """
+
+    replicas = []
+    for device_id in args.device_id.split(","):
+        stt = STT(dataclasses.replace(args, device_id=device_id.strip()))
+        replicas += [stt] + [copy.copy(stt) for _ in range(args.replicas_per_device - 1)]
+    return replicas[0] if len(replicas) == 1 else ReplicaPool(replicas)
+
+
+def start_replicas(args: STTArgs) -> STT | ReplicaPool:
+    r"""
+    `load_replicas`, then warm them up with the batch sizes of `--warmup`. Each phase is logged with its timing.
+    """
+
+    start = time.perf_counter()
+    model = load_replicas(args)
+    log_phase(args.model_name, "load", time.perf_counter() - start)
+    batch_sizes = warmup_batch_sizes(args.warmup, args.batch_size)
+    if batch_sizes:
+        start = time.perf_counter()
+        model.warmup(batch_sizes)
+        log_phase(args.model_name, "warmup", time.perf_counter() - start)
+    return model
+
+
+def log_phase(model_name: str, phase: str, elapsed: float) -> None:
+    STARTUP_SECONDS.set(elapsed, model_name, phase)
+    logger.info(f"Startup phase '{phase}' of {model_name}: {elapsed:.2f}s")
@@ -2,49 +2,97 @@ import dataclasses
 from enum import Enum
 from typing import Dict, List
 
-from fastapi import File, Form
+from fastapi import File, Form, UploadFile
 from pydantic import BaseModel
 
 
 @dataclasses.dataclass
 class AudioTranscriptionRequest:
-    file: bytes | None = File(None)  # File, high priority
+    file: UploadFile | None = File(None)  # File, high priority, spooled to disk when large
     model: str = Form("whisper-1")  # OpenAI-like by default
     language: str | None = Form(None)  #  ISO-639-1
     prompt: str | None = Form(None)  # Should match the audio language
-    response_format: str = Form("json")  # json/text/srt/vtt, not support verbose_json
+    response_format: str = Form("json")  # json/text/srt/vtt/verbose_json
     temperature: float = Form(0)  # The sampling temperature, between 0 and 1
+    timestamp_granularities: List[str] | None = Form(None, alias="timestamp_granularities[]")  # segment/word
 
     # Custom
     url: str = Form(None)  # File URL, low priority
+    stream: bool = Form(False)  # Server-sent events, one per chunk as soon as it is decoded
+    deadline: float | None = Form(None)  # Seconds the client is willing to wait, rejected at once if not feasible
+    priority: int = Form(0)  # Higher is admitted first
+    max_line_chars: int | None = Form(None, gt=0)  # srt/vtt: wrap lines longer than this
+    max_cue_s: float | None = Form(None, gt=0)  # srt/vtt: split longer chunks, merge up to this
+    merge_words: bool = Form(False)  # srt/vtt: merge word chunks into cues of up to 2 lines or a sentence
+    input_format: str | None = Form(None)  # pcm16/f32/npy: the file holds mono samples at `sample_rate`, read without ffmpeg
+    sample_rate: int = Form(16000)  # Of an `input_format` file
+    tasks: str | None = Form(None)  # json/verbose_json: also decoded from the same encoder pass, *e.g.* "translate,transcribe:fr"
 
 
 class AudioTranscriptionResponse(BaseModel):  # "json" response_format
     text: str
     chunks: List[Dict] | None = None  # (Not included in original OpenAI API)
+    skipped_seconds: float | None = None  # Non-speech audio dropped by VAD (Not included in original OpenAI API)
+    tasks: List[Dict] | None = None  # Outputs of the extra `tasks`, in order (Not included in original OpenAI API)
 
 
 @dataclasses.dataclass
 class AudioTranslationRequest:
-    file: bytes | None = File(None)  # File, high priority
+    file: UploadFile | None = File(None)  # File, high priority, spooled to disk when large
     model: str = Form("whisper-1")  # OpenAI-like by default
     prompt: str | None = Form(None)  # Should match the audio language
-    response_format: str = Form("json")  # json/text/srt/vtt, not support verbose_json
+    response_format: str = Form("json")  # json/text/srt/vtt/verbose_json
     temperature: float = Form(0)  # The sampling temperature, between 0 and 1
+    timestamp_granularities: List[str] | None = Form(None, alias="timestamp_granularities[]")  # segment/word
 
     # Custom
     url: str = Form(None)  # File URL, low priority
+    stream: bool = Form(False)  # Server-sent events, one per chunk as soon as it is decoded
+    deadline: float | None = Form(None)  # Seconds the client is willing to wait, rejected at once if not feasible
+    priority: int = Form(0)  # Higher is admitted first
+    max_line_chars: int | None = Form(None, gt=0)  # srt/vtt: wrap lines longer than this
+    max_cue_s: float | None = Form(None, gt=0)  # srt/vtt: split longer chunks, merge up to this
+    merge_words: bool = Form(False)  # srt/vtt: merge word chunks into cues of up to 2 lines or a sentence
+    input_format: str | None = Form(None)  # pcm16/f32/npy: the file holds mono samples at `sample_rate`, read without ffmpeg
+    sample_rate: int = Form(16000)  # Of an `input_format` file
+
+
+@dataclasses.dataclass
+class LanguageDetectionRequest:
+    file: UploadFile | None = File(None)  # File, high priority
+    model: str = Form("whisper-1")
+    url: str = Form(None)  # File URL, low priority
+    windows: int = Form(3)  # Windows of the start of the audio to detect on, between 1 and 10
+    top_k: int = Form(5)  # Most likely languages returned
+
+
+@dataclasses.dataclass
+class BatchRequest:
+    file: UploadFile = File(...)  # JSONL manifest, one file or url per line with its options
+
+
+class AudioVerboseResponse(BaseModel):  # "verbose_json" response_format
+    task: str
+    language: str | None = None
+    duration: float | None = None
+    text: str
+    segments: List[Dict]
+    words: List[Dict] | None = None
+    skipped_seconds: float | None = None  # Non-speech audio dropped by VAD (Not included in original OpenAI API)
+    tasks: List[Dict] | None = None  # verbose_json of the extra `tasks`, in order (Not included in original OpenAI API)
 
 
 class AudioTranslationResponse(BaseModel):  # "json" response_format
     text: str
     chunks: List[Dict] | None = None  # (Not included in original OpenAI API)
+    skipped_seconds: float | None = None  # Non-speech audio dropped by VAD (Not included in original OpenAI API)
 
 
 class ErrorCode(int, Enum):
     DEFAULT = 500
     OVERLOAD = 529
     RATELIMIT = 429
+    TOOLARGE = 413
     KEYERROR = 401
     BADREQUEST = 400
 
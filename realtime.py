@@ -0,0 +1,311 @@
+import asyncio
+import bisect
+import collections
+import dataclasses
+import re
+import subprocess
+import threading
+import time
+from typing import Callable, Deque, List
+
+import numpy as np
+from fastapi import WebSocket, WebSocketDisconnect
+
+from audio import Resampler
+from batching import BatchScheduler
+from inference import GenerateOptions
+from metrics import REALTIME_COMMIT_LATENCY, REALTIME_DROPPED_SECONDS
+
+SAMPLING_RATE = 16000  # Of every Whisper feature extractor
+
+
+@dataclasses.dataclass(frozen=True)
+class Word:
+    start: float  # Seconds since the start of the session
+    end: float
+    text: str
+
+    @property
+    def key(self) -> str:
+        return re.sub(r"[^\w]", "", self.text.lower())
+
+
+class LocalAgreement:
+    r"""
+    Commits the words on which two consecutive hypotheses of the sliding window agree (LocalAgreement-2):
+    a word that survives one more second of context rarely changes afterwards.
+    """
+
+    def __init__(self) -> None:
+        self.committed: Deque[Word] = collections.deque(maxlen=5)  # The last ones, enough to find repeats
+        self.previous: List[Word] = []  # Uncommitted words of the last hypothesis
+
+    @property
+    def end(self) -> float:
+        return self.committed[-1].end if self.committed else 0.0
+
+    def insert(self, words: List[Word]) -> List[Word]:
+        r"""
+        Take a new hypothesis of the window, return the words it commits.
+        """
+
+        words = [w for w in words if w.start >= self.end - 0.1]
+        words = words[self._overlap(words) :]
+        agreed = 0
+        while (
+            agreed < min(len(words), len(self.previous))
+            and words[agreed].key == self.previous[agreed].key
+        ):
+            agreed += 1
+        commit, self.previous = words[:agreed], words[agreed:]
+        self.committed.extend(commit)
+        return commit
+
+    def flush(self) -> List[Word]:
+        commit, self.previous = self.previous, []
+        self.committed.extend(commit)
+        return commit
+
+    def _overlap(self, words: List[Word]) -> int:
+        # Words at the start of the window that repeat the last committed ones, up to 5
+        tail = [w.key for w in self.committed]
+        for n in range(min(len(tail), len(words)), 0, -1):
+            if tail[-n:] == [w.key for w in words[:n]]:
+                return n
+        return 0
+
+
+class RealtimeSession:
+    r"""
+    Transcribes a live stream of samples over a sliding window, at most `max_window_s` long so that memory
+    stays bounded. Each pass is a forward of the window, batched with the passes of other sessions by the
+    `BatchScheduler`; committed audio is dropped from the window once it is longer than `trim_s`. Should passes
+    fall a whole window behind, the oldest audio is dropped as it arrives, and counted.
+    """
+
+    def __init__(
+        self,
+        model,
+        scheduler: BatchScheduler,
+        options: GenerateOptions,
+        step_s: float = 1,
+        trim_s: float = 15,
+        max_window_s: float = 30,
+    ) -> None:
+        self.model = model
+        self.scheduler = scheduler
+        self.options = dataclasses.replace(options, timestamp="word")  # Words are committed one by one
+        self.step = int(step_s * SAMPLING_RATE)
+        self.trim = int(trim_s * SAMPLING_RATE)
+        self.max_window = int(max_window_s * SAMPLING_RATE)
+
+        self.window = np.empty(0, dtype=np.float32)
+        self.offset = 0  # Samples of the session before the window
+        self.received = 0  # Samples of the session
+        self.decoded = 0  # Samples of the session at the last pass
+        self.arrivals: Deque[tuple[int, float]] = collections.deque()  # (samples received, time)
+        self.agreement = LocalAgreement()
+        self.audio = asyncio.Event()
+
+    def feed(self, samples: np.ndarray) -> None:
+        self.window = np.concatenate([self.window, samples])
+        if (excess := len(self.window) - self.max_window) > 0:  # Passes are a whole window behind
+            unseen = self.offset + excess - max(self.decoded, self.offset)  # By any pass
+            REALTIME_DROPPED_SECONDS.inc(max(unseen, 0) / SAMPLING_RATE)
+            self.window = self.window[excess:]
+            self.offset += excess
+            while len(self.arrivals) > 1 and self.arrivals[1][0] <= self.offset:
+                self.arrivals.popleft()
+        self.received += len(samples)
+        self.arrivals.append((self.received, time.perf_counter()))
+        self.audio.set()
+
+    @property
+    def ready(self) -> bool:
+        return self.received - self.decoded >= self.step
+
+    async def decode(self) -> tuple[List[Word], List[Word]]:
+        r"""
+        One pass over the window, returns the words it commits and the ones still tentative.
+        """
+
+        loop = asyncio.get_running_loop()
+        self.decoded = self.received
+        if not len(self.window):
+            return [], []
+        window = self.window[-self.max_window :]  # The feature extractor would cut the rest
+        start = (self.offset + len(self.window) - len(window)) / SAMPLING_RATE
+        item = await loop.run_in_executor(None, self.model.window_item, window.copy())
+        output = await self.scheduler.submit(self.model, item, self.options)
+        result = await loop.run_in_executor(None, self.model.postprocess, [output], self.options)
+        words = [
+            Word(start + begin, start + (end if end is not None else begin), chunk["text"])
+            for chunk in result["chunks"]
+            for begin, end in [chunk["timestamp"]]
+        ]
+        commit = self.agreement.insert(words)
+        if len(window) >= self.max_window:  # Nothing agreed for a whole window, take it as it is
+            commit += self.agreement.flush()
+        self._committed(commit)
+        return commit, self.agreement.previous
+
+    def flush(self) -> List[Word]:
+        commit = self.agreement.flush()
+        self._committed(commit)
+        return commit
+
+    def _committed(self, words: List[Word]) -> None:
+        now = time.perf_counter()
+        for word in words:
+            REALTIME_COMMIT_LATENCY.observe(max(now - self._arrival(word.end), 0))
+
+        # Drop committed audio, or the oldest audio if the window is full anyway, never what arrived during the pass
+        if len(self.window) > self.trim:
+            decoded = self.decoded - self.offset
+            cut = int(self.agreement.end * SAMPLING_RATE) - self.offset
+            if len(self.window) >= self.max_window:
+                cut = max(cut, decoded - self.trim)
+            cut = min(cut, decoded)
+            if cut > 0:
+                self.window = self.window[cut:]
+                self.offset += cut
+        while len(self.arrivals) > 1 and self.arrivals[1][0] <= self.offset:
+            self.arrivals.popleft()
+
+    def _arrival(self, seconds: float) -> float:
+        # When the sample at `seconds` was received
+        samples = int(seconds * SAMPLING_RATE)
+        index = bisect.bisect_left(self.arrivals, (samples, 0.0))
+        return self.arrivals[min(index, len(self.arrivals) - 1)][1]
+
+
+class PCMDecoder:
+    r"""
+    Little-endian 16-bit mono PCM frames at `sample_rate`, resampled to 16 kHz, on the event loop.
+    """
+
+    blocking = False
+
+    def __init__(self, sample_rate: int, output: Callable[[np.ndarray], None]) -> None:
+        self.sample_rate = sample_rate
+        self.output = output
+        self.resampler = Resampler(sample_rate, SAMPLING_RATE)  # Frames join without clicks
+        self.odd = b""  # A frame may split a sample
+
+    def write(self, data: bytes) -> None:
+        data, self.odd = self.odd + data, b""
+        if len(data) % 2:
+            data, self.odd = data[:-1], data[-1:]
+        samples = np.frombuffer(data, dtype="<i2").astype(np.float32) / 32768
+        self.output(self.resampler(samples))
+
+    def close(self) -> None:
+        self.output(self.resampler.flush())  # The last samples still in its filter
+
+
+class FFmpegDecoder:
+    r"""
+    Compressed frames (*e.g.* Opus in Ogg or WebM) decoded as they arrive by one ffmpeg process per session.
+    """
+
+    blocking = True  # Writes may wait for ffmpeg
+
+    def __init__(self, output: Callable[[np.ndarray], None]) -> None:
+        loop = asyncio.get_running_loop()
+        self.process = subprocess.Popen(
+            [
+                "ffmpeg",
+                *("-fflags", "nobuffer", "-probesize", "32", "-analyzeduration", "0"),
+                *("-i", "pipe:0"),
+                *("-ac", "1", "-ar", str(SAMPLING_RATE), "-f", "f32le"),
+                *("-hide_banner", "-loglevel", "quiet"),
+                "pipe:1",
+            ],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+        )
+
+        def read() -> None:
+            rest = b""  # A read may split a sample
+            while raw := self.process.stdout.read1(SAMPLING_RATE // 10 * 4):  # type: ignore
+                raw, rest = rest + raw, b""
+                if len(raw) % 4:
+                    raw, rest = raw[: len(raw) // 4 * 4], raw[len(raw) // 4 * 4 :]
+                loop.call_soon_threadsafe(output, np.frombuffer(raw, dtype=np.float32))
+
+        self.reader = threading.Thread(target=read, daemon=True)
+        self.reader.start()
+
+    def write(self, data: bytes) -> None:
+        self.process.stdin.write(data)  # type: ignore
+        self.process.stdin.flush()  # type: ignore
+
+    def close(self) -> None:
+        try:
+            self.process.stdin.close()  # type: ignore
+        except BrokenPipeError:
+            pass
+        self.reader.join(timeout=5)
+        self.process.kill()
+        self.process.wait()
+
+
+async def serve(websocket: WebSocket, session: RealtimeSession, format: str, sample_rate: int) -> None:
+    r"""
+    Binary messages are audio, the text message "end" (or closing) finishes the session. Sends JSON messages:
+    `partial` (tentative words, may change), `final` (committed words, never change) and `done`. The full text
+    is the concatenation of the `final` ones, it is not kept here.
+    """
+
+    def words(ws: List[Word]) -> dict:
+        return {
+            "text": "".join(w.text for w in ws),
+            "words": [{"word": w.text.strip(), "start": w.start, "end": w.end} for w in ws],
+        }
+
+    loop = asyncio.get_running_loop()
+    decoder = PCMDecoder(sample_rate, session.feed) if format == "pcm16" else FFmpegDecoder(session.feed)
+    finished = asyncio.Event()
+
+    async def receive() -> None:
+        try:
+            while True:
+                message = await websocket.receive()
+                if message["type"] == "websocket.disconnect":
+                    break
+                if message.get("bytes") and decoder.blocking:
+                    await loop.run_in_executor(None, decoder.write, message["bytes"])
+                elif message.get("bytes"):
+                    decoder.write(message["bytes"])
+                elif message.get("text", "").strip() == "end":
+                    break
+        finally:
+            if decoder.blocking:
+                await loop.run_in_executor(None, decoder.close)  # Decodes what is left
+                await asyncio.sleep(0)  # Its last samples are fed
+            else:
+                decoder.close()
+            finished.set()
+            session.audio.set()
+
+    receiver = asyncio.create_task(receive())
+    try:
+        while not finished.is_set():
+            await session.audio.wait()
+            session.audio.clear()
+            if session.ready:
+                commit, partial = await session.decode()
+                if commit:
+                    await websocket.send_json({"type": "final", **words(commit)})
+                await websocket.send_json({"type": "partial", **words(partial)})
+        commit = (await session.decode())[0] if session.received > session.decoded else []
+        commit += session.flush()
+        if commit:
+            await websocket.send_json({"type": "final", **words(commit)})
+        await websocket.send_json({"type": "done"})
+        await websocket.close()
+    except WebSocketDisconnect:
+        pass
+    finally:
+        receiver.cancel()
+        await asyncio.gather(receiver, return_exceptions=True)
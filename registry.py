@@ -0,0 +1,238 @@
+import asyncio
+import dataclasses
+import json
+import logging
+import time
+from typing import Awaitable, Callable, Dict, Iterable, Iterator, List
+
+import torch
+from fastapi import HTTPException, status
+
+from inference import STT, STTArgs
+from metrics import MODEL_EVENTS, MODEL_LOAD_SECONDS
+from pool import ReplicaPool, load_replicas
+from utils import torch_gc
+from workers import WorkerPool
+
+logger = logging.getLogger(__name__)
+
+Model = STT | ReplicaPool | WorkerPool
+Loader = Callable[[STTArgs, dict], Model]
+
+# Keys of a model entry of the config file that are not `STTArgs`
+ENTRY_KEYS = ("pinned", "memory_mb", "workers")
+
+
+@dataclasses.dataclass
+class _Entry:
+    name: str
+    args: STTArgs
+    spec: dict  # Its entry of the config file
+    pinned: bool = False
+    model: Model | None = None
+    memory: int = 0  # Bytes, measured once loaded, or `memory_mb` of the spec
+    users: int = 0  # Requests using the model
+    last_used: float = 0
+    loading: asyncio.Future | None = None
+
+
+class ModelRegistry:
+    r"""
+    The models served, by name. A model is loaded on the first request for it, and the least recently used idle
+    models are evicted when loading it would exceed `budget_bytes` (0 for no budget). Pinned models are loaded
+    at startup and never evicted.
+
+    Configured from a JSON file:
+    ```
+    {
+        "budget_mb": 20000,
+        "models": {
+            "whisper-1": {"model_name": "openai/whisper-large-v3", "pinned": true},
+            "whisper-medium": {"model_name": "openai/whisper-medium", "memory_mb": 1600},
+            "distil-en": {"model_name": "distil-whisper/distil-medium.en", "batch_size": 32}
+        }
+    }
+    ```
+    Entries override the `STTArgs` of the command line, `memory_mb` is the footprint to expect before loading.
+    """
+
+    def __init__(
+        self,
+        specs: Dict[str, dict],
+        base: STTArgs,
+        budget_bytes: int = 0,
+        loader: Loader | None = None,
+    ) -> None:
+        self.budget = budget_bytes
+        self.loader = loader or (lambda args, spec: load_replicas(args))
+        self.entries: Dict[str, _Entry] = {}
+        for name, spec in specs.items():
+            overrides = {k: v for k, v in spec.items() if k not in ENTRY_KEYS}
+            self.entries[name.lower()] = _Entry(  # Case-insensitive
+                name.lower(),
+                dataclasses.replace(base, **overrides),
+                spec,
+                pinned=spec.get("pinned", False),
+                memory=int(spec.get("memory_mb", 0)) << 20,
+            )
+        self.lock = asyncio.Lock()  # One load at a time, so that the budget holds
+        self.on_evict: List[Callable[[Model], Awaitable[None]]] = []
+
+    @classmethod
+    def from_file(
+        cls, path: str, base: STTArgs, budget_bytes: int | None = None, loader: Loader | None = None
+    ) -> "ModelRegistry":
+        with open(path) as f:
+            config = json.load(f)
+        if budget_bytes is None:
+            budget_bytes = int(config.get("budget_mb", 0)) << 20
+        return cls(config["models"], base, budget_bytes, loader)
+
+    @classmethod
+    def static(cls, models: Dict[str, Model]) -> "ModelRegistry":
+        r"""
+        Models already loaded, all pinned.
+        """
+
+        registry = cls({}, STTArgs())
+        for name, model in models.items():
+            registry.entries[name.lower()] = _Entry(
+                name.lower(), STTArgs(), {}, pinned=True, model=model, memory=footprint(model)
+            )
+        return registry
+
+    def __contains__(self, name: str) -> bool:
+        return name.lower() in self.entries
+
+    def loaded(self) -> Dict[str, Model]:
+        return {name: e.model for name, e in self.entries.items() if e.model is not None}
+
+    @property
+    def used(self) -> int:
+        return sum(e.memory for e in self.entries.values() if e.model is not None)
+
+    async def load_pinned(self) -> None:
+        for entry in self.entries.values():
+            if entry.pinned and entry.model is None:
+                await self._load(entry)
+
+    async def acquire(self, name: str) -> Model:
+        r"""
+        The model called `name`, loaded if need be. It is not evicted until `release`.
+        """
+
+        entry = self.entries[name.lower()]
+        while entry.model is None:
+            if entry.loading is None:
+                entry.loading = asyncio.ensure_future(self._load(entry))
+            await asyncio.shield(entry.loading)
+        entry.users += 1
+        entry.last_used = time.monotonic()
+        return entry.model
+
+    def release(self, name: str) -> None:
+        entry = self.entries[name.lower()]
+        entry.users -= 1
+        entry.last_used = time.monotonic()
+
+    def stats(self) -> List[dict]:
+        return [
+            {
+                "id": name,
+                "loaded": entry.model is not None,
+                "pinned": entry.pinned,
+                "in_use": entry.users,
+                "memory_bytes": entry.memory if entry.model is not None else None,
+            }
+            for name, entry in self.entries.items()
+        ]
+
+    async def close(self) -> None:
+        for entry in self.entries.values():
+            if isinstance(entry.model, WorkerPool):
+                entry.model.close()
+
+    async def _load(self, entry: _Entry) -> None:
+        loop = asyncio.get_running_loop()
+        try:
+            async with self.lock:
+                if entry.model is not None:
+                    return
+                await self._make_room(entry.memory, entry)
+                logger.info(f"Loading model '{entry.name}' ({entry.args.model_name})")
+                start = time.perf_counter()
+                try:
+                    model = await loop.run_in_executor(None, self.loader, entry.args, entry.spec)
+                except Exception:
+                    MODEL_EVENTS.inc(1, entry.name, "load_failed")
+                    logger.exception(f"Loading model '{entry.name}' failed")
+                    raise
+                elapsed = time.perf_counter() - start
+                if not entry.spec.get("memory_mb"):
+                    entry.memory = footprint(model)
+                entry.model, entry.last_used = model, time.monotonic()
+                MODEL_EVENTS.inc(1, entry.name, "load")
+                MODEL_LOAD_SECONDS.observe(elapsed, entry.name)
+                logger.info(
+                    f"Loaded model '{entry.name}' in {elapsed:.1f}s, {entry.memory >> 20} MB "
+                    f"({self.used >> 20}/{self.budget >> 20} MB used)"
+                )
+                await self._make_room(0, entry)  # Its measured footprint may be larger than expected
+        finally:
+            entry.loading = None
+
+    async def _make_room(self, needed: int, loading: _Entry) -> None:
+        while self.budget and self.used + needed > self.budget:
+            idle = [
+                e
+                for e in self.entries.values()
+                if e.model is not None and not e.pinned and not e.users and e is not loading
+            ]
+            if not idle:
+                if loading.model is not None:  # Loaded already, over budget until others are idle
+                    logger.warning(f"Memory budget exceeded by {(self.used - self.budget) >> 20} MB")
+                    return
+                raise HTTPException(
+                    status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                    detail=f"Not enough memory to load model '{loading.name}', the others are in use",
+                )
+            await self._evict(min(idle, key=lambda e: e.last_used))
+
+    async def _evict(self, entry: _Entry) -> None:
+        model, entry.model = entry.model, None
+        for callback in self.on_evict:
+            await callback(model)  # type: ignore
+        if isinstance(model, WorkerPool):
+            model.close()
+        del model
+        await asyncio.get_running_loop().run_in_executor(None, torch_gc)
+        MODEL_EVENTS.inc(1, entry.name, "evict")
+        logger.info(f"Evicted model '{entry.name}', {entry.memory >> 20} MB freed")
+
+
+def footprint(model: Model) -> int:
+    r"""
+    Bytes of the weights of `model`, counted once for replicas and tied weights sharing them. Unknown (0) for
+    worker processes.
+    """
+
+    replicas = model.replicas if isinstance(model, ReplicaPool) else [model]
+    modules = {}
+    for replica in replicas:
+        for module in (getattr(replica, "pipe", None) and replica.pipe.model, getattr(replica, "assistant", None)):
+            if module is not None:
+                modules[id(module)] = module
+    tensors = {}
+    for module in modules.values():
+        for tensor in _tensors(module.state_dict(keep_vars=True).values()):  # With the packed weights of int8
+            tensors[(tensor.data_ptr(), tensor.dtype)] = tensor.numel() * tensor.element_size()
+    return sum(tensors.values())
+
+
+def _tensors(values: Iterable) -> Iterator[torch.Tensor]:
+    # The tensors of state dict values, quantized linear layers hold theirs in tuples
+    for value in values:
+        if isinstance(value, torch.Tensor):
+            yield value
+        elif isinstance(value, (tuple, list)):
+            yield from _tensors(value)
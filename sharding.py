@@ -0,0 +1,203 @@
+import asyncio
+import dataclasses
+import os
+import re
+import time
+from typing import Awaitable, BinaryIO, Callable, List
+
+import numpy as np
+
+from audio import decode_to_file, probe_duration
+from batching import BatchScheduler
+from inference import GenerateOptions, with_language
+from metrics import STAGE_SECONDS
+from workers import WorkerPool
+
+SAMPLING_RATE = 16000  # Of every Whisper feature extractor
+
+
+@dataclasses.dataclass(frozen=True)
+class Shard:
+    start: int  # Samples of the original audio transcribed, overlapping the neighbours
+    end: int
+    keep_start: int  # Samples its chunks are kept from, the cuts between shards
+    keep_end: int
+
+
+def plan_shards(
+    audio: np.ndarray,
+    shard_s: float = 600,
+    overlap_s: float = 5,
+    search_s: float = 10,
+    frame_s: float = 0.03,
+) -> List[Shard]:
+    r"""
+    Split `audio` into shards of about `shard_s` seconds. Each cut is at the quietest 0.3 s within `search_s`
+    of its target, so that it rarely falls within a word, and shards extend `overlap_s` past it on both sides
+    so that the words around it are decoded with context. Only the audio around the targets is read.
+    """
+
+    shard_len = int(shard_s * SAMPLING_RATE)
+    search = int(search_s * SAMPLING_RATE)
+    overlap = int(overlap_s * SAMPLING_RATE)
+    frame_len = int(frame_s * SAMPLING_RATE)
+    smooth = max(1, int(0.3 / frame_s))
+
+    cuts = [0]
+    while len(audio) - cuts[-1] > shard_len + search:  # The last shard is never much shorter than the others
+        low = cuts[-1] + shard_len - search
+        n = 2 * search // frame_len
+        frames = np.asarray(audio[low : low + n * frame_len], dtype=np.float32).reshape(n, frame_len)
+        db = 10 * np.log10(np.mean(np.square(frames, dtype=np.float64), axis=1) + 1e-10)
+        loudness = np.convolve(db, np.ones(smooth) / smooth, mode="valid")
+        quietest = int(np.argmin(loudness))
+        cuts.append(low + (quietest + smooth // 2) * frame_len)
+    cuts.append(len(audio))
+
+    return [
+        Shard(max(cut - overlap, 0), min(next_cut + overlap, len(audio)), cut, next_cut)
+        for cut, next_cut in zip(cuts, cuts[1:])
+    ]
+
+
+def stitch(results: List[dict], shards: List[Shard]) -> dict:
+    r"""
+    Merge the transcriptions of `shards` into the one of the whole audio. Timestamps are moved from the shards
+    to the audio, and each chunk is taken from the shard whose kept part holds its middle. A chunk repeating
+    one just before it across a cut, as when both shards placed it on their side, is dropped.
+    """
+
+    chunks: List[dict] = []
+    for index, (result, shard) in enumerate(zip(results, shards)):
+        offset = shard.start / SAMPLING_RATE
+        keep_start = shard.keep_start / SAMPLING_RATE if index else -np.inf
+        keep_end = shard.keep_end / SAMPLING_RATE if index < len(shards) - 1 else np.inf
+        boundary = len(chunks)
+        for chunk in result["chunks"]:
+            begin, end = chunk["timestamp"]
+            begin, end = begin + offset, None if end is None else end + offset
+            middle = begin if end is None else (begin + end) / 2
+            if not keep_start <= middle < keep_end:
+                continue
+            if len(chunks) - boundary < 3 and _repeats(chunks[max(boundary - 3, 0) : boundary], begin, chunk):
+                continue
+            chunks.append({**chunk, "timestamp": (begin, end)})
+
+    stitched = {"text": "".join(chunk["text"] for chunk in chunks), "chunks": chunks}
+    if any("duration" in result for result in results):
+        stitched["duration"] = shards[-1].end / SAMPLING_RATE
+    if any("skipped_seconds" in result for result in results):  # Counted on the kept part of each shard
+        stitched["skipped_seconds"] = sum(
+            result.get("skipped_seconds", 0) * (shard.keep_end - shard.keep_start) / (shard.end - shard.start)
+            for result, shard in zip(results, shards)
+        )
+    if (language := results[0].get("language")) is not None:
+        stitched["language"] = language
+    if "extra" in results[0]:  # Extra decodes of the same shards
+        stitched["extra"] = [
+            stitch([result["extra"][j] for result in results], shards) for j in range(len(results[0]["extra"]))
+        ]
+    return stitched
+
+
+def _repeats(previous: List[dict], begin: float, chunk: dict) -> bool:
+    key = _key(chunk["text"])
+    return bool(key) and any(
+        _key(p["text"]) == key and begin < (p["timestamp"][1] or p["timestamp"][0]) + 0.5 for p in previous
+    )
+
+
+def _key(text: str) -> str:
+    return re.sub(r"[^\w]", "", text.lower())
+
+
+class Sharder:
+    r"""
+    Transcribes long files as shards in parallel, across the replicas of a `ReplicaPool` or the processes of a
+    `WorkerPool`, instead of one window stream. The file is decoded once into a memory-backed temp file that
+    every shard reads. Files shorter than `min_s` (or whose duration can not be told without decoding them),
+    and models that can run only one batch at a time, take the usual streaming path instead.
+
+    The stitched output follows a sequential pass: see `python benchmark.py --mode shards` for the difference on
+    a reference set, which should stay within `--shard-tolerance` of word error rate.
+    """
+
+    def __init__(
+        self,
+        shard_s: float = 600,
+        overlap_s: float = 5,
+        min_s: float | None = None,
+        shards_per_replica: int = 2,
+    ) -> None:
+        self.shard_s = shard_s
+        self.overlap_s = overlap_s
+        self.min_s = 2 * shard_s if min_s is None else min_s
+        self.shards_per_replica = shards_per_replica  # In flight, so that a replica has work as one finishes
+
+    async def run(
+        self,
+        model,
+        file: str | bytes | BinaryIO,
+        options: GenerateOptions,
+        scheduler: BatchScheduler,
+    ) -> dict:
+        loop = asyncio.get_running_loop()
+        parallelism = len(model.workers) if isinstance(model, WorkerPool) else getattr(model, "parallelism", 1)
+        duration = None
+        if parallelism >= 2 and self.min_s:
+            duration = await loop.run_in_executor(None, probe_duration, file, SAMPLING_RATE)
+        if parallelism < 2 or self.min_s and (duration is None or duration < self.min_s):  # Streamed instead
+            if isinstance(model, WorkerPool):
+                return await model.run(file, options)
+            return await scheduler.run(model, file, options)
+
+        path = await loop.run_in_executor(None, decode_to_file, file, SAMPLING_RATE)
+        try:
+            audio = np.memmap(path, dtype=np.float32, mode="r") if os.path.getsize(path) else np.empty(0)
+            if isinstance(model, WorkerPool):
+                transcribe: Callable[[Shard], Awaitable[dict]] = lambda shard: model.run_span(
+                    path, (shard.start, shard.end), options
+                )
+            else:
+                transcribe = lambda shard: scheduler.run(model, audio[shard.start : shard.end], options)
+
+            if len(audio) < self.min_s * SAMPLING_RATE:  # Shorter than its container said
+                return await transcribe(Shard(0, len(audio), 0, len(audio)))
+
+            shards = plan_shards(audio, self.shard_s, self.overlap_s)
+            language = None
+            if options.language is None and model.model_name.split(".")[-1] != "en":
+                # Detected once for the whole file, or each shard would detect its own
+                language = await self._detect_language(model, audio[: shards[0].end])
+                options = with_language(options, language)
+            slots = asyncio.Semaphore(parallelism * self.shards_per_replica)
+
+            async def run_shard(shard: Shard) -> dict:
+                async with slots:
+                    return await transcribe(shard)
+
+            tasks = [asyncio.ensure_future(run_shard(shard)) for shard in shards]
+            try:
+                results = await asyncio.gather(*tasks)
+            finally:
+                for task in tasks:  # The others, once one has failed
+                    task.cancel()
+            start = time.perf_counter()
+            result = stitch(results, shards)
+            STAGE_SECONDS.observe(time.perf_counter() - start, "merge")
+            if language is not None:
+                result["language"] = language
+            return result
+        finally:
+            os.unlink(path)  # Workers keep their mapping if they are still reading it
+
+    @staticmethod
+    async def _detect_language(model, audio: np.ndarray) -> str:
+        # On the first `--detect-language-windows` windows, 3 when Whisper would detect it in every window
+        windows = getattr(model, "language_windows", 0) or 3
+        if isinstance(model, WorkerPool):
+            probs = await model.identify_language(audio, windows)
+        else:
+            loop = asyncio.get_running_loop()
+            probs = await loop.run_in_executor(None, model.identify_language, audio, windows)
+        return max(probs, key=probs.__getitem__)
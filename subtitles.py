@@ -0,0 +1,196 @@
+import dataclasses
+import math
+import textwrap
+from typing import Iterable, Iterator, Literal
+
+# (start, end, text) in seconds
+Cue = tuple[float, float, str]
+
+SENTENCE_END = (".", "?", "!", "。", "？", "！")
+
+
+@dataclasses.dataclass(frozen=True)
+class CueOptions:
+    r"""
+    How chunks become cues. By default every chunk is one cue, as it is.
+    """
+
+    max_line_chars: int | None = None  # Wrap lines longer than this
+    max_lines: int = 2  # Lines of a merged cue
+    max_duration_s: float | None = None  # Split longer chunks, and stop merging into longer cues
+    merge_words: bool = False  # Merge (word) chunks into cues, until a limit or the end of a sentence
+
+    @property
+    def shaping(self) -> bool:
+        return self.max_line_chars is not None or self.max_duration_s is not None or self.merge_words
+
+
+class CueShaper:
+    r"""
+    Turn chunks into cues, incrementally so that it can follow a stream of chunks. Never mutates the chunks.
+    """
+
+    def __init__(self, options: CueOptions = CueOptions()) -> None:
+        self.options = options
+        self.max_chars = (options.max_line_chars or 42) * options.max_lines  # Of a merged cue
+        self.current: list[Cue] = []  # Pieces of the cue being merged
+
+    def push(self, chunk: dict) -> Iterator[Cue]:
+        start, end = chunk["timestamp"]
+        if end is None:  # Whisper did not predict an ending timestamp
+            end = start + 0.001
+        if not self.options.shaping:
+            yield start, end, chunk["text"].rstrip("\n")
+            return
+
+        for piece in self._split(start, end, chunk["text"]):
+            if not self.options.merge_words:
+                yield self._cue([piece])
+            elif self.current and not self._fits(piece):
+                yield self._cue(self.current)
+                self.current = [piece]
+            else:
+                self.current.append(piece)
+            if self.current and self.current[-1][2].rstrip().endswith(SENTENCE_END):
+                yield self._cue(self.current)
+                self.current = []
+
+    def flush(self) -> Iterator[Cue]:
+        if self.current:
+            yield self._cue(self.current)
+            self.current = []
+
+    def _split(self, start: float, end: float, text: str) -> Iterator[Cue]:
+        # Chunks longer than `max_duration_s` are cut into even parts, words spread over time
+        max_duration = self.options.max_duration_s
+        words = text.split()
+        parts = min(math.ceil((end - start) / max_duration), len(words)) if max_duration else 1
+        if parts <= 1:
+            yield start, end, text
+            return
+        for part in range(parts):
+            first, last = len(words) * part // parts, len(words) * (part + 1) // parts
+            yield (
+                start + (end - start) * first / len(words),
+                start + (end - start) * last / len(words),
+                " " + " ".join(words[first:last]),
+            )
+
+    def _fits(self, piece: Cue) -> bool:
+        max_duration = self.options.max_duration_s
+        if max_duration is not None and piece[1] - self.current[0][0] > max_duration:
+            return False
+        return sum(len(text) for _, _, text in self.current) + len(piece[2]) <= self.max_chars
+
+    def _cue(self, pieces: list[Cue]) -> Cue:
+        text = "".join(text for _, _, text in pieces).strip()
+        if self.options.max_line_chars:
+            text = "\n".join(textwrap.wrap(text, self.options.max_line_chars, break_long_words=False))
+        return pieces[0][0], pieces[-1][1], text
+
+
+def shape(chunks: Iterable[dict], options: CueOptions = CueOptions()) -> Iterator[Cue]:
+    shaper = CueShaper(options)
+    for chunk in chunks:
+        yield from shaper.push(chunk)
+    yield from shaper.flush()
+
+
+class SubtitleWriter:
+    r"""
+    Format cues as srt or vtt, one string per cue, so that it can feed a streaming response as well as a buffer.
+    """
+
+    def __init__(self, format: Literal["srt", "vtt"], options: CueOptions = CueOptions()) -> None:
+        self.format = format
+        self.shaper = CueShaper(options)
+        self.index = 0
+
+    def header(self) -> Iterator[str]:
+        if self.format == "vtt":
+            yield "WEBVTT\n\n"
+
+    def feed(self, chunks: Iterable[dict]) -> Iterator[str]:
+        for chunk in chunks:
+            yield from map(self._format, self.shaper.push(chunk))
+
+    def flush(self) -> Iterator[str]:
+        yield from map(self._format, self.shaper.flush())
+
+    def _format(self, cue: Cue) -> str:
+        self.index += 1
+        return format_cue(self.format, self.index, *cue)
+
+
+def format_cue(format: Literal["srt", "vtt"], index: int, start: float, end: float, text: str) -> str:
+    if format == "srt":
+        return "%d\n%s --> %s\n%s\n\n" % (
+            index,
+            _timestamp(start).replace(".", ","),
+            _timestamp(end).replace(".", ","),
+            text.rstrip("\n"),
+        )
+    return "%s --> %s\n%s\n\n" % (_timestamp(start), _timestamp(end), text.rstrip("\n"))
+
+
+def _timestamp(s: float) -> str:
+    # Same as `utils.timestamp`, in one formatting
+    m, s = divmod(s, 60)
+    h, m = divmod(m, 60)
+    return "%02d:%02d:%06.3f" % (h, m, s)
+
+
+def render_subtitles(
+    chunks: Iterable[dict], format: Literal["srt", "vtt"], options: CueOptions = CueOptions()
+) -> str:
+    r"""
+    The whole srt or vtt document, joined once.
+    """
+
+    if options.shaping:
+        writer = SubtitleWriter(format, options)
+        return "".join([*writer.header(), *writer.feed(chunks), *writer.flush()])
+
+    parts = ["WEBVTT\n\n"] if format == "vtt" else []
+    append = parts.append
+    for index, chunk in enumerate(chunks, start=1):  # Hot path of long word-level outputs
+        start, end = chunk["timestamp"]
+        if end is None:  # Whisper did not predict an ending timestamp
+            end = start + 0.001
+        append(format_cue(format, index, start, end, chunk["text"]))
+    return "".join(parts)
+
+
+def whisper2srt(chunks: list[dict], options: CueOptions = CueOptions()) -> str:
+    return render_subtitles(chunks, "srt", options)
+
+
+def whisper2vtt(chunks: list[dict], options: CueOptions = CueOptions()) -> str:
+    return render_subtitles(chunks, "vtt", options)
+
+
+def verbose_json(output: dict, task: str, language: str | None, words: bool = False) -> dict:
+    r"""
+    OpenAI's `verbose_json` response. Segments are the chunks, or sentences merged from them when they are words.
+    """
+
+    chunks = output["chunks"]
+    cues = shape(chunks, CueOptions(merge_words=True) if words else CueOptions())
+    result = {
+        "task": task,
+        "language": language,
+        "duration": output.get("duration"),
+        "text": output["text"],
+        "segments": [
+            {"id": index, "start": start, "end": end, "text": text}
+            for index, (start, end, text) in enumerate(cues)
+        ],
+    }
+    if words:
+        result["words"] = [
+            {"word": chunk["text"].strip(), "start": chunk["timestamp"][0], "end": chunk["timestamp"][1]}
+            for chunk in chunks
+        ]
+    if output.get("skipped_seconds") is not None:
+        result["skipped_seconds"] = output["skipped_seconds"]
+    return result
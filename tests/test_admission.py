@@ -0,0 +1,67 @@
+import asyncio
+
+import pytest
+from fastapi import HTTPException
+
+from admission import AdmissionController
+
+
+def test_requests_that_would_miss_their_deadline_are_rejected_at_once():
+    async def main():
+        admission = AdmissionController(concurrent=1)
+        admission.rtf = 1.0  # Observed: as long to process as the audio lasts
+        admission.seconds_per_byte = 1 / 1000
+        running = await admission.acquire(100_000)  # 100 s of audio
+        with pytest.raises(HTTPException) as error:
+            await admission.acquire(1000, deadline=30)
+        admission.release(running)
+        return error.value
+
+    error = asyncio.run(main())
+    assert error.status_code == 429
+    assert 90 <= int(error.headers["Retry-After"]) <= 101  # The wait estimated, rounded up
+
+
+def test_full_queue_is_rejected():
+    async def main():
+        admission = AdmissionController(concurrent=1, max_queue=2)
+        running = await admission.acquire(1000)
+        queued = [asyncio.create_task(admission.acquire(1000)) for _ in range(2)]
+        await asyncio.sleep(0)
+        with pytest.raises(HTTPException) as error:
+            await admission.acquire(1000)
+        for task in queued:
+            task.cancel()
+        await asyncio.gather(*queued, return_exceptions=True)
+        admission.release(running)
+        return error.value, admission.waiting
+
+    error, waiting = asyncio.run(main())
+    assert error.status_code == 529
+    assert "Retry-After" in error.headers
+    assert waiting == []
+
+
+def test_higher_priorities_are_admitted_ahead_of_earlier_waiters():
+    async def main():
+        admission = AdmissionController(concurrent=1)
+        running = await admission.acquire(1000)
+        admitted = []
+
+        async def request(name: str, priority: int) -> None:
+            ticket = await admission.acquire(1000, priority=priority)
+            admitted.append(name)
+            await asyncio.sleep(0)
+            admission.release(ticket)
+
+        tasks = [asyncio.create_task(request("low", 0))]
+        await asyncio.sleep(0)
+        tasks.append(asyncio.create_task(request("low again", 0)))
+        await asyncio.sleep(0)
+        tasks.append(asyncio.create_task(request("high", 1)))
+        await asyncio.sleep(0)
+        admission.release(running)
+        await asyncio.wait_for(asyncio.gather(*tasks), 5)
+        return admitted
+
+    assert asyncio.run(main()) == ["high", "low", "low again"]
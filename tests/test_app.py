@@ -0,0 +1,194 @@
+import asyncio
+import io
+
+import pytest
+from fastapi.testclient import TestClient
+from starlette.formparsers import MultiPartParser
+
+from app import _extra_decodes, create_app
+from batching import BatchScheduler
+from benchmark import StubSTT, synthetic_audio
+from cache import ResultCache
+from inference import GenerateOptions, STTArgs
+from metrics import MODEL_MEMORY, REALTIME_SESSIONS, REPLICA_QUEUE_DEPTH, REPLICA_UTILISATION
+from registry import ModelRegistry
+
+
+@pytest.fixture
+def client():
+    app = create_app(
+        {"whisper-1": StubSTT(forward_s=0, item_s=0)},
+        scheduler=BatchScheduler(max_wait=0.001),
+        cache=ResultCache(0),
+    )
+    with TestClient(app) as client:
+        yield client
+
+
+def transcribe(client: TestClient, endpoint: str = "transcriptions", **data):
+    return client.post(
+        f"/v1/audio/{endpoint}",
+        files={"file": ("audio.wav", synthetic_audio(5, 0), "audio/wav")},
+        data={"model": "whisper-1", **data},
+    )
+
+
+@pytest.mark.parametrize("endpoint", ["transcriptions", "translations"])
+def test_verbose_json_fields(client, endpoint):
+    response = transcribe(client, endpoint, response_format="verbose_json")
+    assert response.status_code == 200
+    body = response.json()
+    assert body["task"] == ("transcribe" if endpoint == "transcriptions" else "translate")
+    assert body["duration"] == pytest.approx(5, abs=0.01)
+    assert body["segments"] and body["segments"][0]["text"] == " Stub from 0.0s."
+    assert "chunks" not in body
+
+
+def test_json_fields(client):
+    response = transcribe(client, response_format="json")
+    assert response.status_code == 200
+    assert response.json()["chunks"][0]["timestamp"] == [0.0, 5.0]
+
+
+@pytest.mark.parametrize("field", ["max_line_chars", "max_cue_s"])
+@pytest.mark.parametrize("value", ["0", "-1"])
+def test_cue_options_validated(client, field, value):
+    response = transcribe(client, response_format="srt", **{field: value})
+    assert response.status_code == 400
+
+
+def test_cue_options_shape_subtitles(client):
+    response = transcribe(client, response_format="srt", max_line_chars="10", max_cue_s="2")
+    assert response.status_code == 200
+    cues = [cue.splitlines() for cue in response.text.strip().split("\n\n")]
+    assert len(cues) >= 3  # 5 s split into cues of at most 2 s
+    assert all(len(line) <= 10 for cue in cues for line in cue[2:])
+
+
+def test_collectors_are_removed_on_shutdown():
+    gauges = [REPLICA_QUEUE_DEPTH, REPLICA_UTILISATION, MODEL_MEMORY, REALTIME_SESSIONS]
+    before = [len(gauge.collectors) for gauge in gauges]
+    for _ in range(3):
+        with TestClient(create_app({"whisper-1": StubSTT()})) as client:
+            assert [len(gauge.collectors) for gauge in gauges] == [n + 1 for n in before]
+            assert "whisper_realtime_sessions 0" in client.get("/metrics").text
+    assert [len(gauge.collectors) for gauge in gauges] == before
+
+
+def test_apps_leave_the_upload_spool_size_alone():
+    spool_max_size = MultiPartParser.spool_max_size
+    create_app({"whisper-1": StubSTT()})
+    assert MultiPartParser.spool_max_size == spool_max_size  # Set once by the command line, for the process
+
+
+def test_realtime_session_cap_holds_under_concurrent_connects():
+    app = create_app({"whisper-1": StubSTT()}, realtime_sessions=1)
+    scope = {
+        "type": "websocket",
+        "asgi": {"version": "3.0"},
+        "scheme": "ws",
+        "path": "/v1/audio/realtime",
+        "raw_path": b"/v1/audio/realtime",
+        "root_path": "",
+        "query_string": b"",
+        "headers": [],
+        "server": ("testserver", 80),
+        "client": ("testclient", 1),
+        "subprotocols": [],
+    }
+
+    async def main() -> list[dict]:
+        inboxes = [asyncio.Queue() for _ in range(3)]
+        sent: list[dict] = []
+        for inbox in inboxes:
+            inbox.put_nowait({"type": "websocket.connect"})
+
+        async def send(message: dict) -> None:
+            await asyncio.sleep(0.01)  # Servers yield while sending, *e.g.* the handshake
+            sent.append(message)
+
+        tasks = [asyncio.create_task(app(dict(scope), inbox.get, send)) for inbox in inboxes]
+        await asyncio.sleep(0.2)  # All of them have connected at once
+        for inbox in inboxes:
+            inbox.put_nowait({"type": "websocket.disconnect", "code": 1000})
+        await asyncio.wait_for(asyncio.gather(*tasks, return_exceptions=True), 5)
+        return sent
+
+    sent = asyncio.run(main())
+    assert sum(m["type"] == "websocket.accept" for m in sent) == 1
+    assert sum(m["type"] == "websocket.close" and m.get("code") == 1013 for m in sent) == 2
+
+
+def test_undecodable_audio_is_a_bad_request(client):
+    response = client.post(
+        "/v1/audio/transcriptions",
+        files={"file": ("audio.wav", b"RIFF\x00\x00\x00\x00WAVEjunk", "audio/wav")},
+        data={"model": "whisper-1"},
+    )
+    assert response.status_code == 400
+
+
+class Fetcher:
+    def __init__(self, data: bytes) -> None:
+        self.data = data
+        self.files: list[io.BytesIO] = []
+
+    async def fetch(self, url: str) -> io.BytesIO:
+        self.files.append(io.BytesIO(self.data))
+        return self.files[-1]
+
+    async def close(self) -> None:
+        pass
+
+
+def test_language_detection_closes_the_audio_when_the_model_fails_to_load():
+    def loader(args, spec):
+        raise RuntimeError("Out of memory")
+
+    fetcher = Fetcher(synthetic_audio(5, 0))
+    app = create_app(ModelRegistry({"whisper-1": {}}, STTArgs(), loader=loader), fetcher=fetcher)
+    with TestClient(app, raise_server_exceptions=False) as client:
+        response = client.post("/v1/audio/language", data={"url": "https://example.com/audio.wav"})
+    assert response.status_code == 500
+    assert fetcher.files[0].closed
+
+
+def test_language_detection_of_undecodable_audio_is_a_bad_request(client):
+    response = client.post(
+        "/v1/audio/language",
+        files={"file": ("audio.wav", b"RIFF\x00\x00\x00\x00WAVEjunk", "audio/wav")},
+        data={"model": "whisper-1"},
+    )
+    assert response.status_code == 400
+
+
+def test_extra_decodes_of_the_tasks_field():
+    assert _extra_decodes(None, True, 0, "english") == ()
+    assert _extra_decodes(" Translate , transcribe:French,transcribe:de,", "word", 0.2, "english") == (
+        GenerateOptions("word", "translate", "english", None, 0.2),
+        GenerateOptions("word", "transcribe", "french", None, 0.2),  # Forced, by name or code
+        GenerateOptions("word", "transcribe", "german", None, 0.2),
+    )
+    assert _extra_decodes("translate", True, 0, None)[0].language is None  # Detected, as the main decode
+
+
+@pytest.mark.parametrize(
+    "data",
+    [{"tasks": "summarize"}, {"tasks": "translate", "response_format": "srt"}, {"tasks": "translate", "stream": "true"}],
+)
+def test_extra_decodes_are_validated(client, data):
+    assert transcribe(client, **data).status_code == 400
+
+
+class SkippingSTT(StubSTT):
+    def postprocess(self, outputs, options):
+        return {**super().postprocess(outputs, options), "skipped_seconds": 1.5}  # As VAD reports it
+
+
+@pytest.mark.parametrize("endpoint", ["transcriptions", "translations"])
+@pytest.mark.parametrize("response_format", ["json", "verbose_json"])
+def test_skipped_seconds_are_reported(endpoint, response_format):
+    app = create_app({"whisper-1": SkippingSTT(forward_s=0, item_s=0)}, cache=ResultCache(0))
+    with TestClient(app) as client:
+        response = transcribe(client, endpoint, response_format=response_format)
+    assert response.json()["skipped_seconds"] == 1.5
@@ -0,0 +1,141 @@
+import struct
+
+import numpy as np
+import pytest
+
+import audio
+from transformers.pipelines.automatic_speech_recognition import chunk_iter
+
+from audio import Resampler, chunk_windows, decode_stream, prefetch, resample
+
+
+def sine(frequency: float, seconds: float, rate: int) -> np.ndarray:
+    return (0.5 * np.sin(2 * np.pi * frequency * np.arange(int(seconds * rate)) / rate)).astype(np.float32)
+
+
+def wav(
+    samples: np.ndarray, rate: int, tag: int = 1, bits: int = 16, channels: int = 1, extra: bytes = b""
+) -> bytes:
+    r"""
+    A WAV of `samples` in the given encoding, `extra` chunks between its format and its data.
+    """
+
+    frames = np.repeat(samples[:, None], channels, axis=1).reshape(-1)
+    if tag == 3:
+        data = frames.astype(f"<f{bits // 8}").tobytes()
+    elif bits == 8:
+        data = np.round(frames * 127 + 128).astype(np.uint8).tobytes()
+    elif bits == 24:
+        data = np.round(frames * (2**23 - 1)).astype("<i4").view(np.uint8).reshape(-1, 4)[:, :3].tobytes()
+    else:
+        data = np.round(frames * (2 ** (bits - 1) - 1)).astype(f"<i{bits // 8}").tobytes()
+    fmt = struct.pack("<HHIIHH", tag, channels, rate, rate * channels * bits // 8, channels * bits // 8, bits)
+    body = b"WAVE" + chunk(b"fmt ", fmt) + extra + chunk(b"data", data)
+    return b"RIFF" + struct.pack("<I", len(body)) + body
+
+
+def chunk(name: bytes, body: bytes) -> bytes:
+    return name + struct.pack("<I", len(body)) + body + bytes(len(body) % 2)
+
+
+def decode(data: bytes, block_s: float = 5) -> np.ndarray:
+    return np.concatenate(list(decode_stream(data, 16000, block_s)))
+
+
+def peak_frequency(samples: np.ndarray, rate: int) -> float:
+    spectrum = np.abs(np.fft.rfft(samples * np.hanning(len(samples))))
+    return np.fft.rfftfreq(len(samples), 1 / rate)[np.argmax(spectrum)]
+
+
+@pytest.mark.parametrize("orig_rate", [8000, 22050, 44100, 48000])
+def test_resampled_sine_keeps_its_frequency_and_duration(orig_rate):
+    resampled = resample(sine(440, 2, orig_rate), orig_rate, 16000)
+    assert abs(len(resampled) - 32000) <= 1
+    assert peak_frequency(resampled, 16000) == pytest.approx(440, abs=1)
+    assert np.abs(resampled[1000:-1000]).max() == pytest.approx(0.5, abs=0.01)
+
+
+def test_tones_above_the_new_nyquist_frequency_are_filtered_out():
+    resampled = resample(sine(10000, 1, 44100), 44100, 16000)  # Would alias to 6 kHz
+    assert np.abs(resampled[500:-500]).max() < 0.01
+
+
+def test_chunked_resampling_matches_one_shot():
+    samples = np.random.default_rng(0).normal(0, 0.1, 44100 * 3).astype(np.float32)
+    resampler = Resampler(44100, 16000)
+    sizes = [1, 7, 1000, 4410, 44100, 3, 30000]
+    blocks, start = [], 0
+    for size in sizes + [len(samples)]:
+        blocks.append(resampler(samples[start : start + size]))
+        start += size
+    chunked = np.concatenate(blocks + [resampler.flush()])
+    np.testing.assert_allclose(chunked, resample(samples, 44100, 16000), atol=1e-6)
+
+
+@pytest.mark.parametrize(
+    "tag, bits, tolerance",
+    [(1, 8, 1e-2), (1, 16, 1e-4), (1, 24, 1e-6), (1, 32, 1e-6), (3, 32, 0), (3, 64, 1e-7)],
+)
+def test_wav_encodings(tag, bits, tolerance):
+    samples = sine(440, 1, 16000)
+    np.testing.assert_allclose(decode(wav(samples, 16000, tag, bits)), samples, atol=tolerance + 1e-7)
+
+
+def test_wav_channels_are_mixed_down_and_resampled():
+    decoded = decode(wav(sine(440, 2, 44100), 44100, channels=2), block_s=0.5)
+    assert abs(len(decoded) - 32000) <= 1
+    assert peak_frequency(decoded, 16000) == pytest.approx(440, abs=1)
+
+
+def test_wav_chunks_before_the_data_are_skipped():
+    samples = sine(440, 1, 16000)
+    extra = chunk(b"LIST", b"INFO1") + chunk(b"fact", struct.pack("<I", 16000))  # Odd sized, then padded
+    np.testing.assert_allclose(decode(wav(samples, 16000, extra=extra)), samples, atol=1e-4)
+
+
+def test_blocks_are_full_but_the_last():
+    blocks = list(decode_stream(wav(sine(440, 2.5, 16000), 16000), 16000, block_s=1))
+    assert [len(block) for block in blocks] == [16000, 16000, 8000]
+
+
+def test_other_formats_fall_back_to_ffmpeg(monkeypatch):
+    calls = []
+
+    def ffmpeg_stream(source, sampling_rate, block_s=5):
+        calls.append(source)
+        yield np.zeros(16000, dtype=np.float32)
+
+    monkeypatch.setattr(audio, "av", None)
+    monkeypatch.setattr(audio, "ffmpeg_stream", ffmpeg_stream)
+    ogg = b"OggS" + bytes(100)
+    assert len(decode(ogg)) == 16000
+    assert calls == [ogg]
+    assert len(decode(wav(sine(440, 1, 16000), 16000, tag=6, bits=8))) == 16000  # A-law, left to ffmpeg
+    assert len(calls) == 2
+
+
+class Samples:
+    r"""
+    Feature extractor stand-in for `chunk_iter`: the features of a window are its samples.
+    """
+
+    sampling_rate = 16000
+
+    def __call__(self, chunk: np.ndarray, **kwargs) -> dict:
+        return {"samples": chunk}
+
+
+@pytest.mark.parametrize("length", [0, 1, 999, 1000, 1001, 2999, 3000, 3001, 5000, 5001, 12345])
+@pytest.mark.parametrize("block", [1, 700, 1000, 4096])
+def test_windows_match_the_pipeline(length, block):
+    samples = np.random.default_rng(length).normal(0, 0.1, length).astype(np.float32)
+    expected = [
+        (window["samples"], window["stride"], window["is_last"])
+        for window in chunk_iter(samples, Samples(), 3000, 1000, 1000)
+    ]
+    blocks = [samples[i : i + block] for i in range(0, length, block)]
+    streamed = chunk_windows(blocks, 3000, 1000, 1000)
+    for windows in (list(streamed), list(prefetch(chunk_windows(blocks, 3000, 1000, 1000), 2))):
+        assert [(stride, is_last) for _, stride, is_last in windows] == [(s, last) for _, s, last in expected]
+        for (window, _, _), (reference, _, _) in zip(windows, expected):
+            np.testing.assert_array_equal(window, reference)
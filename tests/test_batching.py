@@ -0,0 +1,174 @@
+import asyncio
+import time
+
+import pytest
+
+from batching import BatchScheduler
+from benchmark import StubSTT, synthetic_audio
+from inference import GenerateOptions
+
+
+class Recorder:
+    r"""
+    Model stub that records the batches it runs, each output naming its item and options.
+    """
+
+    batch_size = 4
+    sampling_rate = 16000
+    parallelism = 1
+
+    def __init__(self, forward_s: float = 0) -> None:
+        self.forward_s = forward_s
+        self.batches: list[list[int]] = []
+
+    def forward(self, items: list[dict], options: GenerateOptions) -> list[dict]:
+        self.batches.append([item["id"] for item in items])
+        time.sleep(self.forward_s)
+        return [{"id": item["id"], "task": options.task} for item in items]
+
+
+def run(main):
+    async def wrapped():
+        scheduler = BatchScheduler(max_wait=0.05)
+        try:
+            return await asyncio.wait_for(main(scheduler), 5)  # Fails instead of stalling
+        finally:
+            await scheduler.close()
+
+    return asyncio.run(wrapped())
+
+
+def test_concurrent_items_share_batches_up_to_the_limit():
+    model = Recorder()
+
+    async def main(scheduler):
+        futures = [scheduler.submit(model, {"id": i}, GenerateOptions()) for i in range(10)]
+        return await asyncio.gather(*futures)
+
+    outputs = run(main)
+    assert [output["id"] for output in outputs] == list(range(10))
+    assert model.batches == [[0, 1, 2, 3], [4, 5, 6, 7], [8, 9]]
+
+
+def test_options_are_batched_apart_and_routed_back():
+    model = Recorder()
+    transcribe, translate = GenerateOptions(), GenerateOptions(task="translate")
+
+    async def main(scheduler):
+        futures = [scheduler.submit(model, {"id": i}, translate if i % 2 else transcribe) for i in range(6)]
+        return await asyncio.gather(*futures)
+
+    outputs = run(main)
+    assert [(o["id"], o["task"]) for o in outputs] == [
+        (i, "translate" if i % 2 else "transcribe") for i in range(6)
+    ]
+    assert sorted(model.batches) == [[0, 2, 4], [1, 3, 5]]
+
+
+def test_partial_batch_is_flushed_after_max_wait():
+    model = Recorder()
+
+    async def main(scheduler):
+        start = time.perf_counter()
+        output = await scheduler.submit(model, {"id": 0}, GenerateOptions())
+        return output, time.perf_counter() - start
+
+    output, waited = run(main)
+    assert output["id"] == 0
+    assert 0.04 <= waited < 1
+    assert model.batches == [[0]]
+
+
+def test_cancelled_items_are_dropped_without_stalling():
+    model = Recorder()
+
+    async def main(scheduler):
+        futures = [scheduler.submit(model, {"id": i}, GenerateOptions()) for i in range(3)]
+        futures[1].cancel()  # Its client has gone before the batch formed
+        return await asyncio.gather(futures[0], futures[2])
+
+    outputs = run(main)
+    assert [output["id"] for output in outputs] == [0, 2]
+    assert model.batches == [[0, 2]]
+
+
+def test_concurrent_files_get_their_own_transcriptions():
+    model = StubSTT(batch_size=8, chunk_length_s=5, forward_s=0, item_s=0)
+    durations = [12, 30, 7]
+
+    async def main(scheduler):
+        files = [synthetic_audio(seconds, seed) for seed, seconds in enumerate(durations)]
+        return await asyncio.gather(*(scheduler.run(model, file, GenerateOptions()) for file in files))
+
+    results = run(main)
+    assert [result["duration"] for result in results] == pytest.approx(durations, abs=0.01)
+    for result, seconds in zip(results, durations):
+        assert result["chunks"][-1]["timestamp"][1] == pytest.approx(seconds, abs=0.01)
+
+
+def test_forward_errors_reach_every_caller():
+    class Failing(Recorder):
+        def forward(self, items, options):
+            raise RuntimeError("boom")
+
+    model = Failing()
+
+    async def main(scheduler):
+        futures = [scheduler.submit(model, {"id": i}, GenerateOptions()) for i in range(2)]
+        return await asyncio.gather(*futures, return_exceptions=True)
+
+    assert all(isinstance(error, RuntimeError) for error in run(main))
+
+
+def test_stream_chunks_merges_each_window_a_bounded_number_of_times():
+    class Counting(StubSTT):
+        def postprocess(self, outputs, options):
+            sizes.append(len(outputs))
+            return super().postprocess(outputs, options)
+
+    sizes: list[int] = []
+    model = Counting(batch_size=8, chunk_length_s=5, forward_s=0, item_s=0)
+    file = synthetic_audio(120, 0)
+
+    async def main(scheduler):
+        options = GenerateOptions()
+        streamed = [chunk async for chunks in scheduler.stream_chunks(model, file, options) for chunk in chunks]
+        return streamed, await scheduler.run(model, file, options)
+
+    streamed, result = run(main)
+    # The stub names chunks by their offset in what it merges, only the timestamps tell where they are
+    times = [t for c in streamed for t in c["timestamp"]]
+    assert times == pytest.approx([t for c in result["chunks"] for t in c["timestamp"]], abs=0.01)
+    windows = sizes.pop()  # The one of `run`
+    assert len(sizes) == windows > 30
+    assert max(sizes) <= 2  # Not every window so far
+
+
+def test_cancelled_stream_closes_the_decoder_it_was_waiting_on():
+    model = Recorder()
+    closed = []
+
+    def preprocess(file):
+        try:
+            for i in range(10):
+                time.sleep(0.1)  # Decoding, when the client goes
+                yield {"id": i}
+        finally:
+            closed.append(True)
+
+    model.preprocess = preprocess
+
+    async def main(scheduler):
+        async def consume():
+            async for _ in scheduler.stream(model, None, GenerateOptions()):
+                pass
+
+        task = asyncio.create_task(consume())
+        await asyncio.sleep(0.25)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+        await asyncio.sleep(0.3)  # The window being decoded
+        return closed
+
+    assert run(main) == [True]
@@ -0,0 +1,53 @@
+import torch
+
+from batchsize import BatchSizer, is_out_of_memory
+
+SHAPE = "segment,beams=1,decodes=1"
+
+
+def test_out_of_memory_errors():
+    assert is_out_of_memory(MemoryError())
+    assert is_out_of_memory(torch.cuda.OutOfMemoryError("CUDA out of memory. Tried to allocate 2.00 GiB"))
+    assert is_out_of_memory(RuntimeError("[enforce fail at alloc_cpu.cpp:117] DefaultCPUAllocator: can't allocate memory"))
+    assert not is_out_of_memory(RuntimeError("Expected all tensors to be on the same device"))
+    assert not is_out_of_memory(ValueError("out of memory"))
+
+
+def test_failure_halves_the_limit():
+    sizer = BatchSizer(16)
+    assert sizer.failed(SHAPE, 16) == 8
+    assert sizer.failed(SHAPE, 8) == 4
+    assert sizer.failed(SHAPE, 1) == 1
+    assert sizer.limits() == {SHAPE: 1}
+    assert sizer.limit("word,beams=1,decodes=1") == 16  # Shapes learn apart
+
+
+def test_limit_grows_by_a_quarter_after_a_streak():
+    sizer = BatchSizer(16, maximum=32, probe_after=3)
+    sizer.failed(SHAPE, 16)
+    assert [sizer.succeeded(SHAPE, 8, lambda: True) for _ in range(3)] == [None, None, 10]
+    assert sizer.limit(SHAPE) == 10
+    assert sizer.succeeded(SHAPE, 4, lambda: True) is None  # Smaller batches do not count
+
+
+def test_no_probe_without_free_memory():
+    sizer = BatchSizer(8, maximum=32, probe_after=1)
+    assert sizer.succeeded(SHAPE, 8, lambda: False) is None
+    assert sizer.limit(SHAPE) == 8
+
+
+def test_failed_probe_backs_off():
+    sizer = BatchSizer(8, maximum=32, probe_after=2)
+    for _ in range(2):
+        probe = sizer.succeeded(SHAPE, 8, lambda: True)
+    assert probe == 10
+    assert sizer.failed(SHAPE, 10) == 8  # Back to the size that ran, not halved
+    assert [sizer.succeeded(SHAPE, 8, lambda: True) for _ in range(4)] == [None, None, None, 10]  # Twice the wait
+
+
+def test_maximum_and_sizes():
+    sizer = BatchSizer(8, maximum=8, probe_after=1)
+    assert sizer.succeeded(SHAPE, 8, lambda: True) is None
+    bucketed = BatchSizer(16, maximum=32, probe_after=1, sizes=[1, 2, 4, 8, 16, 32])
+    assert bucketed.failed(SHAPE, 12) == 4  # Snapped to a compiled bucket
+    assert bucketed.succeeded(SHAPE, 4, lambda: True) == 8
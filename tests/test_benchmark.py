@@ -0,0 +1,42 @@
+import json
+import os
+import subprocess
+import sys
+
+import pytest
+
+from benchmark import StubSTT, synthetic_audio
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def test_stub_generates_like_stt():
+    # `StubSTT` borrows `STT.generate`, every attribute it reads must exist on the stub too
+    result = StubSTT(forward_s=0, item_s=0).generate(synthetic_audio(5, 0))
+    assert result["text"].startswith(" Stub from 0.0s.")
+    assert result["duration"] == pytest.approx(5, abs=0.01)
+
+
+@pytest.mark.parametrize("mode", ["engine", "http"])
+def test_stub_benchmark_runs(mode, tmp_path):
+    output = tmp_path / "results.json"
+    subprocess.run(
+        [
+            sys.executable,
+            "benchmark.py",
+            "--stub",
+            *("--mode", mode),
+            *("--requests", "2"),
+            *("--audio-mix", "5:1"),
+            *("--stub-forward-ms", "0", "--stub-item-ms", "0"),
+            *("--warmup-requests", "0"),
+            *("--output", str(output)),
+        ],
+        cwd=ROOT,
+        check=True,
+        capture_output=True,
+        timeout=300,
+    )
+    results = json.loads(output.read_text())
+    assert results["requests"] == 2
+    assert results["errors"] == 0
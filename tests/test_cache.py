@@ -0,0 +1,99 @@
+import asyncio
+import json
+
+import pytest
+
+from cache import ResultCache
+
+
+class Compute:
+    r"""
+    Inference stand-in: counts its calls, each takes `seconds` and returns its number.
+    """
+
+    def __init__(self, seconds: float = 0.05) -> None:
+        self.seconds = seconds
+        self.calls = 0
+
+    async def __call__(self) -> dict:
+        self.calls += 1
+        call = self.calls
+        await asyncio.sleep(self.seconds)
+        return {"text": f"call {call}"}
+
+
+def test_identical_requests_in_flight_share_one_inference():
+    async def main():
+        cache, compute = ResultCache(), Compute()
+        outputs = await asyncio.gather(*(cache.get_or_compute("key", compute) for _ in range(8)))
+        return outputs, compute.calls
+
+    outputs, calls = asyncio.run(main())
+    assert calls == 1
+    assert outputs == [{"text": "call 1"}] * 8
+
+
+def test_waiters_retry_when_the_leader_is_cancelled():
+    async def main():
+        cache, compute = ResultCache(), Compute()
+        leader = asyncio.create_task(cache.get_or_compute("key", compute))
+        await asyncio.sleep(0.01)
+        waiter = asyncio.create_task(cache.get_or_compute("key", compute))
+        await asyncio.sleep(0.01)
+        leader.cancel()  # Its client has gone
+        with pytest.raises(asyncio.CancelledError):
+            await leader
+        return await waiter, compute.calls, cache.inflight
+
+    output, calls, inflight = asyncio.run(main())
+    assert output == {"text": "call 2"}  # Computed again by the waiter
+    assert calls == 2
+    assert inflight == {}
+
+
+def test_errors_reach_the_waiters_and_are_not_cached():
+    async def main():
+        cache, calls = ResultCache(), []
+
+        async def compute():
+            calls.append(1)
+            await asyncio.sleep(0.01)
+            raise ValueError("Invalid data found when processing input")
+
+        outputs = await asyncio.gather(
+            *(cache.get_or_compute("key", compute) for _ in range(3)), return_exceptions=True
+        )
+        assert all(isinstance(output, ValueError) for output in outputs)
+        assert await cache.get("key") is None
+        return len(calls)
+
+    assert asyncio.run(main()) == 1
+
+
+def test_least_recently_used_entries_are_evicted_past_max_bytes():
+    async def main():
+        size = len(json.dumps({"text": "call 1"}).encode())
+        cache, compute = ResultCache(max_bytes=2 * size), Compute(0)
+        await cache.get_or_compute("a", compute)
+        await cache.get_or_compute("b", compute)
+        await cache.get("a")  # Most recently used now
+        await cache.get_or_compute("c", compute)
+        return list(cache.entries), cache.size, size
+
+    keys, used, size = asyncio.run(main())
+    assert keys == ["a", "c"]
+    assert used == 2 * size
+
+
+def test_disk_tier_round_trip(tmp_path):
+    async def main():
+        compute = Compute(0)
+        first = ResultCache(directory=str(tmp_path))
+        output = await first.get_or_compute("key", lambda: compute())
+        second = ResultCache(directory=str(tmp_path))  # *e.g.* after a restart
+        assert await second.get("key") == output
+        assert await ResultCache(0, str(tmp_path)).get_or_compute("key", compute) == output
+        return compute.calls
+
+    assert asyncio.run(main()) == 1
+    assert [path.name for path in tmp_path.rglob("*") if path.is_file()] == ["key.json"]
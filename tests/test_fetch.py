@@ -0,0 +1,123 @@
+import asyncio
+import http.server
+import threading
+import time
+
+import pytest
+from fastapi import HTTPException
+
+from fetch import URLFetcher
+
+BODY = b"RIFF" + bytes(1000)
+
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # Keep-alive, so that connections can be reused
+    connections: list = []  # Client address of each request
+
+    def do_GET(self) -> None:
+        Handler.connections.append(self.client_address)
+        if self.path == "/audio":
+            self._send(200, BODY)
+        elif self.path == "/unsized":  # No content-length, the size is only known while reading
+            self.send_response(200)
+            self.send_header("Transfer-Encoding", "chunked")
+            self.end_headers()
+            for _ in range(4):
+                self.wfile.write(b"%x\r\n%s\r\n" % (len(BODY), BODY))
+            self.wfile.write(b"0\r\n\r\n")
+        elif self.path == "/slow":
+            time.sleep(1)
+            self._send(200, BODY)
+        else:
+            self._send(404, b"Not found")
+
+    def _send(self, code: int, body: bytes) -> None:
+        self.send_response(code)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args) -> None:
+        pass
+
+
+@pytest.fixture(scope="module")
+def server():
+    httpd = http.server.ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{httpd.server_address[1]}"
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def fetch(*urls: str, **kwargs) -> list:
+    async def main() -> list:
+        fetcher = URLFetcher(**kwargs)
+        try:
+            return [await fetcher.fetch(url) for url in urls]
+        finally:
+            await fetcher.close()
+
+    return asyncio.run(main())
+
+
+def test_download(server):
+    (file,) = fetch(f"{server}/audio")
+    assert file.read() == BODY
+
+
+@pytest.mark.parametrize("path", ["/audio", "/unsized"])
+def test_size_limit(server, path):
+    with pytest.raises(HTTPException) as raised:
+        fetch(f"{server}{path}", max_bytes=len(BODY) - 1 if path == "/audio" else 2 * len(BODY))
+    assert raised.value.status_code == 413
+
+
+def test_timeout(server):
+    start = time.perf_counter()
+    with pytest.raises(HTTPException) as raised:
+        fetch(f"{server}/slow", timeout=0.2)
+    assert raised.value.status_code == 400
+    assert time.perf_counter() - start < 1
+
+
+def test_error_status_is_a_bad_request(server):
+    with pytest.raises(HTTPException) as raised:
+        fetch(f"{server}/missing")
+    assert raised.value.status_code == 400
+    assert "404" in raised.value.detail
+
+
+@pytest.mark.parametrize("url", ["ftp://example.com/a.wav", "file:///etc/passwd", "not a url"])
+def test_only_http_urls(url):
+    with pytest.raises(HTTPException) as raised:
+        fetch(url)
+    assert raised.value.status_code == 400
+
+
+def test_connections_are_reused(server):
+    Handler.connections.clear()
+    files = fetch(*[f"{server}/audio"] * 3)
+    assert [file.read() for file in files] == [BODY] * 3
+    assert len(Handler.connections) == 3
+    assert len(set(Handler.connections)) == 1  # One client port: one connection
+
+
+def test_idle_hosts_are_forgotten(server):
+    async def main():
+        fetcher = URLFetcher(per_host=1)
+        try:
+            first = asyncio.create_task(fetcher.fetch(f"{server}/slow"))
+            await asyncio.sleep(0.1)
+            second = asyncio.create_task(fetcher.fetch(f"{server}/audio"))
+            await asyncio.sleep(0.1)
+            assert list(fetcher.hosts) == ["127.0.0.1"]
+            assert not second.done()  # Waits for the host
+            await asyncio.gather(first, second)
+            return fetcher.hosts
+        finally:
+            await fetcher.close()
+
+    assert asyncio.run(main()) == {}
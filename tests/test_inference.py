@@ -0,0 +1,204 @@
+import threading
+
+import pytest
+import torch
+
+from batchsize import BatchSizer
+from inference import STT, GenerateOptions, batch_buckets, warmup_batch_sizes
+
+
+class FakeSTT(STT):
+    r"""
+    `STT.forward` over a fake `_forward` that runs out of memory above `capacity` windows.
+    """
+
+    def __init__(
+        self,
+        capacity: int,
+        batch_size: int = 16,
+        error: type = torch.cuda.OutOfMemoryError,
+        probe_after: int = 50,
+    ) -> None:
+        self.model_name = "fake"
+        self.device = "cpu"
+        self.sizer = BatchSizer(batch_size, 2 * batch_size, probe_after)
+        self.capacity = capacity
+        self.error = error
+        self.calls: list[int] = []
+
+    def _forward(self, items: list[dict], options: GenerateOptions) -> list[dict]:
+        self.calls.append(len(items))
+        if len(items) > self.capacity:
+            raise self.error("CUDA out of memory. Tried to allocate 2.00 GiB")
+        return [{"index": item["index"]} for item in items]
+
+
+def items(n: int) -> list[dict]:
+    return [{"index": i} for i in range(n)]
+
+
+@pytest.mark.parametrize("error", [torch.cuda.OutOfMemoryError, MemoryError])
+def test_out_of_memory_splits_and_retries(error):
+    stt = FakeSTT(capacity=5, error=error)
+    outputs = stt.forward(items(16), GenerateOptions())
+    assert [output["index"] for output in outputs] == list(range(16))
+    assert stt.calls[:3] == [16, 8, 4]  # Halved until it fits
+    assert stt.batch_limit(GenerateOptions()) == 4
+
+
+def test_later_batches_start_at_the_limit():
+    stt = FakeSTT(capacity=5)
+    stt.forward(items(16), GenerateOptions())
+    stt.calls.clear()
+    outputs = stt.forward(items(10), GenerateOptions())
+    assert [output["index"] for output in outputs] == list(range(10))
+    assert stt.calls == [4, 4, 2]  # Split up front, no failure
+
+
+def test_limit_probes_upward_carefully():
+    stt = FakeSTT(capacity=5, probe_after=2)
+    options = GenerateOptions()
+    stt.forward(items(8), options)
+    assert stt.calls == [8, 4, 4]
+    assert stt.batch_limit(options) == 5  # Two full batches of 4 ran: grows by a quarter, not doubled
+    stt.forward(items(10), options)
+    assert stt.batch_limit(options) == 6
+    stt.calls.clear()
+    outputs = stt.forward(items(6), options)
+    assert [output["index"] for output in outputs] == list(range(6))
+    assert stt.calls == [6, 3, 3]
+    assert stt.batch_limit(options) == 5  # A failed probe goes back to what ran, not halved
+
+
+def test_shapes_learn_apart():
+    stt = FakeSTT(capacity=5)
+    stt.forward(items(16), GenerateOptions())
+    assert stt.batch_limit(GenerateOptions(timestamp="word")) == 16
+
+
+def test_other_errors_are_raised():
+    stt = FakeSTT(capacity=5, error=ValueError)
+    with pytest.raises(ValueError):
+        stt.forward(items(8), GenerateOptions())
+    assert stt.calls == [8]
+
+
+def test_a_single_window_that_does_not_fit_is_raised():
+    stt = FakeSTT(capacity=0)
+    with pytest.raises(torch.cuda.OutOfMemoryError):
+        stt.forward(items(2), GenerateOptions())
+    assert stt.calls == [2, 1]
+
+
+class StubEncoder:
+    def __init__(self) -> None:
+        self.calls = 0
+
+    def __call__(self, features: torch.Tensor) -> torch.Tensor:
+        self.calls += 1
+        return 2 * features
+
+
+class StubModel:
+    device = torch.device("cpu")
+    dtype = torch.float32
+
+    def __init__(self) -> None:
+        self.encoder = StubEncoder()
+
+    def get_encoder(self) -> StubEncoder:
+        return self.encoder
+
+
+class StubPipeline:
+    r"""
+    Stand-in for the transformers pipeline: a window "decodes" to the sum of its encoded features, plus 1000
+    when translated.
+    """
+
+    def __init__(self) -> None:
+        self.batches: list[int] = []
+        self.model = StubModel()
+
+    def forward(self, batch: dict, task: str = "transcribe", encoder_outputs=None) -> dict:
+        self.batches.append(len(batch["input_features"]))
+        if encoder_outputs is None:
+            encoder_outputs = self.model.get_encoder()(batch["input_features"])
+        tokens = encoder_outputs.sum(-1) + (1000 if task == "translate" else 0)
+        return {"tokens": tokens, "stride": batch["stride"]}
+
+
+class PipelineSTT(STT):
+    r"""
+    `STT._forward` with `--compile` buckets, over `StubPipeline`.
+    """
+
+    def __init__(self, batch_size: int) -> None:
+        self.model_name = "stub"
+        self.device = "cpu"
+        self.buckets = batch_buckets(batch_size)
+        self.sizer = BatchSizer(batch_size, sizes=self.buckets)
+        self.assistant = None
+        self.timing = threading.local()
+        self.pipe = StubPipeline()
+
+    def pipeline_params(self, options: GenerateOptions) -> tuple[dict, dict]:
+        return {"task": options.task}, {}
+
+    @staticmethod
+    def collate(inputs: list[dict]) -> dict:
+        return {
+            "input_features": torch.cat([i["input_features"] for i in inputs]),
+            "stride": [i["stride"] for i in inputs],
+        }
+
+
+def windows(n: int) -> list[dict]:
+    return [
+        {"input_features": torch.full((1, 4), float(i)), "stride": (i, 0, 0), "is_last": False, "samples": i}
+        for i in range(n)
+    ]
+
+
+@pytest.mark.parametrize("n", [1, 3, 5, 8])
+def test_batches_padded_to_a_bucket_return_their_items(n):
+    stt = PipelineSTT(batch_size=8)
+    outputs = stt.forward(windows(n), GenerateOptions())
+    assert stt.pipe.batches == [min(b for b in stt.buckets if b >= n)]
+    assert [output["tokens"].tolist() for output in outputs] == [[8.0 * i] for i in range(n)]
+    assert [output["stride"] for output in outputs] == [(i, 0, 0) for i in range(n)]
+    assert [output["samples"] for output in outputs] == list(range(n))  # Passed through
+
+
+def test_warmup_batch_sizes():
+    assert warmup_batch_sizes("1,8,max", 16) == [1, 8, 16]
+    assert warmup_batch_sizes("all", 12) == [1, 2, 4, 8, 12]
+    assert warmup_batch_sizes(" 4, 64 ,", 16) == [4, 16]  # Clamped to the batch size
+    assert warmup_batch_sizes("0", 16) == []
+    with pytest.raises(ValueError):
+        warmup_batch_sizes("eight", 16)
+
+
+def test_limits_snap_to_buckets():
+    stt = FakeSTT(capacity=5, batch_size=12)
+    stt.sizer = BatchSizer(12, 24, sizes=batch_buckets(24))
+    outputs = stt.forward(items(12), GenerateOptions())
+    assert [output["index"] for output in outputs] == list(range(12))
+    assert stt.calls == [12, 4, 2, 4, 2]  # Halves run in parts of the limit
+    assert stt.batch_limit(GenerateOptions()) == 4  # Not 6, which has no compiled graph
+
+
+def test_extra_decodes_share_the_encoder_pass_and_match_separate_decodes():
+    stt = PipelineSTT(batch_size=4)
+    translate = GenerateOptions(task="translate")
+    outputs = stt.forward(windows(3), GenerateOptions(extra_decodes=(translate,)))
+    assert stt.pipe.model.encoder.calls == 1
+
+    separate = PipelineSTT(batch_size=4)
+    transcribed = separate.forward(windows(3), GenerateOptions())
+    translated = separate.forward(windows(3), translate)
+    assert separate.pipe.model.encoder.calls == 2
+    for output, alone, extra in zip(outputs, transcribed, translated):
+        assert output["tokens"].tolist() == alone["tokens"].tolist()
+        assert [e["tokens"].tolist() for e in output["extra"]] == [extra["tokens"].tolist()]
+        assert output["extra"][0]["stride"] == extra["stride"]
@@ -0,0 +1,55 @@
+import asyncio
+import json
+
+from benchmark import synthetic_audio
+from jobs import BatchJob, JobItem
+
+
+def manifest(tmp_path, count: int) -> list[str]:
+    for i in range(count):
+        (tmp_path / f"{i}.wav").write_bytes(synthetic_audio(1 + i, i))
+    return [json.dumps({"id": str(i), "file": f"{i}.wav"}) for i in range(count)]
+
+
+def records(job: BatchJob) -> list[dict]:
+    with open(job.output) as f:
+        return [json.loads(line) for line in f]
+
+
+def test_resumed_job_keeps_one_record_per_item(tmp_path):
+    job = BatchJob.create(str(tmp_path / "job"), manifest(tmp_path, 6), str(tmp_path))
+    finished = asyncio.Event()
+
+    async def first(item: JobItem) -> dict:
+        if item.id == "5":
+            raise RuntimeError("Out of memory")
+        if item.id in ("3", "4"):  # Still running when the job is killed
+            finished.set()
+            await asyncio.sleep(60)
+        return {"text": item.id, "chunks": []}
+
+    async def kill():
+        run = asyncio.create_task(job.run(first, concurrency=2))
+        await finished.wait()
+        await asyncio.sleep(0.1)
+        run.cancel()
+        await asyncio.gather(run, return_exceptions=True)
+
+    asyncio.run(kill())
+    assert {r["id"]: r["status"] for r in records(job)} == {"5": "failed"}
+
+    transcribed = []
+
+    async def second(item: JobItem) -> dict:
+        transcribed.append(item.id)
+        return {"text": item.id, "chunks": []}
+
+    resumed = BatchJob(str(tmp_path / "job"))
+    assert resumed.items["5"].duration == 6  # Probed by the first run
+    asyncio.run(resumed.run(second))
+    assert sorted(transcribed) == ["0", "1", "2", "3", "4", "5"]
+    assert resumed.status == "completed"
+    lines = records(resumed)
+    assert sorted(r["id"] for r in lines) == ["0", "1", "2", "3", "4", "5"]
+    assert all(r["status"] == "completed" and r["response"]["text"] == r["id"] for r in lines)
+    assert all(r["duration"] == int(r["id"]) + 1 for r in lines)
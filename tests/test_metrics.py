@@ -0,0 +1,38 @@
+import pytest
+
+import metrics
+from metrics import Counter, Gauge, Histogram
+
+
+@pytest.fixture
+def remote(monkeypatch):
+    monkeypatch.setattr(metrics, "REMOTE", {})
+    monkeypatch.setattr(metrics, "REGISTRY", [])
+    return metrics.REMOTE
+
+
+def test_gauges_of_several_processes_take_the_highest(remote):
+    peak = Gauge("test_peak_bytes", "Peak", ["device"])
+    peak.set(100, "cuda:0")
+    remote["worker-0:1"] = {"test_peak_bytes": {("cuda:0",): 300, ("cuda:1",): 50}}
+    remote["worker-1:2"] = {"test_peak_bytes": {("cuda:0",): 200}}
+    assert peak.render()[2:] == ['test_peak_bytes{device="cuda:0"} 300', 'test_peak_bytes{device="cuda:1"} 50']
+
+
+def test_retired_processes_keep_their_counts_and_drop_their_gauges(remote):
+    peak = Gauge("test_peak_bytes", "Peak", ["device"])
+    seconds = Counter("test_seconds_total", "Seconds")
+    latency = Histogram("test_latency_seconds", "Latency", buckets=(1,))
+    for pid in (1, 2):  # A worker, and the one started when it crashed
+        remote[f"worker-0:{pid}"] = {
+            "test_peak_bytes": {("cuda:0",): 100 * pid},
+            "test_seconds_total": {(): 10.0},
+            "test_latency_seconds": {(): [[1, 0], 0.5]},
+        }
+        metrics.retire(f"worker-0:{pid}")
+    remote["worker-0:3"] = {"test_peak_bytes": {("cuda:0",): 50}, "test_seconds_total": {(): 1.0}}
+
+    assert peak.render()[2:] == ['test_peak_bytes{device="cuda:0"} 50']
+    assert seconds.render()[2:] == ["test_seconds_total 21.0"]
+    assert latency.render()[-2:] == ["test_latency_seconds_sum 1.0", "test_latency_seconds_count 2"]
+    assert list(remote) == [metrics.RETIRED, "worker-0:3"]
@@ -0,0 +1,117 @@
+import asyncio
+import threading
+import time
+
+import pytest
+
+from batching import BatchScheduler
+from batchsize import BatchSizer
+from inference import GenerateOptions
+from pool import ReplicaPool
+
+
+class Replica:
+    r"""
+    CPU stand-in for an `STT` replica: its forward passes wait for `release` when it is set.
+    """
+
+    model_name = "stub"
+    batch_size = 4
+    sampling_rate = 16000
+    language_windows = 0
+
+    def __init__(self, index: int) -> None:
+        self.device = f"cpu{index}"
+        self.sizer = BatchSizer(self.batch_size)
+        self.release: threading.Event | None = None
+        self.started = threading.Event()
+        self.fail = False
+        self.seen: list[int] = []
+
+    def forward(self, items: list[dict], options: GenerateOptions) -> list[dict]:
+        self.seen.append(len(items))
+        self.started.set()
+        if self.release is not None:
+            self.release.wait(5)
+        if self.fail:
+            raise RuntimeError("replica failed")
+        return [{"device": self.device, **item} for item in items]
+
+    def batch_limit(self, options: GenerateOptions) -> int:
+        return self.sizer.limit("default")
+
+
+def items(n: int) -> list[dict]:
+    return [{"id": i} for i in range(n)]
+
+
+def test_batches_go_to_the_least_loaded_replica():
+    replicas = [Replica(0), Replica(1)]
+    pool = ReplicaPool(replicas)
+    release = threading.Event()
+    replicas[0].release = replicas[1].release = release
+
+    threads = [threading.Thread(target=pool.forward, args=(items(3), GenerateOptions()))]
+    threads[0].start()
+    assert replicas[0].started.wait(5)
+    threads.append(threading.Thread(target=pool.forward, args=(items(1), GenerateOptions())))
+    threads[1].start()
+    assert replicas[1].started.wait(5)
+    assert [stats["queue_depth"] for stats in pool.stats()] == [3, 1]
+
+    # Replica 1 has the fewest windows in flight, even though it is busy too
+    threads.append(threading.Thread(target=pool.forward, args=(items(1), GenerateOptions())))
+    threads[2].start()
+    deadline = time.monotonic() + 5
+    while pool.stats()[1]["queue_depth"] < 2 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert [stats["queue_depth"] for stats in pool.stats()] == [3, 2]
+
+    release.set()
+    for thread in threads:
+        thread.join(5)
+    assert replicas[0].seen == [3] and replicas[1].seen == [1, 1]
+    assert [stats["queue_depth"] for stats in pool.stats()] == [0, 0]
+
+
+def test_load_is_released_when_a_replica_raises():
+    replicas = [Replica(0), Replica(1)]
+    replicas[0].fail = True
+    pool = ReplicaPool(replicas)
+    with pytest.raises(RuntimeError):
+        pool.forward(items(4), GenerateOptions())
+    assert [stats["queue_depth"] for stats in pool.stats()] == [0, 0]
+    assert replicas[0].seen == [4]
+
+    replicas[0].fail = False
+    outputs = pool.forward(items(2), GenerateOptions())  # Not avoided as if it were still loaded
+    assert {output["device"] for output in outputs} == {"cpu0"}
+
+
+def test_scheduler_keeps_every_replica_busy():
+    replicas = [Replica(0), Replica(1)]
+    pool = ReplicaPool(replicas)
+    release = threading.Event()
+    replicas[0].release = replicas[1].release = release
+
+    async def main() -> list[dict]:
+        scheduler = BatchScheduler(max_wait=0.01)
+        try:
+            futures = [scheduler.submit(pool, item, GenerateOptions()) for item in items(8)]
+            loop = asyncio.get_running_loop()
+            started = await loop.run_in_executor(None, lambda: all(r.started.wait(5) for r in replicas))
+            assert started  # Both batches run at once
+            release.set()
+            return await asyncio.wait_for(asyncio.gather(*futures), 5)
+        finally:
+            await scheduler.close()
+
+    outputs = asyncio.run(main())
+    assert [output["id"] for output in outputs] == list(range(8))
+    assert {output["device"] for output in outputs} == {"cpu0", "cpu1"}
+
+
+def test_batch_limit_is_the_largest_of_the_replicas():
+    replicas = [Replica(0), Replica(1)]
+    replicas[0].sizer.failed("default", 4)
+    assert ReplicaPool(replicas).batch_limit(GenerateOptions()) == 4
@@ -0,0 +1,124 @@
+import asyncio
+import time
+
+import numpy as np
+import pytest
+
+from batching import BatchScheduler
+from inference import GenerateOptions
+from realtime import SAMPLING_RATE, LocalAgreement, PCMDecoder, RealtimeSession, Word
+
+
+def words(*texts: str, start: float = 0) -> list[Word]:
+    return [Word(start + i, start + i + 1, f" {text}") for i, text in enumerate(texts)]
+
+
+def test_agreement_commits_the_common_prefix():
+    agreement = LocalAgreement()
+    assert agreement.insert(words("the", "cat")) == []
+    assert [w.text for w in agreement.insert(words("the", "cat", "sat"))] == [" the", " cat"]
+    assert [w.text for w in agreement.previous] == [" sat"]
+    assert agreement.insert(words("a", "dog", start=2)) == []  # Changed its mind, nothing agreed
+    assert [w.text for w in agreement.flush()] == [" a", " dog"]
+    assert agreement.previous == [] and agreement.end == 4
+
+
+def test_agreement_skips_words_repeating_the_committed_ones():
+    agreement = LocalAgreement()
+    agreement.insert(words("one", "two"))
+    agreement.insert(words("one", "two"))
+    # The window still holds the committed words, with slightly moved timestamps
+    hypothesis = [Word(1.95, 2.5, " Two,"), *words("three", start=2.5)]
+    assert agreement._overlap(hypothesis) == 1
+    assert agreement.insert(hypothesis) == []
+    assert [w.text for w in agreement.insert(words("three", "four", start=2.5))] == [" three"]
+
+
+class Stub:
+    r"""
+    Model stub whose passes take `forward_s` and hear one word per second of the window.
+    """
+
+    batch_size = 4
+    sampling_rate = SAMPLING_RATE
+    parallelism = 1
+
+    def __init__(self, forward_s: float = 0) -> None:
+        self.forward_s = forward_s
+        self.windows: list[int] = []
+
+    def window_item(self, window: np.ndarray) -> dict:
+        self.windows.append(len(window))
+        return {"samples": len(window)}
+
+    def forward(self, items: list[dict], options: GenerateOptions) -> list[dict]:
+        time.sleep(self.forward_s)
+        return items
+
+    def postprocess(self, outputs: list[dict], options: GenerateOptions) -> dict:
+        seconds = outputs[0]["samples"] // SAMPLING_RATE
+        chunks = [{"text": f" w{i}", "timestamp": (i, i + 1)} for i in range(seconds)]
+        return {"text": "".join(c["text"] for c in chunks), "chunks": chunks}
+
+
+def seconds(n: float) -> np.ndarray:
+    return np.zeros(int(n * SAMPLING_RATE), dtype=np.float32)
+
+
+def run(main):
+    async def wrapped():
+        scheduler = BatchScheduler(max_wait=0.001)
+        try:
+            return await asyncio.wait_for(main(scheduler), 5)
+        finally:
+            await scheduler.close()
+
+    return asyncio.run(wrapped())
+
+
+def test_window_is_bounded_while_passes_fall_behind():
+    model = Stub()
+
+    async def main(scheduler):
+        session = RealtimeSession(model, scheduler, GenerateOptions())
+        for _ in range(40):
+            session.feed(seconds(1))
+        assert len(session.window) == 30 * SAMPLING_RATE
+        assert session.offset == 10 * SAMPLING_RATE
+        commit, _ = await session.decode()
+        return session, commit
+
+    session, commit = run(main)
+    assert model.windows == [30 * SAMPLING_RATE]
+    assert commit[0].start == 10  # Words are placed in the session, after the dropped audio
+    assert len(session.window) <= 15 * SAMPLING_RATE  # Trimmed to `trim_s` once committed
+
+
+def test_audio_arriving_during_a_pass_is_kept():
+    model = Stub(forward_s=0.2)
+
+    async def main(scheduler):
+        session = RealtimeSession(model, scheduler, GenerateOptions())
+        session.feed(seconds(30))
+        decoding = asyncio.ensure_future(session.decode())
+        await asyncio.sleep(0.05)
+        session.feed(seconds(20))  # Longer than `trim_s`
+        await decoding
+        return session
+
+    session = run(main)
+    assert session.decoded == 30 * SAMPLING_RATE
+    assert session.offset <= session.decoded  # Nothing after the decoded audio was cut
+    assert session.offset + len(session.window) == session.received == 50 * SAMPLING_RATE
+
+
+def test_pcm_decoder_flushes_its_resampler():
+    rate = 48000
+    t = np.arange(rate) / rate
+    pcm = (np.sin(2 * np.pi * 440 * t) * 16000).astype("<i2").tobytes()
+    blocks: list[np.ndarray] = []
+    decoder = PCMDecoder(rate, blocks.append)
+    for start in range(0, len(pcm), 1921):  # Frames splitting samples
+        decoder.write(pcm[start : start + 1921])
+    decoder.close()
+    assert sum(len(b) for b in blocks) == pytest.approx(SAMPLING_RATE, abs=1)
@@ -0,0 +1,100 @@
+import asyncio
+import types
+
+import pytest
+import torch
+from fastapi import HTTPException
+
+from inference import STTArgs
+from registry import ModelRegistry, footprint
+
+
+class Loader:
+    r"""
+    Stand-in for `load_replicas`: the models it loads are names, in the order they were loaded.
+    """
+
+    def __init__(self) -> None:
+        self.loaded: list[str] = []
+
+    def __call__(self, args: STTArgs, spec: dict) -> str:
+        self.loaded.append(args.model_name)
+        return args.model_name
+
+
+def registry(loader: Loader, budget_mb: int, **pinned: bool) -> ModelRegistry:
+    specs = {
+        name: {"model_name": name, "memory_mb": 100, "pinned": pinned.get(name, False)} for name in "abc"
+    }
+    return ModelRegistry(specs, STTArgs(), budget_mb << 20, loader)
+
+
+async def use(registry: ModelRegistry, name: str) -> None:
+    await registry.acquire(name)
+    registry.release(name)
+
+
+def loaded(registry: ModelRegistry) -> list[str]:
+    return sorted(registry.loaded())
+
+
+def test_least_recently_used_idle_model_is_evicted():
+    async def main():
+        models = registry(Loader(), 200)
+        await use(models, "a")
+        await use(models, "b")
+        await use(models, "a")
+        await use(models, "c")
+        return loaded(models)
+
+    assert asyncio.run(main()) == ["a", "c"]
+
+
+def test_pinned_models_are_loaded_at_startup_and_never_evicted():
+    async def main():
+        loader = Loader()
+        models = registry(loader, 200, a=True)
+        await models.load_pinned()
+        assert loader.loaded == ["a"]
+        await use(models, "b")
+        await use(models, "c")
+        return loaded(models)
+
+    assert asyncio.run(main()) == ["a", "c"]
+
+
+def test_models_in_use_are_not_evicted_past_the_budget():
+    async def main():
+        models = registry(Loader(), 200)
+        await models.acquire("a")
+        await models.acquire("b")
+        with pytest.raises(HTTPException) as error:
+            await models.acquire("c")
+        assert error.value.status_code == 503
+        assert models.used <= 200 << 20
+        models.release("b")
+        await models.acquire("c")  # Room once "b" is idle
+        return loaded(models)
+
+    assert asyncio.run(main()) == ["a", "c"]
+
+
+def test_concurrent_requests_load_a_model_once():
+    async def main():
+        loader = Loader()
+        models = registry(loader, 0)
+        await asyncio.gather(*(models.acquire("a") for _ in range(4)))
+        return loader.loaded, models.stats()[0]["in_use"]
+
+    assert asyncio.run(main()) == (["a"], 4)
+
+
+def test_footprint_counts_int8_weights_and_tied_weights_once():
+    model = torch.nn.Sequential(torch.nn.Linear(64, 64), torch.nn.Linear(64, 64), torch.nn.LayerNorm(64))
+    model[1].weight = model[0].weight  # Tied, as Whisper's output projection is
+    stt = types.SimpleNamespace(pipe=types.SimpleNamespace(model=model), assistant=None)
+    assert footprint(stt) == (64 * 64 + 2 * 64 + 2 * 64) * 4
+
+    torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8, inplace=True)
+    linear = 64 * 64 + 64 * 4 + 4 + 8  # int8 weights, float bias, scale and zero point
+    assert footprint(stt) == 2 * linear + 2 * 64 * 4
@@ -0,0 +1,97 @@
+import asyncio
+import os
+import shutil
+import subprocess
+import tempfile
+
+import pytest
+
+import sharding
+from batching import BatchScheduler
+from audio import probe_duration
+from benchmark import StubSTT, synthetic_audio
+from inference import GenerateOptions
+from sharding import Sharder
+
+
+@pytest.fixture
+def decoded(monkeypatch):
+    # Files decoded to shared memory, which only sharded ones should be
+    paths = []
+
+    def decode_to_file(*args, **kwargs):
+        paths.append(real(*args, **kwargs))
+        return paths[-1]
+
+    real = sharding.decode_to_file
+    monkeypatch.setattr(sharding, "decode_to_file", decode_to_file)
+    return paths
+
+
+def run(sharder: Sharder, model, data) -> dict:
+    async def main() -> dict:
+        scheduler = BatchScheduler(max_wait=0.001)
+        try:
+            return await sharder.run(model, data, GenerateOptions(), scheduler)
+        finally:
+            await scheduler.close()
+
+    return asyncio.run(main())
+
+
+def test_short_files_stream(decoded):
+    result = run(Sharder(shard_s=10), StubSTT(forward_s=0, item_s=0, parallelism=4), synthetic_audio(15, 0))
+    assert result["duration"] == pytest.approx(15, abs=0.01)
+    assert decoded == []
+
+
+def test_single_replica_streams(decoded):
+    result = run(Sharder(shard_s=10), StubSTT(forward_s=0, item_s=0, parallelism=1), synthetic_audio(45, 0))
+    assert result["duration"] == pytest.approx(45, abs=0.01)
+    assert decoded == []
+
+
+def test_long_files_shard(decoded):
+    result = run(Sharder(shard_s=10), StubSTT(forward_s=0, item_s=0, parallelism=4), synthetic_audio(45, 0))
+    assert result["duration"] == pytest.approx(45, abs=0.01)
+    assert len(decoded) == 1 and not os.path.exists(decoded[0])
+    begins = [chunk["timestamp"][0] for chunk in result["chunks"]]
+    assert begins == sorted(begins) and len(begins) > 1
+
+
+def test_shards_share_the_language_detected_once(decoded):
+    class Detecting(StubSTT):
+        def identify_language(self, file, windows=3):
+            detected.append(len(file))
+            return {"fr": 0.9, "en": 0.1}
+
+        def forward(self, items, options):
+            languages.add(options.language)
+            return super().forward(items, options)
+
+    detected: list[int] = []
+    languages: set = set()
+    result = run(Sharder(shard_s=10), Detecting(forward_s=0, item_s=0, parallelism=4), synthetic_audio(45, 0))
+    assert len(detected) == 1 and detected[0] < 45 * 16000  # On the first shard only
+    assert languages == {"fr"}
+    assert result["language"] == "fr"
+
+
+@pytest.mark.skipif(shutil.which("ffmpeg") is None, reason="Needs ffmpeg to encode compressed audio")
+@pytest.mark.parametrize("max_size", [1 << 30, 1024])  # Kept in memory, rolled over to an unnamed file
+def test_compressed_uploads_shard(decoded, max_size):
+    encoded = subprocess.run(
+        ["ffmpeg", "-i", "pipe:0", "-c:a", "libopus", "-f", "ogg", "-loglevel", "quiet", "pipe:1"],
+        input=synthetic_audio(45, 0),
+        capture_output=True,
+        check=True,
+    ).stdout
+    upload = tempfile.SpooledTemporaryFile(max_size=max_size)  # As Starlette and `URLFetcher` spool them
+    upload.write(encoded)
+    upload.seek(0)
+    assert probe_duration(upload) == pytest.approx(45, abs=0.1)
+    assert upload.tell() == 0
+
+    result = run(Sharder(shard_s=10), StubSTT(forward_s=0, item_s=0, parallelism=4), upload)
+    assert result["duration"] == pytest.approx(45, abs=0.1)
+    assert len(decoded) == 1
@@ -0,0 +1,51 @@
+import numpy as np
+import pytest
+
+from vad import pack_windows, speech_segments
+
+RATE = 16000
+
+
+def speech(*regions: tuple[float, float]) -> list[np.ndarray]:
+    # Loud tone over the `(start, end)` regions, silence elsewhere, in blocks of one second
+    end = max(stop for _, stop in regions) + 2
+    audio = np.zeros(int(end * RATE), dtype=np.float32)
+    t = np.arange(len(audio)) / RATE
+    for start, stop in regions:
+        i, j = int(start * RATE), int(stop * RATE)
+        audio[i:j] = 0.5 * np.sin(2 * np.pi * 440 * t[i:j])
+    return [audio[i : i + RATE] for i in range(0, len(audio), RATE)]
+
+
+class LevelVAD:
+    # Fixed threshold, unlike `EnergyVAD` whose noise floor follows a long steady tone
+    frame_s = 0.03
+
+    def __call__(self, frames: np.ndarray) -> np.ndarray:
+        return np.abs(frames).max(axis=1) > 0.1
+
+
+def segments(blocks: list[np.ndarray]) -> list[tuple[int, np.ndarray]]:
+    return list(speech_segments(blocks, RATE, LevelVAD()))
+
+
+@pytest.mark.parametrize("length", [29.9, 30, 30.02, 30.3, 45, 60.02, 75])
+def test_long_regions_fit_windows(length):
+    pieces = segments(speech((1, 1 + length)))
+    for start, samples in pieces:
+        assert 0.5 * RATE <= len(samples) <= 30 * RATE
+    # Contiguous pieces, covering the region
+    for (start, samples), (next_start, _) in zip(pieces, pieces[1:]):
+        assert start + len(samples) == next_start
+    assert pieces[0][0] <= RATE
+    assert pieces[-1][0] + len(pieces[-1][1]) >= (1 + length) * RATE
+
+    # Every piece is packed whole, never split over two windows
+    windows = list(pack_windows(pieces, 30 * RATE))
+    assert sum(len(spans) for _, spans in windows) == len(pieces)
+
+
+def test_separate_regions():
+    pieces = segments(speech((1, 3), (10, 12)))
+    assert len(pieces) == 2
+    assert [round(start / RATE, 1) for start, _ in pieces] == [0.8, 9.8]
@@ -0,0 +1,100 @@
+import asyncio
+import os
+
+import pytest
+
+import workers
+from audio import SHM
+from benchmark import StubSTT, synthetic_audio
+from inference import GenerateOptions, STTArgs
+from workers import WorkerPool
+
+CRASH = "crash"  # Prompt on which the stub worker dies
+
+
+class CrashingSTT(StubSTT):
+    def forward(self, items: list[dict], options: GenerateOptions) -> list[dict]:
+        if options.prompt == CRASH:
+            os._exit(3)
+        return super().forward(items, options)
+
+
+def load_stub(args: STTArgs) -> CrashingSTT:
+    # Module-level, so that the spawned workers can unpickle it
+    return CrashingSTT(forward_s=0, item_s=0)
+
+
+@pytest.fixture
+def pool():
+    pool = WorkerPool(STTArgs(device_id="cpu"), 1, max_wait=0.001, load=load_stub)
+    pool.wait_ready()
+    yield pool
+    pool.close()
+
+
+@pytest.fixture
+def decoded(monkeypatch):
+    # Paths of the rings the audio is handed over through, of 10 s so that long files go round them
+    paths = []
+
+    class Ring(workers._Ring):
+        def __init__(self, capacity: int) -> None:
+            super().__init__(capacity)
+            paths.append(self.path)
+
+    monkeypatch.setattr(workers, "_Ring", Ring)
+    monkeypatch.setattr(workers, "RING_S", 10)
+    return paths
+
+
+def test_audio_is_handed_over_through_shared_memory(pool, decoded):
+    result = asyncio.run(pool.run(synthetic_audio(12, 0), GenerateOptions()))
+    assert result["duration"] == pytest.approx(12, abs=0.01)  # Read by the worker from the memory map
+    assert result["chunks"][0]["text"] == " Stub from 0.0s."
+    (path,) = decoded
+    if SHM is not None:
+        assert os.path.dirname(path) == SHM
+    assert not os.path.exists(path)
+
+
+def test_long_audio_goes_round_the_ring(pool, decoded):
+    result = asyncio.run(pool.run(synthetic_audio(70, 0), GenerateOptions()))
+    assert result["duration"] == pytest.approx(70, abs=0.01)
+    begins = [chunk["timestamp"][0] for chunk in result["chunks"]]
+    assert begins == sorted(begins) and result["chunks"][-1]["timestamp"][1] == pytest.approx(70, abs=0.01)
+    assert not os.path.exists(decoded[0])
+
+
+def test_invalid_audio_is_a_value_error(pool, decoded):
+    with pytest.raises(ValueError):
+        asyncio.run(pool.run(b"RIFF\x00\x00\x00\x00WAVEjunk", GenerateOptions()))
+    assert not os.path.exists(decoded[0])
+    result = asyncio.run(pool.run(synthetic_audio(5, 0), GenerateOptions()))  # The worker is still serving
+    assert result["duration"] == pytest.approx(5, abs=0.01)
+
+
+def test_streamed_chunks(pool, decoded):
+    async def main() -> list:
+        return [chunks async for chunks in pool.stream_chunks(synthetic_audio(70, 0), GenerateOptions())]
+
+    events = asyncio.run(main())
+    chunks = [chunk for event in events for chunk in event]
+    assert chunks[-1]["timestamp"][1] == pytest.approx(70, abs=0.01)
+    assert not os.path.exists(decoded[0])
+
+
+def test_crashed_worker_is_restarted(pool, decoded):
+    with pytest.raises(RuntimeError, match="crashed"):
+        asyncio.run(pool.run(synthetic_audio(5, 0), GenerateOptions(prompt=CRASH)))
+    assert not os.path.exists(decoded[0])
+
+    pool.wait_ready()
+    for _ in range(100):  # The new process is started by the thread that saw the old one die
+        if pool.stats()[0]["restarts"]:
+            break
+        asyncio.run(asyncio.sleep(0.05))
+    assert pool.stats()[0]["restarts"] == 1
+
+    result = asyncio.run(pool.run(synthetic_audio(5, 0), GenerateOptions()))
+    assert result["duration"] == pytest.approx(5, abs=0.01)
+    assert not any(os.path.exists(path) for path in decoded)
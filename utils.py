@@ -1,4 +1,5 @@
 import gc
+import json
 from typing import Literal
 
 import torch
@@ -104,21 +105,8 @@ def vtt_chunk(start: float, end: float, content: str) -> str:
     return chunk
 
 
-def whisper2srt(chunks: list[dict]) -> str:
-    result = ""
-    for index, chunk in enumerate(chunks, start=1):
-        if chunk["timestamp"][1] is None:  # Whisper did not predict an ending timestamp
-            chunk["timestamp"] = (chunk["timestamp"][0], chunk["timestamp"][0] + 0.001)
-        result += srt_chunk(
-            index, chunk["timestamp"][0], chunk["timestamp"][1], chunk["text"]
-        )
-    return result
-
-
-def whisper2vtt(chunks: list[dict]) -> str:
-    result = "WEBVTT\n\n"
-    for chunk in chunks:
-        if chunk["timestamp"][1] is None:  # Whisper did not predict an ending timestamp
-            chunk["timestamp"] = (chunk["timestamp"][0], chunk["timestamp"][0] + 0.001)
-        result += vtt_chunk(chunk["timestamp"][0], chunk["timestamp"][1], chunk["text"])
-    return result
+def sse(event: str, data) -> str:
+    r"""
+    One server-sent event, `data` is JSON-encoded so that it stays on one line.
+    """
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
@@ -0,0 +1,186 @@
+import dataclasses
+from typing import Iterable, Iterator, Protocol
+
+import numpy as np
+
+# (offset in the packed window, start in the original audio, length), all in samples
+Span = tuple[int, int, int]
+
+
+class VAD(Protocol):
+    frame_s: float
+
+    def __call__(self, frames: np.ndarray) -> np.ndarray:
+        r"""
+        `frames` is `(n, frame_len)` float32 PCM, returns `(n,)` booleans, `True` for speech.
+        """
+        ...
+
+
+@dataclasses.dataclass
+class EnergyVAD:
+    r"""
+    Baseline voice activity detection: a frame is speech when it is louder than both `threshold_db` (dBFS)
+    and the running noise floor plus `margin_db`.
+    """
+
+    frame_s: float = 0.03
+    threshold_db: float = -45
+    margin_db: float = 6
+    floor_db: float | None = None  # Running noise floor: follows quiet frames at once, loud ones slowly
+
+    def __call__(self, frames: np.ndarray) -> np.ndarray:
+        db = 10 * np.log10(np.mean(np.square(frames, dtype=np.float64), axis=1) + 1e-10)
+        if len(db):
+            floor = float(np.percentile(db, 10))
+            if self.floor_db is None or floor < self.floor_db:
+                self.floor_db = floor
+            else:
+                self.floor_db = 0.95 * self.floor_db + 0.05 * floor
+        return db > max(self.threshold_db, (self.floor_db or -np.inf) + self.margin_db)
+
+
+def speech_segments(
+    blocks: Iterable[np.ndarray],
+    sampling_rate: int,
+    vad: VAD,
+    min_speech_s: float = 0.25,
+    min_silence_s: float = 0.5,
+    pad_s: float = 0.2,
+    max_segment_s: float = 30,
+    min_piece_s: float = 0.5,
+) -> Iterator[tuple[int, np.ndarray]]:
+    r"""
+    Yield `(start, samples)` of the speech regions of a stream of PCM blocks, `start` being in samples
+    of the original audio. Regions longer than `max_segment_s` are yielded in pieces of at most `max_segment_s`,
+    so memory stays bounded and a piece always fits in one window; a last piece shorter than `min_piece_s`
+    is merged into the one before it.
+    """
+
+    frame_len = int(vad.frame_s * sampling_rate)
+    min_speech = max(1, int(min_speech_s / vad.frame_s))
+    min_silence = int(min_silence_s * sampling_rate)
+    pad = min(int(pad_s * sampling_rate), min_silence)
+    max_segment = int(max_segment_s * sampling_rate)
+    min_piece = int(min_piece_s * sampling_rate)
+
+    audio = np.empty(0, dtype=np.float32)
+    offset = 0  # Position of `audio[0]` in the original audio
+    framed = 0  # Samples already split into frames
+    segment_start = None  # Start of the current speech region, `None` when in silence
+    speech_end = 0  # End of the last speech frame
+    run_start, run = 0, 0  # Consecutive speech frames seen in silence
+    held: tuple[int, np.ndarray] | None = None  # Last full piece of the region, kept back in case the rest is short
+
+    for block in blocks:
+        audio = np.concatenate([audio, block])
+        n = (offset + len(audio) - framed) // frame_len
+        start = framed - offset
+        frames = audio[start : start + n * frame_len].reshape(n, frame_len)
+        for i, speech in enumerate(vad(frames)):
+            frame_start = framed + i * frame_len
+            frame_end = frame_start + frame_len
+            if segment_start is None:
+                if not speech:
+                    run = 0
+                    continue
+                if run == 0:
+                    run_start = frame_start
+                run += 1
+                if run >= min_speech:
+                    segment_start = max(run_start - pad, offset)
+                    speech_end = frame_end
+            elif speech:
+                speech_end = frame_end
+                if frame_end - segment_start >= max_segment:
+                    if held is not None:
+                        yield held
+                    cut = segment_start + max_segment
+                    held = segment_start, audio[segment_start - offset : cut - offset]
+                    segment_start = cut
+            elif frame_end - speech_end >= min_silence:
+                samples = audio[segment_start - offset : speech_end + pad - offset]
+                yield from _close(held, segment_start, samples, max_segment, min_piece)
+                segment_start, run, held = None, 0, None
+        framed += n * frame_len
+
+        # Only keep what may still become part of a region
+        keep = segment_start if segment_start is not None else framed - pad - min_speech * frame_len
+        if (drop := max(keep, offset) - offset) > 0:
+            audio = audio[drop:]
+            offset += drop
+
+    if segment_start is not None:
+        end = min(speech_end + pad, offset + len(audio))
+        samples = audio[segment_start - offset : end - offset]
+        yield from _close(held, segment_start, samples, max_segment, min_piece)
+
+
+def _close(
+    held: tuple[int, np.ndarray] | None,
+    start: int,
+    samples: np.ndarray,
+    max_segment: int,
+    min_piece: int,
+) -> Iterator[tuple[int, np.ndarray]]:
+    r"""
+    Yield the last pieces of a region: a too short rest is merged into the held piece, and a piece over
+    `max_segment` (a rest that was merged, or the end padding) is halved rather than leaving a sliver.
+    """
+
+    if held is not None:
+        if len(samples) < min_piece:
+            start, samples = held[0], np.concatenate([held[1], samples])
+        else:
+            yield held
+    if len(samples) > max_segment:
+        half = len(samples) // 2
+        yield start, samples[:half]
+        start, samples = start + half, samples[half:]
+    yield start, samples
+
+
+def pack_windows(
+    segments: Iterable[tuple[int, np.ndarray]],
+    window_len: int,
+    gap: int = 0,
+) -> Iterator[tuple[np.ndarray, list[Span]]]:
+    r"""
+    Concatenate speech regions into windows of up to `window_len` samples, separated by `gap` samples of silence.
+    A region is only split when it does not fit in an empty window.
+    """
+
+    parts: list[np.ndarray] = []
+    spans: list[Span] = []
+    size = 0
+    for start, samples in segments:
+        while len(samples):
+            if size and size + gap + len(samples) > window_len:
+                yield np.concatenate(parts), spans
+                parts, spans, size = [], [], 0
+            if size:
+                parts.append(np.zeros(gap, dtype=np.float32))
+                size += gap
+            take = samples[: window_len - size]
+            parts.append(take)
+            spans.append((size, start, len(take)))
+            size += len(take)
+            start += len(take)
+            samples = samples[len(take) :]
+    if parts:
+        yield np.concatenate(parts), spans
+
+
+def remap(t: float | None, spans: list[Span], sampling_rate: int) -> float | None:
+    r"""
+    Map a time (in second) of a packed window back to the original audio.
+    """
+
+    if t is None or not spans:
+        return t
+    position = t * sampling_rate
+    index = 0
+    while index + 1 < len(spans) and spans[index + 1][0] <= position:
+        index += 1
+    packed, original, length = spans[index]
+    return (original + min(max(position - packed, 0), length)) / sampling_rate
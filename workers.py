@@ -0,0 +1,495 @@
+import asyncio
+import dataclasses
+import itertools
+import logging
+import multiprocessing
+import os
+import tempfile
+import threading
+from typing import AsyncIterator, BinaryIO, Callable, Dict, Iterator, List
+
+import numpy as np
+
+import metrics
+from audio import SHM, decode_stream
+from inference import GenerateOptions, STTArgs
+
+SAMPLING_RATE = 16000  # Of every Whisper feature extractor
+RING_S = 60  # Decoded audio a request may hold in shared memory, ahead of what its worker has read
+
+
+class WorkerPool:
+    r"""
+    Runs `STT` in dedicated worker processes, away from the GIL of the event loop.
+
+    Audio is decoded here as the worker reads it, through a memory-backed ring buffer of `RING_S` seconds that
+    workers memory-map, instead of being pickled. Each worker batches the chunks of its own requests, and sends
+    back only the results over a pipe.
+    Workers are spread over the devices of `--device-id`, and over the core sets of `--cpu-cores` ("0-7;8-15").
+    Workers that die are restarted, their requests fail. Their metrics are sent back once a second while busy,
+    and merged into the ones of this process. Workers load and warm up in the background, see `wait_ready`.
+    """
+
+    def __init__(
+        self,
+        args: STTArgs,
+        workers: int,
+        max_batch_size: int | None = None,
+        max_wait: float = 0.01,
+        load: Callable[[STTArgs], object] | None = None,  # In the workers, `start_replicas` by default
+    ) -> None:
+        self.model_name = args.model_name
+        self.language_windows = args.detect_language_windows
+        devices = args.device_id.split(",")
+        core_sets = args.cpu_cores.split(";") if args.cpu_cores else [None]
+        context = multiprocessing.get_context("spawn")  # CUDA can not be forked
+        self.workers = [
+            _Worker(
+                f"worker{index}",
+                dataclasses.replace(
+                    args,
+                    device_id=devices[index % len(devices)].strip(),
+                    cpu_cores=core_sets[index % len(core_sets)],
+                ),
+                context,
+                max_batch_size,
+                max_wait,
+                load,
+            )
+            for index in range(workers)
+        ]
+        self.ids = itertools.count()
+
+    async def run(self, file: str | bytes | BinaryIO, options: GenerateOptions) -> dict:
+        async for kind, payload in self._job(file, ("job", options, False)):
+            if kind == "done":
+                return payload  # type: ignore
+        raise RuntimeError("Worker sent no result")
+
+    async def run_span(self, path: str, span: tuple[int, int], options: GenerateOptions) -> dict:
+        r"""
+        Transcribe the samples `span` (start, end) of audio already decoded into `path`, *e.g.* a shard of a long
+        file. `path` is left to the caller.
+        """
+
+        async for kind, payload in self._job(path, ("job", options, False, span), decoded=True):
+            if kind == "done":
+                return payload  # type: ignore
+        raise RuntimeError("Worker sent no result")
+
+    async def stream_chunks(
+        self, file: str | bytes | BinaryIO, options: GenerateOptions
+    ) -> AsyncIterator[list[dict]]:
+        async for kind, payload in self._job(file, ("job", options, True)):
+            if kind == "chunks":
+                yield payload  # type: ignore
+
+    def wait_ready(self) -> None:
+        r"""
+        Block until every worker has loaded and warmed up its model, raise if one died doing so.
+        """
+
+        for worker in self.workers:
+            worker.ready.wait()
+            if worker.error is not None:
+                self.close()
+                raise RuntimeError(worker.error)
+
+    async def identify_language(
+        self, file: str | bytes | BinaryIO | np.ndarray, windows: int = 3
+    ) -> Dict[str, float]:
+        # Only the audio of these windows is decoded
+        async for kind, payload in self._job(file, ("detect", windows), max_seconds=30 * windows):
+            if kind == "done":
+                return payload  # type: ignore
+        raise RuntimeError("Worker sent no result")
+
+    def stats(self) -> List[dict]:
+        return [
+            {
+                "replica": worker.name,
+                "pid": worker.process.pid,
+                "queue_depth": len(worker.jobs),
+                "restarts": worker.restarts,
+            }
+            for worker in self.workers
+        ]
+
+    def close(self) -> None:
+        for worker in self.workers:
+            worker.close()
+
+    async def _job(
+        self,
+        file: str | bytes | BinaryIO | np.ndarray,
+        request: tuple,
+        max_seconds: float | None = None,
+        decoded: bool = False,  # `file` is the path of samples decoded already, not removed afterwards
+    ) -> AsyncIterator[tuple[str, object]]:
+        loop = asyncio.get_running_loop()
+        worker = min(self.workers, key=lambda w: len(w.jobs))
+        job_id = next(self.ids)
+        ring = None if decoded else _Ring(int(RING_S * SAMPLING_RATE))
+        source = file if ring is None else (ring.path, ring.capacity)
+        producer = None
+        getter = None
+        try:
+            queue = worker.submit(job_id, (request[0], job_id, source, *request[1:]), ring)
+            if ring is not None:  # Decoded while the worker reads it, decoding errors are raised here
+
+                def notify(written: int, done: bool) -> None:
+                    worker.send(("audio", job_id, written, done))
+
+                producer = loop.run_in_executor(None, ring.fill, file, max_seconds, notify)
+            while True:
+                getter = getter or asyncio.ensure_future(queue.get())
+                if producer is not None and not producer.done():
+                    await asyncio.wait({getter, producer}, return_when=asyncio.FIRST_COMPLETED)
+                    if producer.done():
+                        producer.result()
+                    if not getter.done():
+                        continue
+                kind, payload = await getter
+                getter = None
+                if kind == "error":
+                    raise RuntimeError(payload)
+                if kind == "invalid":
+                    raise ValueError(payload)
+                yield kind, payload
+                if kind == "done":
+                    break
+        finally:
+            if getter is not None:
+                getter.cancel()
+            worker.finish(job_id)
+            if ring is not None:
+                ring.close(filled=producer is not None)  # The worker keeps its mapping if it is still reading
+
+
+class _Ring:
+    r"""
+    Decoded samples handed over to a worker through a memory-backed file of `capacity` samples, written over
+    in a circle: the worker is told how far it is written, and tells how far it has read, so that decoding
+    runs at most `capacity` samples ahead of it.
+    """
+
+    def __init__(self, capacity: int) -> None:
+        self.capacity = capacity
+        self.fd, self.path = tempfile.mkstemp(suffix=".f32", dir=SHM)
+        os.ftruncate(self.fd, capacity * 4)
+        self.written = 0
+        self.read = 0
+        self.closed = False
+        self.condition = threading.Condition()
+
+    def fill(
+        self,
+        file: str | bytes | BinaryIO | np.ndarray,
+        max_seconds: float | None,
+        notify: Callable[[int, bool], None],
+    ) -> None:
+        r"""
+        Decode `file` into the ring, up to `max_seconds` if given, waiting for the worker to read as it fills up.
+        """
+
+        blocks = decode_stream(file, SAMPLING_RATE)
+        try:
+            for block in blocks:
+                if not self._write(block):
+                    return  # The job has ended
+                notify(self.written, False)
+                if max_seconds is not None and self.written >= max_seconds * SAMPLING_RATE:
+                    break
+            notify(self.written, True)
+        finally:
+            blocks.close()
+            os.close(self.fd)
+
+    def consumed(self, read: int) -> None:
+        with self.condition:
+            self.read = read
+            self.condition.notify_all()
+
+    def close(self, filled: bool = True) -> None:
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+        if not filled:
+            os.close(self.fd)
+        os.unlink(self.path)
+
+    def _write(self, samples: np.ndarray) -> bool:
+        done = 0
+        while done < len(samples):
+            with self.condition:
+                self.condition.wait_for(lambda: self.closed or self.written - self.read < self.capacity)
+                if self.closed:
+                    return False
+                position = self.written % self.capacity
+                n = min(len(samples) - done, self.capacity - (self.written - self.read), self.capacity - position)
+            block = np.ascontiguousarray(samples[done : done + n], dtype=np.float32)
+            os.pwrite(self.fd, block.tobytes(), position * 4)
+            with self.condition:
+                self.written += n
+            done += n
+        return True
+
+
+class _RingReader:
+    r"""
+    The worker side of a `_Ring`: iterates over its samples as they are written, in blocks of at most 5 s.
+    """
+
+    def __init__(self, path: str, capacity: int, job_id: int, send: Callable[[tuple], None]) -> None:
+        self.ring = np.memmap(path, dtype=np.float32, mode="r", shape=(capacity,))
+        self.capacity = capacity
+        self.job_id = job_id
+        self.send = send
+        self.written = 0
+        self.done = False
+        self.closed = False
+        self.condition = threading.Condition()
+
+    def update(self, written: int, done: bool) -> None:
+        with self.condition:
+            self.written, self.done = written, done
+            self.condition.notify_all()
+
+    def close(self) -> None:
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+
+    def __iter__(self) -> Iterator[np.ndarray]:
+        read = 0
+        while True:
+            with self.condition:
+                self.condition.wait_for(lambda: self.closed or self.done or self.written > read)
+                if self.closed or self.done and self.written == read:
+                    return
+                written = self.written
+            position = read % self.capacity
+            n = min(written - read, self.capacity - position, 5 * SAMPLING_RATE)
+            samples = np.array(self.ring[position : position + n])  # Copied before it is written over
+            read += n
+            try:
+                self.send((self.job_id, "consumed", read))
+            except OSError:  # The server has gone
+                return
+            yield samples
+
+
+class _Worker:
+    def __init__(self, name: str, args: STTArgs, context, max_batch_size, max_wait, load=None) -> None:
+        self.name = name
+        self.args = args
+        self.context = context
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.load = load  # Picklable, *e.g.* a module-level function
+        self.lock = threading.Lock()
+        self.jobs: Dict[int, tuple[asyncio.AbstractEventLoop, asyncio.Queue]] = {}
+        self.rings: Dict[int, _Ring] = {}  # Of the jobs whose audio is still being decoded
+        self.restarts = 0
+        self.closed = False
+        self.ready = threading.Event()  # Set once its model is loaded (and stays so across restarts)
+        self.error: str | None = None
+        self.start()
+
+    def start(self) -> None:
+        self.conn, child = self.context.Pipe()
+        self.process = self.context.Process(
+            target=_serve,
+            args=(self.args, child, self.max_batch_size, self.max_wait, self.load),
+            name=self.name,
+            daemon=True,
+        )
+        self.process.start()
+        child.close()
+        threading.Thread(target=self._receive, args=(self.conn, self.process), daemon=True).start()
+
+    def submit(self, job_id: int, message: tuple, ring: "_Ring | None" = None) -> asyncio.Queue:
+        queue: asyncio.Queue = asyncio.Queue()
+        with self.lock:
+            self.jobs[job_id] = (asyncio.get_running_loop(), queue)
+            try:
+                self.conn.send(message)
+            except OSError:
+                del self.jobs[job_id]
+                raise RuntimeError(f"{self.name} is restarting")
+            if ring is not None:
+                self.rings[job_id] = ring
+        return queue
+
+    def send(self, message: tuple) -> None:
+        with self.lock:
+            try:
+                self.conn.send(message)
+            except OSError:  # Restarting, its jobs fail
+                pass
+
+    def finish(self, job_id: int) -> None:
+        with self.lock:
+            self.rings.pop(job_id, None)
+            if self.jobs.pop(job_id, None) is not None:  # Client has gone before the result
+                try:
+                    self.conn.send(("cancel", job_id))
+                except OSError:
+                    pass
+
+    def close(self) -> None:
+        self.closed = True
+        self.process.terminate()
+
+    def _deliver(self, job_id: int, message: tuple) -> None:
+        with self.lock:
+            job = self.jobs.get(job_id)
+            if job is not None and message[0] != "chunks":
+                del self.jobs[job_id]
+        if job is not None:
+            loop, queue = job
+            loop.call_soon_threadsafe(queue.put_nowait, message)
+
+    def _receive(self, conn, process) -> None:
+        try:
+            while True:
+                job_id, kind, payload = conn.recv()
+                if kind == "metrics":
+                    metrics.REMOTE[f"{self.name}:{process.pid}"] = payload
+                elif kind == "consumed":
+                    with self.lock:
+                        ring = self.rings.get(job_id)
+                    if ring is not None:
+                        ring.consumed(payload)
+                elif kind == "ready":
+                    self.ready.set()
+                else:
+                    self._deliver(job_id, (kind, payload))
+        except (EOFError, OSError):
+            pass
+
+        # The worker has died, fail what it was doing and start a new one
+        process.join()
+        metrics.retire(f"{self.name}:{process.pid}")  # Its gauges are stale, its counts stay
+        with self.lock:
+            jobs, self.jobs = self.jobs, {}
+            self.rings = {}  # Closed by their jobs as they fail
+        for loop, queue in jobs.values():
+            message = ("error", f"{self.name} crashed (exit code {process.exitcode})")
+            loop.call_soon_threadsafe(queue.put_nowait, message)
+        if not self.ready.is_set():  # Could not even load, restarting would not help
+            self.error = f"{self.name} exited while loading (exit code {process.exitcode})"
+            self.ready.set()
+        elif not self.closed:
+            self.restarts += 1
+            self.start()
+
+
+def _serve(args: STTArgs, conn, max_batch_size: int | None, max_wait: float, load=None) -> None:
+    from batching import BatchScheduler
+    from pool import start_replicas
+
+    logging.basicConfig(
+        level=logging.INFO,
+        format=f"%(asctime)s %(levelname)s {multiprocessing.current_process().name} %(name)s: %(message)s",
+    )
+    model = (load or start_replicas)(args)
+    conn.send((None, "ready", None))
+    scheduler = BatchScheduler(max_batch_size, max_wait)
+    asyncio.run(_loop(model, scheduler, conn))
+
+
+async def _loop(model, scheduler, conn) -> None:
+    loop = asyncio.get_running_loop()
+    messages: asyncio.Queue = asyncio.Queue()
+    lock = threading.Lock()
+    tasks: Dict[int, asyncio.Task] = {}
+
+    def send(message: tuple) -> None:
+        with lock:
+            conn.send(message)
+
+    def receive() -> None:
+        try:
+            while True:
+                loop.call_soon_threadsafe(messages.put_nowait, conn.recv())
+        except (EOFError, OSError):  # The server has gone
+            loop.call_soon_threadsafe(messages.put_nowait, None)
+
+    async def report() -> None:
+        idle = False
+        while True:
+            await asyncio.sleep(1)
+            if tasks or not idle:  # One last report after the jobs are done
+                try:
+                    send((None, "metrics", metrics.snapshot()))
+                except OSError:  # The server has gone
+                    return
+            idle = not tasks
+
+    rings: Dict[int, _RingReader] = {}
+
+    def failed(job_id: int, e: Exception) -> None:
+        if isinstance(e, ValueError):  # Invalid audio or options, a client error
+            send((job_id, "invalid", str(e)))
+        else:
+            send((job_id, "error", f"{type(e).__name__}: {e}"))
+
+    def ended(job_id: int) -> None:
+        tasks.pop(job_id, None)
+        if (ring := rings.pop(job_id, None)) is not None:
+            ring.close()
+
+    async def run(
+        job_id: int,
+        source: str | _RingReader,
+        options: GenerateOptions,
+        stream: bool,
+        span: tuple[int, int] | None = None,
+    ) -> None:
+        try:
+            audio = np.memmap(source, dtype=np.float32, mode="r") if isinstance(source, str) else source
+            if span is not None:
+                audio = audio[span[0] : span[1]]
+            if stream:
+                async for chunks in scheduler.stream_chunks(model, audio, options):
+                    send((job_id, "chunks", chunks))
+                send((job_id, "done", None))
+            else:
+                send((job_id, "done", await scheduler.run(model, audio, options)))
+        except Exception as e:
+            failed(job_id, e)
+        finally:
+            ended(job_id)
+
+    async def detect(job_id: int, source: str | _RingReader, windows: int) -> None:
+        try:
+            audio = np.memmap(source, dtype=np.float32, mode="r") if isinstance(source, str) else source
+            send((job_id, "done", await loop.run_in_executor(None, model.identify_language, audio, windows)))
+        except Exception as e:
+            failed(job_id, e)
+        finally:
+            ended(job_id)
+
+    threading.Thread(target=receive, daemon=True).start()
+    reporter = asyncio.create_task(report())
+    while (message := await messages.get()) is not None:
+        if message[0] in ("job", "detect"):
+            job_id, source = message[1], message[2]
+            if isinstance(source, tuple):  # (path, capacity) of a `_Ring` the server is decoding into
+                try:
+                    source = rings[job_id] = _RingReader(*source, job_id, send)
+                except OSError as e:  # Removed already, the job has ended
+                    failed(job_id, e)
+                    continue
+            handler = run if message[0] == "job" else detect
+            tasks[job_id] = asyncio.create_task(handler(job_id, source, *message[3:]))  # type: ignore
+        elif message[0] == "audio" and message[1] in rings:
+            rings[message[1]].update(*message[2:])
+        elif message[0] == "cancel":
+            if (ring := rings.pop(message[1], None)) is not None:
+                ring.close()  # Unblocks its reader
+            if message[1] in tasks:
+                tasks[message[1]].cancel()
+    reporter.cancel()
+    await scheduler.close()